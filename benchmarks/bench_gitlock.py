@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+"""
+End to end benchmarks for gitlock.
+
+Synthetic package repos of a configurable size are generated with ``git fast-import``,
+and a lock repo is set up with a local bare repository as its "origin", so that the
+benchmarks are reproducible and do not need the network. Results are written as JSON
+so that latency, throughput and memory can be compared across releases.
+
+Example:
+
+    python benchmarks/bench_gitlock.py --sizes 1000,10000,100000 --lockers 8 -o results.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import platform
+import logging
+import datetime
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+import multiprocessing
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gitlock
+import gitlock.utils
+import gitlock.lock
+import gitlock.git_io
+import gitlock.lockfile
+import gitlock.metrics as metrics
+
+PKG = 'bench'
+# Identity used for the commits made in the benchmark repos
+GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'gitlock-bench',
+    'GIT_AUTHOR_EMAIL': 'bench@example.com',
+    'GIT_COMMITTER_NAME': 'gitlock-bench',
+    'GIT_COMMITTER_EMAIL': 'bench@example.com',
+}
+
+def git(cwd, *args, **kwargs):
+    """
+    Run a git command and return its output
+    """
+    return subprocess.run(['git'] + list(args), cwd=cwd, input=kwargs.get('input'),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stdout
+
+def package_files(n_files):
+    """
+    Paths of the files in a synthetic package, spread over a few levels of directories
+    """
+    return ['include/dir{0}/sub{1}/file{2}.h'.format(n//1000, (n//100)%10, n) for n in range(n_files)]
+
+def make_package(path, n_files):
+    """
+    Create a package repo with ``n_files`` files in a single commit
+    """
+    os.makedirs(path)
+    git(path, 'init', '-q', '-b', 'master')
+    stream = ['blob', 'mark :1', 'data 2', 'x', '',
+              'commit refs/heads/master', 'mark :2',
+              'committer gitlock-bench <bench@example.com> 0 +0000', 'data 4', 'init']
+    stream += ['M 100644 :1 {0}'.format(f) for f in package_files(n_files)]
+    git(path, 'fast-import', '--quiet', input=('\n'.join(stream)+'\n').encode('utf-8'))
+    git(path, 'reset', '-q', '--soft', 'master')
+
+def change_package(path, n_files, n_changes):
+    """
+    Commit a small change to a package: add, delete and rename ``n_changes`` files each
+    """
+    files = package_files(n_files)
+    random.seed(n_files)
+    changed = random.sample(files, 2*n_changes)
+    stream = ['blob', 'mark :1', 'data 2', 'y', '',
+              'commit refs/heads/master',
+              'committer gitlock-bench <bench@example.com> 1 +0000', 'data 6', 'change',
+              'from refs/heads/master^0']
+    stream += ['M 100644 :1 include/new/file{0}.h'.format(n) for n in range(n_changes)]
+    stream += ['D {0}'.format(f) for f in changed[:n_changes]]
+    stream += ['R {0} {1}'.format(f, f.replace('.h', '_renamed.h')) for f in changed[n_changes:]]
+    git(path, 'fast-import', '--quiet', '--force', input=('\n'.join(stream)+'\n').encode('utf-8'))
+    git(path, 'reset', '-q', '--soft', 'master')
+
+def make_lock_remote(path):
+    """
+    Create a bare "origin" for the lock repo with an initial commit
+    """
+    git(os.path.dirname(path), 'init', '-q', '--bare', '-b', 'master', path)
+    seed = path+'.seed'
+    git(os.path.dirname(path), 'clone', '-q', path, seed)
+    with open(os.path.join(seed, 'README'), 'w') as f:
+        f.write('gitlock benchmark locks\n')
+    git(seed, 'add', 'README')
+    git(seed, 'commit', '-q', '-m', 'init')
+    git(seed, 'push', '-q', 'origin', 'master')
+    shutil.rmtree(seed)
+
+def clone_lock_repo(origin, path, pkg_path, backend):
+    """
+    Clone the lock repo and write the package configuration file
+    """
+    args = ['clone', '-q'] + (['--bare'] if backend == 'plumbing' else []) + [origin, path]
+    git(os.path.dirname(path), *args)
+    gitlock.utils.edit_lock_cfg(PKG, path, pkg_path)
+
+def measure(name, func, memory=False):
+    """
+    Run ``func`` and measure its wall time, the time of each phase and (optionally) the
+    peak memory allocated by Python
+    """
+    metrics.reset()
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        func()
+    result = {'name': name, 'seconds': time.perf_counter()-start}
+    result.update(metrics.summary())
+    if memory:
+        result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    phases = [(phase, totals['seconds']) for phase, totals in result['phases'].items()
+              if not phase.startswith('git ')]
+    print("  {0:<12} {1:8.3f}s  {2}".format(name, result['seconds'], ', '.join(
+        ['{0}={1:.3f}'.format(k, v) for k, v in phases])), file=sys.stderr)
+    return result
+
+def bench_size(workdir, n_files, args):
+    """
+    Time init, build, update, lock, unlock and info on a package with ``n_files`` files
+    """
+    print("{0} files:".format(n_files), file=sys.stderr)
+    root = os.path.join(workdir, 'size{0}'.format(n_files))
+    pkg_path = os.path.join(root, 'pkg')
+    origin = os.path.join(root, 'origin.git')
+    gitpath = os.path.join(root, 'locks')
+    os.makedirs(root)
+    start = time.perf_counter()
+    make_package(pkg_path, n_files)
+    make_lock_remote(origin)
+    clone_lock_repo(origin, gitpath, pkg_path, args.backend)
+    other = os.path.join(root, 'other')
+    clone_lock_repo(origin, other, pkg_path, args.backend)
+    setup_time = time.perf_counter()-start
+
+    files = package_files(n_files)
+    user = 'bench-user'
+    results = []
+    results.append(measure('init', lambda: gitlock.utils.create_lockfile(
+        gitpath, PKG, pkg_path, lockfile_format=args.format, shards=args.shards), args.memory))
+    results.append(measure('build', lambda: gitlock.utils.create_lockfile(
+        gitpath, PKG, pkg_path, overwrite=True), args.memory))
+    change_package(pkg_path, n_files, args.changes)
+    results.append(measure('update', lambda: gitlock.utils.create_lockfile(
+        gitpath, PKG, pkg_path, update=True), args.memory))
+    # Only lock files that are still in the package after the update
+    repo = gitlock.lock.Repo(PKG, gitpath)
+    repo.update_all_locks()
+    files = [f for f in files if repo.get_lock(f) is not None]
+    batch = files[:args.batch]
+    results.append(measure('lock', lambda: gitlock.lock.Repo(PKG, gitpath).lock(files[-1], user),
+                           args.memory))
+    results.append(measure('unlock', lambda: gitlock.lock.Repo(PKG, gitpath).unlock(files[-1], user),
+                           args.memory))
+    results.append(measure('lock_batch', lambda: gitlock.lock.Repo(PKG, gitpath).lock(batch, user),
+                           args.memory))
+    results.append(measure('info', lambda: gitlock.lock.Repo(PKG, gitpath).get_locked_info(),
+                           args.memory))
+    results.append(measure('unlock_batch', lambda: gitlock.lock.Repo(PKG, gitpath).unlock(batch, user),
+                           args.memory))
+    # Another client takes a lock, so info has to fetch the changes
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        gitlock.lock.Repo(PKG, other).lock(files[0], 'other-user')
+    results.append(measure('info_changed', lambda: gitlock.lock.Repo(PKG, gitpath).get_locked_info(),
+                           args.memory))
+    # Total size of the lockfile and its shards
+    lockfile_size = sum([int(line.split()[3]) for line in git(
+        origin, 'ls-tree', '-r', '-l', 'HEAD', 'repos/{0}'.format(PKG)).decode('utf-8').splitlines()])
+    git(origin, 'gc', '-q')
+    history_size = sum([os.path.getsize(os.path.join(path, name))
+                        for path, dirs, names in os.walk(os.path.join(origin, 'objects')) for name in names])
+    result = {'files': n_files, 'setup_seconds': setup_time, 'lockfile_bytes': lockfile_size,
+              'history_bytes': history_size, 'operations': results}
+    if not args.keep:
+        shutil.rmtree(root)
+    return result
+
+def locker(params):
+    """
+    Worker process for the concurrency benchmark: lock and unlock a list of files
+    """
+    gitpath, user, files = params
+    os.environ.update(GIT_ENV)
+    # GitPython logs the rejected pushes of the race as errors
+    logging.getLogger('git').setLevel(logging.CRITICAL)
+    metrics.reset()
+    latencies = []
+    granted = 0
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        repo = gitlock.lock.Repo(PKG, gitpath)
+        for filename in files:
+            start = time.perf_counter()
+            try:
+                report = repo.lock(filename, user)
+            except gitlock.git_io.GitError:
+                report = None
+            latencies.append(time.perf_counter()-start)
+            if report:
+                granted += 1
+                try:
+                    repo.unlock(filename, user)
+                except gitlock.git_io.GitError:
+                    pass
+    counters = metrics.summary()['counters']
+    return {'latencies': latencies, 'granted': granted, 'retries': counters.get('retries', 0),
+            'rebased': counters.get('rebased', 0)}
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if len(values)==0:
+        return None
+    return values[min(len(values)-1, int(fraction*len(values)))]
+
+def bench_concurrency(workdir, n_lockers, mode, args):
+    """
+    Race ``n_lockers`` clients, each with its own clone of the lock repo, to lock either
+    the same files (``mode='same'``) or different files (``mode='different'``). Different
+    files are spread over the package, so with ``--shards prefix:3`` or ``hash:<n>`` the
+    lockers mostly change different shards. With ``--shared-clone`` all of the lockers
+    are processes on the same host that share one clone of the lock repo.
+    """
+    root = os.path.join(workdir, 'race-{0}-{1}'.format(mode, n_lockers))
+    pkg_path = os.path.join(root, 'pkg')
+    origin = os.path.join(root, 'origin.git')
+    os.makedirs(root)
+    make_package(pkg_path, args.race_files)
+    make_lock_remote(origin)
+    seed = os.path.join(root, 'seed')
+    clone_lock_repo(origin, seed, pkg_path, args.backend)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        gitlock.utils.create_lockfile(seed, PKG, pkg_path, lockfile_format=args.format,
+                                      shards=args.shards)
+    files = package_files(args.race_files)
+    params = []
+    for n in range(n_lockers):
+        if args.shared_clone:
+            gitpath = seed
+        else:
+            gitpath = os.path.join(root, 'locker{0}'.format(n))
+            clone_lock_repo(origin, gitpath, pkg_path, args.backend)
+        if mode == 'same':
+            targets = files[:args.ops]
+        else:
+            start = n*(len(files)//n_lockers)
+            targets = files[start:start+args.ops]
+        params.append((gitpath, 'user{0}'.format(n), targets))
+
+    start = time.perf_counter()
+    pool = multiprocessing.Pool(n_lockers)
+    try:
+        workers = pool.map(locker, params)
+    finally:
+        pool.close()
+        pool.join()
+    wall = time.perf_counter()-start
+    latencies = sum([w['latencies'] for w in workers], [])
+    result = {
+        'lockers': n_lockers,
+        'mode': mode,
+        'shared_clone': args.shared_clone,
+        'ops': len(latencies),
+        'granted': sum([w['granted'] for w in workers]),
+        'retries': sum([w['retries'] for w in workers]),
+        'rebased': sum([w['rebased'] for w in workers]),
+        'seconds': wall,
+        'throughput': len(latencies)/wall,
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p95': percentile(latencies, 0.95),
+        'latency_max': max(latencies),
+    }
+    print("  {0} lockers ({1} files): {2:.2f} locks/s, p95 {3:.3f}s, {4} retries ({5} rebased)".format(
+        n_lockers, mode, result['throughput'], result['latency_p95'], result['retries'],
+        result['rebased']), file=sys.stderr)
+    if not args.keep:
+        shutil.rmtree(root)
+    return result
+
+def add_history(origin, n_commits):
+    """
+    Add ``n_commits`` lock and unlock commits to the lock branch of ``origin``, using
+    ``git fast-import`` (much faster than running gitlock for each one)
+    """
+    path = 'repos/{0}/locks.txt'.format(PKG)
+    lines = git(origin, 'show', 'master:'+path).split(b'\n')
+    rows = [n for n, line in enumerate(lines) if gitlock.lockfile.parse_row(line) is not None]
+    stream = []
+    for n in range(n_commits):
+        index = rows[(n//2) % len(rows)]
+        filename, user, lock_time = gitlock.lockfile.parse_row(lines[index])
+        user = 'None' if n%2 else 'user{0}'.format(n%10)
+        lines[index] = gitlock.lockfile.format_row(filename, user, lock_time).encode('utf-8')
+        data = b'\n'.join(lines)
+        msg = '{0} {1}'.format('unlock' if n%2 else 'lock', filename).encode('utf-8')
+        stream += [b'commit refs/heads/master',
+                   'committer gitlock-bench <bench@example.com> {0} +0000'.format(n).encode('utf-8'),
+                   'data {0}'.format(len(msg)).encode('utf-8'), msg]
+        if n == 0:
+            stream.append(b'from refs/heads/master^0')
+        stream += ['M 100644 inline {0}'.format(path).encode('utf-8'),
+                   'data {0}'.format(len(data)).encode('utf-8'), data]
+    git(origin, 'fast-import', '--quiet', input=b'\n'.join(stream)+b'\n')
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter()-start
+
+def bench_history(workdir, n_commits, args):
+    """
+    Time fresh clones and the pull of a client that is ``n_commits`` lock operations
+    behind, with full and shallow (depth 1) fetches, before and after compacting the
+    history of the lock repo
+    """
+    root = os.path.join(workdir, 'history{0}'.format(n_commits))
+    pkg_path = os.path.join(root, 'pkg')
+    origin = os.path.join(root, 'origin.git')
+    os.makedirs(root)
+    make_package(pkg_path, args.history_files)
+    make_lock_remote(origin)
+    seed = os.path.join(root, 'seed')
+    clone_lock_repo(origin, seed, pkg_path, 'plumbing')
+    # The clients clone the lock repo before the history is added
+    clients = {}
+    for depth in (0, 1):
+        gitpath = os.path.join(root, 'client{0}'.format(depth))
+        clone_lock_repo(origin, gitpath, pkg_path, 'plumbing')
+        config = gitlock.utils.edit_lock_cfg(PKG, gitpath, pkg_path)
+        config['fetch_depth'] = depth
+        with open(gitlock.utils.get_config_path(gitpath, PKG), 'w') as f:
+            yaml.dump(config, f)
+        clients[depth] = gitpath
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        gitlock.utils.create_lockfile(seed, PKG, pkg_path)
+    add_history(origin, n_commits)
+    url = 'file://'+origin
+
+    def clone(name, *clone_args):
+        path = os.path.join(root, name)
+        seconds = timed(lambda: git(root, 'clone', '-q', '--bare', *(list(clone_args)+[url, path])))
+        shutil.rmtree(path)
+        return seconds
+
+    result = {'commits': n_commits}
+    result['clone_full'] = clone('full')
+    result['clone_shallow'] = clone('shallow', '--depth', '1')
+    result['pull_full'] = timed(lambda: gitlock.lock.Repo(PKG, clients[0]).update_all_locks())
+    result['pull_shallow'] = timed(lambda: gitlock.lock.Repo(PKG, clients[1]).update_all_locks())
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        result['compact'] = timed(lambda: gitlock.utils.compact_lock_repo(seed, PKG))
+    git(origin, 'gc', '-q', '--prune=now')
+    result['clone_full_compacted'] = clone('compacted')
+    print("  {0} commits: clone {1:.3f}s (shallow {2:.3f}s, compacted {3:.3f}s), pull "
+          "{4:.3f}s (shallow {5:.3f}s)".format(n_commits, result['clone_full'], result['clone_shallow'],
+                                              result['clone_full_compacted'], result['pull_full'],
+                                              result['pull_shallow']), file=sys.stderr)
+    if not args.keep:
+        shutil.rmtree(root)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gitlock with synthetic repos")
+    parser.add_argument('--sizes', type=str, default='1000,10000',
+                        help="Comma separated numbers of files in the synthetic packages")
+    parser.add_argument('--backend', type=str, default='worktree', choices=['worktree', 'plumbing'],
+                        help="Lock repo backend (plumbing uses bare clones)")
+    parser.add_argument('--format', type=str, default='dense', choices=['dense', 'sparse'],
+                        help="Lockfile format")
+    parser.add_argument('--shards', type=str, default='none',
+                        help="Lockfile shards, for example 'prefix:3' or 'hash:16' ('none' for "
+                             "a single lockfile)")
+    parser.add_argument('--batch', type=int, default=40,
+                        help="Number of files locked by the batch lock benchmark")
+    parser.add_argument('--changes', type=int, default=10,
+                        help="Number of files added, deleted and renamed before 'update'")
+    parser.add_argument('--lockers', type=str, default='1,4',
+                        help="Comma separated numbers of concurrent lockers (0 to skip)")
+    parser.add_argument('--ops', type=int, default=5,
+                        help="Number of locks taken by each concurrent locker")
+    parser.add_argument('--shared-clone', action='store_true',
+                        help="Run the concurrent lockers on one clone of the lock repo")
+    parser.add_argument('--race-files', type=int, default=1000,
+                        help="Number of files in the package used by the concurrency benchmark")
+    parser.add_argument('--history', type=str, default='',
+                        help="Comma separated numbers of lock operations in the history of the "
+                             "lock repo for the clone and pull benchmark")
+    parser.add_argument('--history-files', type=int, default=1000,
+                        help="Number of files in the package used by the history benchmark")
+    parser.add_argument('--memory', action='store_true',
+                        help="Record the peak Python memory of each operation (slower)")
+    parser.add_argument('--workdir', type=str, default=None,
+                        help="Directory for the generated repos (a temporary directory by default)")
+    parser.add_argument('--keep', action='store_true',
+                        help="Keep the generated repos")
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help="File to write the JSON results to (stdout by default)")
+    args = parser.parse_args()
+
+    os.environ.update(GIT_ENV)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='gitlock-bench-')
+    git_version = git(workdir, '--version').decode('utf-8').strip()
+    results = {
+        'meta': {
+            'date': str(datetime.datetime.now()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'git': git_version,
+            'commit': git(os.path.dirname(os.path.abspath(__file__)), 'rev-parse', 'HEAD').decode('utf-8').strip(),
+            'backend': args.backend,
+            'format': args.format,
+            'shards': args.shards,
+        },
+        'sizes': [],
+        'concurrency': [],
+        'history': [],
+    }
+    for size in [int(s) for s in args.sizes.split(',') if s != '']:
+        results['sizes'].append(bench_size(workdir, size, args))
+    for n_lockers in [int(n) for n in args.lockers.split(',') if n != '']:
+        if n_lockers > 0:
+            print("Concurrency:", file=sys.stderr)
+            for mode in ('different', 'same'):
+                results['concurrency'].append(bench_concurrency(workdir, n_lockers, mode, args))
+    history = [int(n) for n in args.history.split(',') if n != '' and int(n) > 0]
+    if len(history)>0:
+        print("History:", file=sys.stderr)
+    for n_commits in history:
+        results['history'].append(bench_history(workdir, n_commits, args))
+    if args.workdir is None and not args.keep:
+        shutil.rmtree(workdir)
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
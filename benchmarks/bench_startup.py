@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Startup benchmark for the gitlock command line.
+
+Time ``import gitlock.cmd``, ``gitlock --help`` and ``gitlock info`` (with the remote
+unchanged) in fresh interpreters, and check that these do not import GitPython or PyYAML.
+The benchmark fails (with exit code 1) if the import time is over the ``--budget``.
+
+Example:
+
+    python benchmarks/bench_startup.py --budget 0.05 -o startup.json
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import bench_gitlock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'scripts', 'gitlock')
+# Modules that should only be imported by the commands that need them
+HEAVY_MODULES = ['git', 'yaml']
+
+def run_importtime(args, env):
+    """
+    Run a python command with ``-X importtime`` and return the total import time (in
+    seconds) and the names of the imported modules
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + args, env=env,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    modules = {}
+    for line in process.stderr.decode('utf-8').split('\n'):
+        if line.startswith('import time:') and '|' in line:
+            fields = line[len('import time:'):].split('|')
+            if fields[0].strip().isdigit():
+                name = fields[2].strip()
+                modules[name] = int(fields[0])
+    return sum(modules.values())/1e6, modules
+
+def measure(name, args, env, repeat):
+    """
+    Take the median import time of ``repeat`` runs of a command
+    """
+    times = []
+    for n in range(repeat):
+        total, modules = run_importtime(args, env)
+        times.append(total)
+    heavy = sorted(set([module.split('.')[0] for module in modules
+                        if module.split('.')[0] in HEAVY_MODULES]))
+    result = {'name': name, 'import_seconds': sorted(times)[len(times)//2], 'modules': len(modules),
+              'heavy_modules': heavy}
+    print("  {0:<16} {1:8.4f}s  {2} modules{3}".format(
+        name, result['import_seconds'], result['modules'],
+        '' if len(heavy)==0 else ' (imports {0})'.format(', '.join(heavy))), file=sys.stderr)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup time of gitlock")
+    parser.add_argument('--budget', type=float, default=0.05,
+                        help="Maximum time (in seconds) to import gitlock.cmd")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Number of runs of each command")
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help="File to write the JSON results to (stdout by default)")
+    args = parser.parse_args()
+
+    os.environ.update(bench_gitlock.GIT_ENV)
+    workdir = tempfile.mkdtemp(prefix='gitlock-startup-')
+    env = dict(os.environ, PYTHONPATH=ROOT, HOME=workdir)
+    try:
+        # A small lock repo for 'gitlock info'
+        pkg_path = os.path.join(workdir, 'pkg')
+        origin = os.path.join(workdir, 'origin.git')
+        gitpath = os.path.join(workdir, 'locks')
+        bench_gitlock.make_package(pkg_path, 100)
+        bench_gitlock.make_lock_remote(origin)
+        bench_gitlock.clone_lock_repo(origin, gitpath, pkg_path, 'worktree')
+        info = [SCRIPT, 'info', bench_gitlock.PKG, '-g', gitpath, '-t', '3600']
+        subprocess.run([sys.executable, SCRIPT, 'build', bench_gitlock.PKG, '-g', gitpath],
+                       env=env, stdout=subprocess.DEVNULL, check=True)
+        # Fill the caches
+        subprocess.run([sys.executable] + info, env=env, stdout=subprocess.DEVNULL, check=True)
+
+        print("Startup:", file=sys.stderr)
+        results = [
+            measure('import', ['-c', 'import gitlock.cmd'], env, args.repeat),
+            measure('help', [SCRIPT, '--help'], env, args.repeat),
+            measure('info', info, env, args.repeat),
+        ]
+    finally:
+        shutil.rmtree(workdir)
+
+    failures = []
+    if results[0]['import_seconds'] > args.budget:
+        failures.append("importing gitlock.cmd took {0:.4f}s (budget {1}s)".format(
+            results[0]['import_seconds'], args.budget))
+    for result in results:
+        if len(result['heavy_modules'])>0:
+            failures.append("'{0}' imports {1}".format(result['name'], ', '.join(result['heavy_modules'])))
+    output = {'budget': args.budget, 'results': results, 'failures': failures}
+    if args.output is None:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    for failure in failures:
+        print("FAILED: {0}".format(failure), file=sys.stderr)
+    if len(failures)>0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
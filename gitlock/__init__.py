@@ -1,4 +1,12 @@
-from . import utils
-from . import lock
-from . import cmd
-from . import git_io
\ No newline at end of file
+import importlib
+
+__all__ = ['aio', 'utils', 'lock', 'cmd', 'git_io', 'history', 'lockfile', 'metrics', 'multi', 'query', 'server', 'spool']
+
+def __getattr__(name):
+    """
+    Import the submodules when they are first used, so that commands that do not need
+    GitPython (or PyYAML) do not pay for importing them
+    """
+    if name in __all__:
+        return importlib.import_module('.'+name, __name__)
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
@@ -0,0 +1,243 @@
+"""
+Asyncio client for gitlock.
+
+`AsyncRepo` locks, unlocks and queries files from an asyncio service (for example a
+review bot or an editor plugin) without blocking the event loop:
+
+- ``git ls-remote`` and ``git fetch`` run as asyncio subprocesses, which are killed if
+  the caller is cancelled or times out. Concurrent callers (for any package in the same
+  lock repo) share a single check of the remote and a single fetch.
+- Lock and unlock requests are queued, and the requests that arrive within ``window``
+  seconds of each other are applied together in a single commit and push (see
+  `gitlock.lock.Repo.prepare_requests`) in a worker thread.
+
+For example::
+
+    repo = AsyncRepo('afw')
+    report = await repo.lock(['include/lsst/afw/table/io/FitsReader.h'], 'user', timeout=30)
+    locks = await repo.info(older_than='3d')
+"""
+import asyncio
+import logging
+import subprocess
+
+import gitlock.utils as utils
+import gitlock.git_io
+import gitlock.query
+from gitlock.lock import Repo, Report, get_username
+
+logger = logging.getLogger('gitlock.aio')
+
+async def run_git(gitpath, *args):
+    """
+    Run a git command without blocking the event loop and return its output as bytes.
+    The command is killed if the caller is cancelled.
+    """
+    process = await asyncio.create_subprocess_exec('git', '-C', gitpath, *args,
+                                                   stdin=subprocess.DEVNULL,
+                                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        raise gitlock.git_io.GitError("'git {0}' failed: {1}{2}".format(
+            ' '.join(args), stdout.decode('utf-8', 'replace'), stderr.decode('utf-8', 'replace')))
+    return stdout
+
+# Checks of the remote and fetches that are running, by event loop, lock repo and branch
+_in_flight = {}
+
+def shared(key, factory):
+    """
+    Wait for the task that is running for ``key``, or start one with the coroutine
+    function ``factory``. Cancelling one of the callers does not cancel the task for the
+    other callers.
+    """
+    task = _in_flight.get(key)
+    if task is None or task.done():
+        task = asyncio.ensure_future(factory())
+        _in_flight[key] = task
+
+        def done(task):
+            if _in_flight.get(key) is task:
+                del _in_flight[key]
+            if not task.cancelled():
+                # The error is raised in the callers, if any are left
+                task.exception()
+        task.add_done_callback(done)
+    return asyncio.shield(task)
+
+class AsyncRepo(object):
+    """
+    Asyncio client for the locks of a package (see the module documentation)
+    """
+    def __init__(self, pkg, gitpath=None, window=0.05):
+        # Queries and lock changes use separate repos, so that queries can run while
+        # changes are prepared in the worker thread
+        self.reader = Repo(pkg, gitpath)
+        self.writer = Repo(pkg, gitpath)
+        self.pkg = pkg
+        self.gitpath = self.reader.gitpath
+        self.branch = self.reader.branch
+        self.window = window
+        # Default user of the requests, read when it is first needed
+        self.username = None
+        self.pending = []
+        self._worker = None
+
+    def _key(self, name):
+        return (id(asyncio.get_running_loop()), name, utils.get_full_path(self.reader.git_dir),
+                self.branch)
+
+    async def remote_tip(self):
+        """
+        Commit at the tip of the lock branch on the remote (see `gitlock.git_io.remote_tip`)
+        """
+        try:
+            result = await run_git(self.gitpath, 'ls-remote', 'origin', 'refs/heads/{0}'.format(self.branch))
+        except gitlock.git_io.GitError as e:
+            raise gitlock.git_io.GitError("Unable to read the refs from the remote origin:\n{0}".format(e))
+        if result.strip() == b'':
+            raise gitlock.git_io.GitError("Could not find branch {0} on the remote origin".format(self.branch))
+        return result.split()[0].decode('utf-8')
+
+    async def is_fresh(self, ttl=0):
+        """
+        Check whether the last fetched commit is the tip of the remote (see
+        `gitlock.lock.Repo.is_fresh`)
+        """
+        head = self.reader.read_tip()
+        if self.reader.checked_recently(head, ttl):
+            return True
+        tip = await shared(self._key('remote_tip'), self.remote_tip)
+        self.reader.record_remote_tip(tip)
+        return tip == head
+
+    async def fetch(self):
+        """
+        Fetch the lock branch from the remote (see `gitlock.lock.Repo.fetch_locks`) and
+        return the new commit
+        """
+        async def fetch():
+            await run_git(self.gitpath, *gitlock.git_io.fetch_args(self.branch, self.reader.fetch_depth))
+            return self.reader.read_tip()
+        return await shared(self._key('fetch'), fetch)
+
+    async def read_locked(self, ttl=0):
+        """
+        Load the currently locked files (see `gitlock.lock.Repo.read_locked`), only fetching
+        the lock branch if the remote has changed
+        """
+        if not await self.is_fresh(ttl):
+            await self.fetch()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.reader.read_locked, 0, True)
+
+    async def info(self, username=None, ttl=None, timeout=None, **query):
+        """
+        List of the locked files (`gitlock.lockfile.Lock`), optionally only the files
+        locked by ``username`` and the files that match the ``query`` filters (see
+        `gitlock.query.LockIndex.query`). ``ttl`` is the same as for
+        `gitlock.lock.Repo.get_locked_info`.
+        """
+        if ttl is None:
+            ttl = self.reader.config.get('info_ttl', 0)
+
+        async def info():
+            locks = await self.read_locked(ttl)
+            return list(gitlock.query.LockIndex(locks).query(user=username, **query))
+        return await asyncio.wait_for(info(), timeout)
+
+    async def lock(self, filenames, username=None, timeout=None):
+        """
+        Lock one or more files (see `gitlock.lock.Repo.lock`) and return the report
+        """
+        reports = await self.batch([('lock', filenames, username)], timeout)
+        return reports[0]
+
+    async def unlock(self, filenames, username=None, timeout=None):
+        """
+        Unlock one or more files (see `gitlock.lock.Repo.unlock`) and return the report
+        """
+        reports = await self.batch([('unlock', filenames, username)], timeout)
+        return reports[0]
+
+    async def batch(self, requests, timeout=None):
+        """
+        Apply several lock and unlock requests, given as ``(action, filenames, username)``
+        tuples, in the same commit and return their reports. Each request is applied
+        all-or-nothing on its own.
+
+        If the call is cancelled (or times out) before the requests are prepared they
+        are not applied. Requests that are already being committed and pushed are still
+        applied.
+        """
+        loop = asyncio.get_running_loop()
+        if self.username is None and any([username is None for action, filenames, username in requests]):
+            # The default user is read with git, so only once and not in the event loop
+            self.username = await loop.run_in_executor(None, get_username, None)
+        requests = [(action, [filenames] if isinstance(filenames, str) else list(filenames),
+                     username or self.username) for action, filenames, username in requests]
+        future = loop.create_future()
+        self.pending.append((requests, future))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._work())
+        return await asyncio.wait_for(future, timeout)
+
+    async def _work(self):
+        """
+        Apply the queued requests, collecting the requests that arrive within ``window``
+        seconds into a group commit
+        """
+        loop = asyncio.get_running_loop()
+        while len(self.pending)>0:
+            await asyncio.sleep(self.window)
+            batch, self.pending = self.pending, []
+            batch = [(requests, future) for requests, future in batch if not future.done()]
+            if len(batch)==0:
+                continue
+            try:
+                results = await loop.run_in_executor(None, self._apply, batch)
+            except Exception as e:
+                logger.exception("Error applying {0} lock requests".format(len(batch)))
+                for requests, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (requests, future), reports in zip(batch, results):
+                if reports is not None and not future.done():
+                    future.set_result(reports)
+
+    def _apply(self, batch):
+        """
+        Apply a batch of requests in a single transaction (in a worker thread). Returns
+        the reports for each call of `batch`, or None if it was cancelled.
+        """
+        results = [None]*len(batch)
+
+        def prepare():
+            active = [n for n, (requests, future) in enumerate(batch) if not future.cancelled()]
+            reports, changes, commit_msg = self.writer.prepare_requests(
+                [request for n in active for request in batch[n][0]])
+            results[:] = [None]*len(batch)
+            for n in active:
+                count = len(batch[n][0])
+                results[n], reports = reports[:count], reports[count:]
+            report = Report()
+            report.success = True
+            return report, changes, commit_msg
+
+        # The lockfile of the last batch is reused without a pull only if no other process
+        # committed to the lock repo since then (see `gitlock.lock.Repo.transact`)
+        self.writer.transact(prepare, optimistic=True)
+        return results
+
+    async def close(self):
+        """
+        Wait until the queued requests have been applied
+        """
+        if self._worker is not None:
+            await self._worker
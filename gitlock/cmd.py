@@ -1,40 +1,253 @@
 import os
+import sys
 import logging
 import argparse
+from collections import OrderedDict
 
+# Only light modules are imported here, the modules that need GitPython are imported
+# by the commands that use them so that the command line starts quickly
 import gitlock.utils as utils
-import gitlock.lock
+import gitlock.metrics as metrics
 
 logger = logging.getLogger('gitlock')
 
+def get_filenames(args, pkg_path=None):
+    """
+    Get the list of filenames (or glob patterns) passed with ``-f`` and ``--filelist``,
+    relative to the package path (or as absolute paths if ``pkg_path`` is None)
+    """
+    filenames = []
+    if args.filename is not None:
+        filenames += args.filename
+    if args.filelist is not None:
+        if args.filelist == '-':
+            lines = sys.stdin.readlines()
+        else:
+            with open(args.filelist, 'r') as f:
+                lines = f.readlines()
+        filenames += [line.strip() for line in lines if line.strip()!='']
+    if len(filenames)==0:
+        raise ValueError("You must specify at least one filename with -f or --filelist")
+    filenames = [os.path.join(os.getcwd(), filename) for filename in filenames]
+    if pkg_path is None:
+        return filenames
+    return [os.path.relpath(filename, pkg_path) for filename in filenames]
+
+def change_locks(args, action):
+    """
+    Lock or unlock a set of files, using the lock server if one is running
+    """
+    import gitlock.lock
+
+    pkgs = utils.get_packages(args.gitpath, args.pkg, args.all)
+    if len(pkgs)!=1:
+        import gitlock.multi
+        multi = gitlock.multi.MultiRepo(pkgs, args.gitpath)
+        reports = multi.change_locks(action, get_filenames(args), args.user)
+        gitlock.multi.display_reports(reports)
+        if not all(reports.values()):
+            sys.exit(1)
+        return
+    args.pkg = pkgs[0]
+    gitpath = utils.get_gitpath(args.gitpath)
+    config = utils.load_lock_cfg(gitpath, args.pkg)
+    filenames = get_filenames(args, config['pkg_path'])
+    username = gitlock.lock.get_username(args.user)
+    report = send_locks(gitpath, args.pkg, action, filenames, username)
+    if not report:
+        sys.exit(1)
+
+def send_locks(gitpath, pkg, action, filenames, username, repo=None):
+    """
+    Lock or unlock files of a package through the lock server if one is running,
+    otherwise with ``repo`` (or a new `gitlock.lock.Repo`), and return the report
+    """
+    import gitlock.lock
+    import gitlock.server
+
+    request = {'op': action, 'pkg': pkg, 'filenames': filenames, 'user': username}
+    response = gitlock.server.send(gitpath, request)
+    if response is None:
+        if repo is None:
+            repo = gitlock.lock.Repo(pkg, gitpath)
+        return getattr(repo, action)(filenames, username)
+    report = gitlock.lock.Report(action, [(filename, (status, msg))
+                                          for filename, status, msg in response['report']])
+    report.success = response['success']
+    report.display()
+    return report
+
 def lock(args):
     """
-    Attempt to lock a file
+    Attempt to lock a set of files
     """
-    utils.check_required(args, ['pkg', 'filename'])
-    repo = gitlock.lock.Repo(args.pkg, args.gitpath)
-    filename = os.path.join(os.getcwd(), args.filename)
-    filename = os.path.relpath(filename, repo.config['pkg_path'])
-    repo.lock(filename, args.user)
+    change_locks(args, 'lock')
 
 def unlock(args):
     """
-    Attempt to unlock a file
+    Attempt to unlock a set of files
     """
-    utils.check_required(args, ['pkg', 'filename'])
-    repo = gitlock.lock.Repo(args.pkg, args.gitpath)
-    filename = os.path.join(os.getcwd(), args.filename)
-    filename = os.path.relpath(filename, repo.config['pkg_path'])
-    repo.unlock(filename, args.user)
+    change_locks(args, 'unlock')
+
+def get_query(args, pkg_path):
+    """
+    Filters for the locks shown by ``info`` (see `gitlock.query.LockIndex.query`)
+    """
+    query = {}
+    if args.filename is not None or args.filelist is not None:
+        query['paths'] = get_filenames(args, pkg_path)
+    for key in ['older_than', 'newer_than', 'limit']:
+        if getattr(args, key) is not None:
+            query[key] = getattr(args, key)
+    if args.offset:
+        query['offset'] = args.offset
+    if args.reverse:
+        query['reverse'] = True
+    return query
 
 def get_info(args):
     """
     Get the information about all of the locked files. If a user is specified, only
     get information about that users locked files
     """
+    import gitlock.lock
+    import gitlock.server
+
+    pkgs = utils.get_packages(args.gitpath, args.pkg, args.all)
+    gitpath = utils.get_gitpath(args.gitpath)
+    output = 'json' if args.json else 'table' if args.table else 'text'
+    if len(pkgs)!=1:
+        import gitlock.multi
+        multi = gitlock.multi.MultiRepo(pkgs, gitpath)
+        ttl = args.ttl if args.ttl is not None else multi.config.get('info_ttl', 0)
+        for pkg, locks in multi.read_locked(ttl).items():
+            query = get_query(args, multi.repos[pkg].config['pkg_path'])
+            if output != 'json':
+                print("{0}:".format(pkg))
+            gitlock.lock.display_locks(locks, args.user, args.sortby, output=output, pkg=pkg, **query)
+        return
+    args.pkg = pkgs[0]
+    query = get_query(args, utils.load_lock_cfg(gitpath, args.pkg)['pkg_path'])
+    response = gitlock.server.send(gitpath, {'op': 'info', 'pkg': args.pkg, 'ttl': args.ttl})
+    if response is None:
+        repo = gitlock.lock.Repo(args.pkg, gitpath)
+        repo.get_locked_info(username=args.user, sortby=args.sortby, display=True, ttl=args.ttl,
+                             output=output, **query)
+    else:
+        locks = OrderedDict([(row[0], gitlock.lock.Lock(None, *row)) for row in response['locks']
+                             if args.user is None or row[1]==args.user])
+        gitlock.lock.display_locks(locks, args.user, args.sortby, output=output, **query)
+
+def check(args):
+    """
+    Check whether any of the files changed in the package are locked by other users
+    (or install a pre-commit hook that runs this check)
+    """
+    import gitlock.lock
+
     utils.check_required(args, ['pkg'])
+    if args.install_hook:
+        utils.install_hook(args.gitpath, args.pkg, args.overwrite, args.user)
+        return
     repo = gitlock.lock.Repo(args.pkg, args.gitpath)
-    repo.get_locked_info(username=args.user, sortby=args.sortby, display=True)
+    report = repo.check(gitlock.lock.get_username(args.user), args.staged, args.ttl)
+    report.display()
+    if not report:
+        sys.exit(1)
+
+def notify(message):
+    """
+    Show a desktop notification (with ``notify-send``), or ring the terminal bell if
+    desktop notifications are not available
+    """
+    import shutil
+    import subprocess
+
+    if shutil.which('notify-send') is not None:
+        subprocess.call(['notify-send', 'gitlock', message])
+    else:
+        sys.stderr.write('\a')
+        sys.stderr.flush()
+
+def watch(args):
+    """
+    Print the changes to the locks of a package as they are pushed, or wait until a set of
+    files is free (and lock them if ``--claim`` is given)
+    """
+    import json
+    import fnmatch
+    import gitlock.lock
+    from gitlock.lockfile import PathTrie
+
+    utils.check_required(args, ['pkg'])
+    repo = gitlock.lock.Repo(args.pkg, args.gitpath)
+    filenames = None
+    if args.filename is not None or args.filelist is not None:
+        filenames = get_filenames(args, repo.config['pkg_path'])
+    until_free = args.until_free or args.claim
+    if until_free:
+        if filenames is None:
+            raise ValueError("You must specify the files to wait for with -f or --filelist")
+        username = gitlock.lock.get_username(args.user)
+
+    def related(path):
+        # Changes to the watched files, to the directories containing them or inside them
+        return any([path == filename or path.startswith(filename+'/') or
+                    filename.startswith(path+'/') or fnmatch.fnmatch(path, filename)
+                    for filename in filenames])
+
+    for locks, events in repo.watch(args.interval):
+        for event in events:
+            if filenames is not None and not related(event['path']):
+                continue
+            if args.json:
+                print(json.dumps(event))
+            else:
+                print(gitlock.lock.describe_event(event))
+            sys.stdout.flush()
+            if args.notify:
+                notify(gitlock.lock.describe_event(event))
+        if until_free:
+            trie = PathTrie(locks.values())
+            if all([len(trie.conflicts(filename, username))==0 for filename in filenames]):
+                if not args.claim:
+                    print("The requested files are not locked by other users")
+                    return
+                report = send_locks(repo.gitpath, args.pkg, 'lock', filenames, username, repo)
+                if report:
+                    return
+                if any([status == 'missing' for status, msg in report.values()]):
+                    sys.exit(1)
+                # Another user locked one of the files first, keep waiting
+
+def history(args):
+    """
+    Show who held the locks on a set of files (or held by a user, or in a range of
+    times), or statistics on how long locks are held
+    """
+    import gitlock.lock
+    import gitlock.history
+
+    utils.check_required(args, ['pkg'])
+    repo = gitlock.lock.Repo(args.pkg, args.gitpath)
+    index = gitlock.history.History(repo)
+    index.update(args.archive, args.ttl if args.ttl is not None else repo.config.get('info_ttl', 0))
+    filters = {'user': args.user, 'since': args.since, 'until': args.until}
+    if args.filename is not None or args.filelist is not None:
+        filters['paths'] = get_filenames(args, repo.config['pkg_path'])
+    if args.stats:
+        gitlock.history.write_stats(index, sys.stdout, args.top, **filters)
+        return
+    holds = index.holds(reverse=args.reverse, limit=args.limit, offset=args.offset, **filters)
+    gitlock.history.write_holds(holds, sys.stdout, 'json' if args.json else 'text')
+
+def serve(args):
+    """
+    Run a lock server that keeps the lock repo in memory and commits requests that
+    arrive at the same time together
+    """
+    import gitlock.server
+    gitlock.server.LockServer(args.gitpath, args.window).run()
 
 def init(args):
     """
@@ -44,7 +257,8 @@ def init(args):
     utils.check_required(args, ['gitpath', 'pkg', 'pkg_path'])
     utils.edit_git_cfg(args.gitpath, args.user)
     utils.edit_lock_cfg(args.pkg, args.gitpath, args.pkg_path, args.user)
-    utils.create_lockfile(args.gitpath, args.pkg, args.pkg_path, args.overwrite, update=False)
+    utils.create_lockfile(args.gitpath, args.pkg, args.pkg_path, args.overwrite, update=False,
+                          lockfile_format=args.format, shards=args.shards)
 
 def cfg(args):
     """
@@ -62,35 +276,72 @@ def gitcfg(args):
 
 def build(args):
     """
-    Build the lockfile
+    Build the lockfile (or the lockfiles of several packages in parallel)
     """
-    utils.check_required(args, ['pkg'])
-    utils.create_lockfile(args.gitpath, args.pkg, args.pkg_path, args.overwrite, update=False)
+    pkgs = utils.get_packages(args.gitpath, args.pkg, args.all)
+    if len(pkgs)!=1:
+        utils.build_lockfiles(args.gitpath, pkgs, args.overwrite, lockfile_format=args.format,
+                              shards=args.shards)
+        return
+    args.pkg = pkgs[0]
+    utils.create_lockfile(args.gitpath, args.pkg, args.pkg_path, args.overwrite, update=False,
+                          lockfile_format=args.format, shards=args.shards)
 
 def update(args):
     """
     Update the lockfile
     """
-    utils.check_required(args, ['pkg'])
+    pkgs = utils.get_packages(args.gitpath, args.pkg, args.all)
+    if len(pkgs)!=1:
+        utils.update_lockfiles(args.gitpath, pkgs)
+        return
+    args.pkg = pkgs[0]
     utils.create_lockfile(args.gitpath, args.pkg, args.pkg_path, overwrite=False, update=True)
 
+def migrate(args):
+    """
+    Convert the lockfile to another format (sparse by default, unless only the shards
+    are changed), keeping the locks
+    """
+    utils.check_required(args, ['pkg'])
+    lockfile_format = args.format
+    if lockfile_format is None and args.shards is None:
+        lockfile_format = 'sparse'
+    utils.migrate_lockfile(args.gitpath, args.pkg, lockfile_format, args.shards)
+
+def compact(args):
+    """
+    Squash the history of the lock repo into a snapshot commit
+    """
+    utils.compact_lock_repo(args.gitpath, args.pkg, args.keep, args.archive)
+
 commands = {
     'lock': lock,
     'unlock': unlock,
     'info': get_info,
+    'check': check,
+    'watch': watch,
+    'history': history,
     'init': init,
     'cfg': cfg,
     'gitcfg': gitcfg,
     'build': build,
-    'update': update
+    'update': update,
+    'migrate': migrate,
+    'compact': compact,
+    'serve': serve
 }
 
 def main():
     parser = argparse.ArgumentParser(description="Commands for locking git files")
     parser.add_argument("command", type=str, 
                         help="Command to run (from {0})".format(list(commands.keys())))
-    parser.add_argument('pkg', type=str,
-                        help="Name of the package")
+    parser.add_argument('pkg', type=str, nargs='?', default=None,
+                        help="Name of the package (or a comma separated list of packages for "
+                             "'lock', 'unlock', 'info', 'build' and 'update')")
+    parser.add_argument('-a', '--all', action='store_true',
+                        help="Use all of the packages in the lock repo (for command='lock', "
+                             "'unlock', 'info', 'build' or 'update')")
     parser.add_argument('-u', '--user', type=str, default=None,
                         help="github ID of the user")
     parser.add_argument('-g', '--gitpath', default=None,
@@ -101,10 +352,71 @@ def main():
                         help="Overwrite an existing lockfile (for command='build')")
     parser.add_argument('-l','--logging', type=str, default='info',
                         help="Logging level")
-    parser.add_argument('-s','--sortby', type=str, default='user',
+    parser.add_argument('-s','--sortby', type=str, default='user', choices=['user', 'path', 'time'],
                         help="Sorting order for displaying gitlock info")
-    parser.add_argument('-f','--filename', type=str, default=None,
-                        help="Filename to lock or unlock")
+    parser.add_argument('-t','--ttl', type=float, default=None,
+                        help="Seconds to trust a previous check of the remote for 'info', 'check' or 'history'")
+    parser.add_argument('-f','--filename', type=str, nargs='+', default=None,
+                        help="Filenames or glob patterns to lock or unlock (or to show for 'info', 'watch' and 'history')")
+    parser.add_argument('-F','--filelist', type=str, default=None,
+                        help="File with a list of filenames to lock or unlock ('-' for stdin)")
+    parser.add_argument('-w','--window', type=float, default=0.05,
+                        help="Seconds to collect requests for a group commit (for command='serve')")
+    parser.add_argument('--format', type=str, default=None, choices=['dense', 'sparse'],
+                        help="Lockfile format: a row for every file (dense) or only for locked "
+                             "files (sparse) (for command='init', 'build' or 'migrate')")
+    parser.add_argument('--shards', type=str, default=None,
+                        help="Split the lockfile into shards by directory ('prefix:<levels>') or "
+                             "by a hash of the path ('hash:<number>'), or 'none' for a single "
+                             "lockfile (for command='init', 'build' or 'migrate')")
+    parser.add_argument('--staged', action='store_true',
+                        help="Only check the staged files (for command='check')")
+    parser.add_argument('--install-hook', action='store_true',
+                        help="Install a pre-commit hook that runs 'gitlock check' in the package "
+                             "repo (for command='check')")
+    parser.add_argument('-i', '--interval', type=float, default=5.0,
+                        help="Seconds between polls of the remote (for command='watch')")
+    parser.add_argument('--until-free', action='store_true',
+                        help="Wait until the files are not locked by other users (for command='watch')")
+    parser.add_argument('--claim', action='store_true',
+                        help="Lock the files as soon as they are free (for command='watch')")
+    parser.add_argument('--json', action='store_true',
+                        help="Print the locks or changes as JSON lines (for command='info', 'watch' or 'history')")
+    parser.add_argument('--table', action='store_true',
+                        help="Print the locks as a table (for command='info')")
+    parser.add_argument('--older-than', type=str, default=None,
+                        help="Only show locks older than an age like 90 (seconds), 30m, 12h or 3d "
+                             "(for command='info')")
+    parser.add_argument('--newer-than', type=str, default=None,
+                        help="Only show locks newer than an age (for command='info')")
+    parser.add_argument('--limit', type=int, default=None,
+                        help="Maximum number of locks to show (for command='info' or 'history')")
+    parser.add_argument('--offset', type=int, default=0,
+                        help="Number of locks to skip, to show the next page (for command='info' or 'history')")
+    parser.add_argument('--reverse', action='store_true',
+                        help="Reverse the sorting order (for command='info' or 'history')")
+    parser.add_argument('--notify', action='store_true',
+                        help="Show a desktop notification for each change (for command='watch')")
+    parser.add_argument('--keep', type=int, default=0,
+                        help="Number of recent commits to keep (for command='compact')")
+    parser.add_argument('--archive', type=str, default=None,
+                        help="Branch to keep the old history on (for command='compact'), or to read it "
+                             "from (for command='history')")
+    parser.add_argument('--since', type=str, default=None,
+                        help="Only show locks held after a date (like 2026-09-01) or an age like "
+                             "3d (for command='history')")
+    parser.add_argument('--until', type=str, default=None,
+                        help="Only show locks held before a date or an age (for command='history')")
+    parser.add_argument('--stats', action='store_true',
+                        help="Show the hold times of each user and the most contended files "
+                             "(for command='history')")
+    parser.add_argument('--top', type=int, default=10,
+                        help="Number of most contended files to show (for command='history')")
+    parser.add_argument('--profile', action='store_true',
+                        help="Print the time spent in each phase of the command")
+    parser.add_argument('--metrics', type=str, default=os.environ.get('GITLOCK_METRICS'),
+                        help="Send metrics as JSON lines to a file ('-' for stderr) or to a "
+                             "sink function ('module:function')")
     #parser.add_argument('','', type=str, default=None,
     #                    help="")
     args = parser.parse_args()
@@ -119,4 +431,12 @@ def main():
     # Execute the command
     if args.command not in commands:
         raise ValueError("Valid commands are {0}".format(commands.keys()))
-    commands[args.command](args)
\ No newline at end of file
+    if args.metrics is not None:
+        metrics.add_sink(metrics.load_sink(args.metrics))
+    try:
+        with metrics.phase(args.command, pkg=args.pkg):
+            commands[args.command](args)
+    finally:
+        if args.profile:
+            metrics.display()
+        metrics.close()
\ No newline at end of file
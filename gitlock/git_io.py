@@ -1,75 +1,626 @@
-import git
+import os
+import time
+import atexit
+import random
+import threading
+import subprocess
 import logging
-from git.remote import FetchInfo
-from git.remote import PushInfo
+
+import gitlock.metrics as metrics
 
 logger = logging.getLogger('gitlock.git_io')
 
 class GitError(Exception):
     pass
 
-def pull(repo):
+class PushRejected(GitError):
+    """
+    The remote rejected a push because another client pushed first
+    """
+    pass
+
+def backoff_delay(attempt, base=0.1, cap=5.0):
+    """
+    Time to wait (in seconds) before retry number ``attempt``, using exponential
+    backoff with full jitter so that competing clients do not retry in lockstep
+    """
+    return random.uniform(0, min(cap, base*2**attempt))
+
+def is_ref_race(summary):
+    """
+    Whether a remote rejection was caused by another client updating the ref at the
+    same time (as opposed to, for example, a permission error)
+    """
+    return any([msg in summary for msg in ('failed to update ref', 'cannot lock ref')])
+
+def retry_ref_race(func, attempts=4):
     """
-    Attempt to pull changes from the remote master
+    Call ``func``, and call it again after a short backoff if it failed because another
+    process on the host (for example a query fetching the lock branch) was updating the
+    same local ref
     """
-    origin = repo.remote('origin')
-    pull_result = origin.pull()[0]
+    for attempt in range(attempts):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == attempts-1 or not is_ref_race(str(e)):
+                raise
+            logger.info("Another process is updating the refs of the lock repo, retrying")
+            time.sleep(backoff_delay(attempt, 0.05, 1.0))
 
-    if pull_result.flags&FetchInfo.ERROR:
-        print("There was an unknown error pulling from the remote. "
-              "This is likely an unexpected merge conflict. "
-              "Entering ipython console for debugging purposes")
-        import IPython; IPython.embed()
-        raise GitError("There was an error pulling the data from the remote origin")
+def remote_tip(gitpath, branch):
+    """
+    Get the commit at the tip of a branch on the remote, using only the ref advertisement
+    (without fetching any objects)
+    """
+    try:
+        with metrics.phase('remote_check'):
+            result = run(gitpath, 'ls-remote', 'origin', 'refs/heads/{0}'.format(branch)).decode('utf-8')
+    except GitError as e:
+        raise GitError("Unable to read the refs from the remote origin:\n{0}".format(e))
+    if result.strip() == '':
+        raise GitError("Could not find branch {0} on the remote origin".format(branch))
+    return result.split()[0]
 
-    if pull_result.flags&FetchInfo.HEAD_UPTODATE:
-        logger.info("Lock file is already up to date\n")
-    elif pull_result.flags&FetchInfo.FAST_FORWARD:
-        logger.info("Updates pulled from remote")
-    else:
-        print("There was an unknown flag while pulling from the remote")
-        import IPython; IPython.embed()
+def pull(repo, depth=None, branch=None):
+    """
+    Attempt to pull changes to ``branch`` (by default the branch that is checked out)
+    from the remote into the branch that is checked out.
+
+    If ``depth`` is given only that many commits of the branch are fetched (a shallow
+    fetch), so the time to pull does not grow with the history of the lock repo. The
+    fetched history may not reach the local commit, so instead of merging, the local
+    branch is reset to the remote branch. It is also reset if the history of the remote
+    branch was rewritten (see `compact_history`). Local commits that were not pushed are
+    never dropped: the pull fails instead if the remote moved as well. Uncommitted
+    changes in the lock repo (for example to a package configuration) are kept, and the
+    pull fails instead of discarding them if the remote changed the same files.
+    """
+    import git
+
+    if branch is None:
+        branch = repo.active_branch.name
+    ref = remote_ref(branch)
+    args = ['--quiet', 'origin', '+refs/heads/{0}:{1}'.format(branch, ref)]
+    if depth is not None:
+        args = ['--depth={0}'.format(depth)] + args
+    try:
+        with metrics.phase('pull'):
+            fetched = read_ref(repo.git_dir, ref)
+            retry_ref_race(lambda: repo.git.fetch(*args))
+            tip = read_ref(repo.git_dir, ref)
+            head = read_ref(repo.git_dir, 'HEAD')
+            if tip == head:
+                logger.info("Lock file is already up to date\n")
+            elif depth is not None:
+                if repo.is_ancestor(tip, head):
+                    logger.info("The local lock repo is ahead of the remote")
+                elif fetched is not None and head != fetched and repo.is_ancestor(fetched, head):
+                    raise GitError("The lock repo at {0} has local commits that were not pushed, "
+                                   "push or reset them before pulling".format(repo.working_tree_dir))
+                else:
+                    reset_keep(repo, tip)
+                    logger.info("Updates pulled from remote")
+            elif repo.is_ancestor(head, tip):
+                repo.git.merge('--ff-only', '--quiet', tip)
+                logger.info("Updates pulled from remote")
+            elif repo.is_ancestor(tip, head):
+                logger.info("The local lock repo is ahead of the remote")
+            elif len(repo.merge_base(head, tip))==0:
+                logger.info("The history of the remote was rewritten, resetting to {0}".format(tip))
+                reset_keep(repo, tip)
+            else:
+                repo.git.merge('--no-edit', '--quiet', tip)
+                logger.info("Updates merged from remote")
+    except git.GitCommandError as e:
+        raise GitError("There was an error pulling the data from the remote origin, "
+                       "this is likely an unexpected merge conflict:\n{0}".format(e))
     return True
 
-def update_remote(commit_msg, lockfile_path, repo=None, repo_path=None):
+def reset_keep(repo, commit):
     """
-    Attempt to commit a lock and push it to the remote master. If this fails, rewind to the
-    lockfile before the commit.
+    Move the branch of a GitPython repo, and the files in its working tree, to
+    ``commit``, keeping uncommitted changes to files that are the same in both commits.
+    Raises a `GitError` if a file with uncommitted changes would have to be overwritten.
     """
+    import git
+
+    try:
+        # A lockfile that was rewritten with the content it already had in the index is
+        # not a change, but reset --keep only looks at the stat data
+        repo.git.update_index('-q', '--refresh')
+        repo.git.reset('--keep', '--quiet', commit)
+    except git.GitCommandError as e:
+        raise GitError("The lock repo at {0} has uncommitted changes to files that changed "
+                       "on the remote, commit or discard them first:\n{1}".format(
+                       repo.working_tree_dir, e.stderr.strip()))
+
+def update_remote(commit_msg, lockfile_path, repo=None, repo_path=None, rewind=True, branch=None):
+    """
+    Attempt to commit a lock and push it to ``branch`` on the remote (by default the
+    upstream of the branch that is checked out). If this fails, rewind to the lockfile
+    before the commit. ``lockfile_path`` can also be a list of lockfiles (or
+    shards) to commit, including removed files. If ``rewind`` is False a commit that was
+    rejected because another client pushed first is left checked out, for a caller that
+    resets the lock repo to the new remote tip anyway (see `gitlock.lock.Repo.reset_to_remote`).
+
+    Returns None if the push was successful, a `PushRejected` error if another client
+    pushed to the remote first, or a `GitError` for any other failure.
+    """
+    import git
+    from git.remote import PushInfo
+
     if repo is None:
         if repo_path is None:
             return GitError("Either a repo or path to a repo is required")
-        repo = git.Repo(path)
+        repo = git.Repo(repo_path)
 
+    paths = [lockfile_path] if isinstance(lockfile_path, str) else list(lockfile_path)
     try:
         # Stage the lockfile
-        repo.git.add(lockfile_path)
+        repo.git.add('--all', '--', *paths)
     except:
         return GitError("Error staging lockfile")
     try:
         # Commit changes to the lockfile
-        repo.index.commit(commit_msg)
+        with metrics.phase('commit'):
+            repo.index.commit(commit_msg)
     except:
         # If an error occured before a commit was made, make sure to reset the lockfile
-        repo.git.reset(lockfile_path)
+        repo.git.reset('--', *paths)
         return GitError("Error commiting lockfile to local repo")
 
+    error = None
     try:
         # Attempt to push the changes to the remote
         origin = repo.remote('origin')
-        push_result = origin.push()[0]
-        
-        if push_result.flags&PushInfo.ERROR:
-            logger.error("Push flags: {0}".push_result.flags)
-            raise GitError('Unknown Error in push')
+        with metrics.phase('push'):
+            refspec = [] if branch is None else ['HEAD:refs/heads/{0}'.format(branch)]
+            push_result = origin.push(*refspec)[0]
+        if (push_result.flags&PushInfo.REJECTED or
+                (push_result.flags&PushInfo.REMOTE_REJECTED and is_ref_race(push_result.summary))):
+            error = PushRejected("The remote rejected the push: {0}".format(
+                                 push_result.summary.strip()))
+        elif push_result.flags&(PushInfo.ERROR|PushInfo.REMOTE_REJECTED|PushInfo.REMOTE_FAILURE):
+            error = GitError("Error pushing to the remote (push flags: {0}): {1}".format(
+                             push_result.flags, push_result.summary))
         elif push_result.flags&PushInfo.FAST_FORWARD:
             logger.info("Push successful")
         else:
-            print("Not sure what happened during push, don't forget to set success=True if it is")
-            print('Push flags: {0}'.push_result.flags)
-    except:
-        print('error in push!!!')
-        import IPython; IPython.embed()
+            logger.warning("Unexpected push flags: {0}".format(push_result.flags))
+    except (git.GitCommandError, IndexError) as e:
+        error = GitError("Error pushing to the remote: {0}".format(e))
+
+    if error is not None and (rewind or not isinstance(error, PushRejected)):
         # Rewind the last commit
-        repo.git.reset('--hard', 'HEAD~1')
-    return None
\ No newline at end of file
+        repo.git.reset('--keep', 'HEAD~1')
+    return error
+
+# Commands that transfer data to or from the remote over their own connection, so the
+# output that is piped back says nothing about the number of bytes that were transferred
+REMOTE_COMMANDS = ('fetch', 'push', 'pull', 'clone', 'ls-remote')
+
+def run(gitpath, *args, **kwargs):
+    """
+    Run a git command in the repo at ``gitpath`` and return its output as bytes.
+    ``input`` (bytes) is passed to the standard input of the command and ``env`` (a
+    dict) is added to its environment. The metrics record the bytes piped to and from
+    the command, except for the `REMOTE_COMMANDS`.
+    """
+    env = None
+    if kwargs.get('env') is not None:
+        env = dict(os.environ, **kwargs['env'])
+    with metrics.phase('git '+args[0]) as record:
+        process = subprocess.Popen(['git', '-C', gitpath] + list(args), stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        stdout, stderr = process.communicate(kwargs.get('input'))
+        if args[0] not in REMOTE_COMMANDS:
+            record['bytes'] = len(kwargs.get('input') or b'')+len(stdout)
+    if process.returncode != 0:
+        raise GitError("'git {0}' failed: {1}{2}".format(' '.join(args), stdout.decode('utf-8', 'replace'),
+                                                        stderr.decode('utf-8', 'replace')))
+    return stdout
+
+def current_branch(git_dir):
+    """
+    Name of the branch checked out in a repo, read directly from its HEAD
+    """
+    with open(os.path.join(git_dir, 'HEAD'), 'r') as f:
+        head = f.read().strip()
+    if not head.startswith('ref: refs/heads/'):
+        raise GitError("The lock repo at {0} is not on a branch".format(git_dir))
+    return head[len('ref: refs/heads/'):]
+
+def read_ref(git_dir, ref):
+    """
+    Get the commit that a ref (for example ``HEAD``) points to, reading the loose or
+    packed refs in the git directory without running git. Return None if the ref does
+    not exist.
+    """
+    if (os.path.isdir(os.path.join(git_dir, 'reftable')) or
+            os.path.isfile(os.path.join(git_dir, 'commondir'))):
+        # Refs that are not stored as plain files (or are shared with another worktree)
+        try:
+            return run(git_dir, 'rev-parse', '--verify', '-q', ref+'^{commit}').decode('utf-8').strip()
+        except GitError:
+            return None
+    path = os.path.join(git_dir, ref)
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            value = f.read().strip()
+        if value.startswith('ref: '):
+            return read_ref(git_dir, value[len('ref: '):])
+        return value
+    packed_path = os.path.join(git_dir, 'packed-refs')
+    if os.path.isfile(packed_path):
+        with open(packed_path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields)==2 and fields[1]==ref:
+                    return fields[0]
+    return None
+
+def remote_ref(branch):
+    """
+    Name of the local ref that tracks a branch on the remote
+    """
+    return 'refs/remotes/origin/{0}'.format(branch)
+
+def fetch(gitpath, branch, depth=None):
+    """
+    Fetch a branch from the remote into its remote tracking ref, without touching the
+    working tree, and return the commit at the tip of the branch. If ``depth`` is given
+    only that many commits of the branch are fetched.
+    """
+    with metrics.phase('fetch'):
+        retry_ref_race(lambda: run(gitpath, *fetch_args(branch, depth)))
+    return run(gitpath, 'rev-parse', remote_ref(branch)).decode('utf-8').strip()
+
+def fetch_args(branch, depth=None):
+    """
+    Arguments of the git command that fetches a branch into its remote tracking ref
+    """
+    args = ['fetch', '--quiet', 'origin', '+refs/heads/{0}:{1}'.format(branch, remote_ref(branch))]
+    if depth is not None:
+        args.insert(1, '--depth={0}'.format(depth))
+    return args
+
+def fetch_history(gitpath, branches, known=None):
+    """
+    Fetch the history of some branches from the remote into their remote tracking refs,
+    including the commits that a shallow `fetch` left out.
+
+    If ``known`` is a commit whose history is already in the repo (for example the last
+    commit that was indexed), only the commits after it are needed: a shallow repo is
+    deepened a few commits at a time until none of the commits after ``known`` are cut
+    off by the shallow boundary, instead of fetching the whole history again.
+    """
+    refspecs = ['origin'] + ['+refs/heads/{0}:{1}'.format(branch, remote_ref(branch)) for branch in branches]
+    with metrics.phase('fetch'):
+        if run(gitpath, 'rev-parse', '--is-shallow-repository').strip() != b'true':
+            retry_ref_race(lambda: run(gitpath, 'fetch', '--quiet', *refspecs))
+            return
+        if known is not None:
+            retry_ref_race(lambda: run(gitpath, 'fetch', '--quiet', *refspecs))
+            for depth in (16, 256, 4096):
+                if len(shallow_commits(gitpath, branches, known))==0:
+                    return
+                retry_ref_race(lambda: run(gitpath, 'fetch', '--quiet', '--deepen={0}'.format(depth), *refspecs))
+            if len(shallow_commits(gitpath, branches, known))==0:
+                return
+        retry_ref_race(lambda: run(gitpath, 'fetch', '--quiet', '--unshallow', *refspecs))
+
+def shallow_commits(gitpath, branches, known):
+    """
+    Commits of the remote tracking refs of ``branches`` after the commit ``known``
+    whose parents are missing because the repo is shallow
+    """
+    path = run(gitpath, 'rev-parse', '--git-path', 'shallow').decode('utf-8').strip()
+    path = os.path.join(gitpath, path)
+    if not os.path.isfile(path):
+        return set()
+    with open(path, 'r') as f:
+        shallow = set(f.read().split())
+    revs = [remote_ref(branch) for branch in branches]
+    commits = run(gitpath, 'rev-list', *revs + ['^'+known]).decode('utf-8').split()
+    return shallow.intersection(commits)
+
+def iter_lines(gitpath, *args, **kwargs):
+    """
+    Run a git command and generate the lines of its output (as bytes) as they are
+    written, for commands like ``git log`` whose output can be too large to keep in memory.
+    With ``sep=b'\\0'`` the output is split on NUL characters instead (for the ``-z``
+    option of git commands) and the separators are not included.
+    """
+    sep = kwargs.get('sep', b'\n')
+    process = subprocess.Popen(['git', '-C', gitpath] + list(args), stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    finished = False
+    try:
+        if sep == b'\n':
+            for line in process.stdout:
+                yield line
+        else:
+            rest = b''
+            for chunk in iter(lambda: process.stdout.read(65536), b''):
+                records = (rest+chunk).split(sep)
+                rest = records.pop()
+                for record in records:
+                    yield record
+            if rest != b'':
+                yield rest
+        finished = True
+    finally:
+        if not finished:
+            # The caller stopped reading early
+            process.kill()
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise GitError("'git {0}' failed: {1}".format(' '.join(args), stderr.decode('utf-8', 'replace')))
+
+def iter_tree(gitpath, commit):
+    """
+    Generate the paths of every file and directory in a commit of a repo, streamed from
+    ``git ls-tree`` so that the tree is never held in memory
+    """
+    for path in iter_lines(gitpath, 'ls-tree', '-r', '-t', '-z', '--name-only', commit, sep=b'\0'):
+        yield path.decode('utf-8')
+
+class BatchReader(object):
+    """
+    Long-lived ``git cat-file --batch`` process that reads objects from a repo.
+
+    Reading a file is a single request to the running process instead of starting a git
+    command, so one reader can be shared by every lookup (and every package) in the
+    same lock repo, see `batch_reader`. Objects that are fetched after the process was
+    started are also found.
+    """
+    def __init__(self, gitpath):
+        self.gitpath = gitpath
+        self.process = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.process = subprocess.Popen(['git', '-C', self.gitpath, 'cat-file', '--batch'],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def read(self, name):
+        """
+        Read an object (for example ``<commit>:<path>``), returning its type and contents
+        """
+        with self.lock, metrics.phase('git cat-file --batch') as record:
+            if self.process is None or self.process.poll() is not None:
+                self.start()
+            try:
+                self.process.stdin.write(name.encode('utf-8')+b'\n')
+                self.process.stdin.flush()
+                header = self.process.stdout.readline()
+            except (IOError, OSError) as e:
+                self.close()
+                raise GitError("Unable to read {0}: {1}".format(name, e))
+            fields = header.split()
+            if len(fields)!=3 or not fields[2].isdigit():
+                if header == b'':
+                    # The process died, it is restarted for the next read
+                    self.close()
+                raise GitError("Could not read {0} from {1}: {2}".format(
+                               name, self.gitpath, header.decode('utf-8', 'replace').strip()))
+            size = int(fields[2])
+            data = self.process.stdout.read(size)
+            self.process.stdout.read(1)
+            record['bytes'] = size
+        return fields[1].decode('utf-8'), data
+
+    def close(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except (IOError, OSError):
+                pass
+            self.process.wait()
+            self.process.stdout.close()
+            self.process = None
+
+# Readers shared by all of the repos opened in this process, by git directory
+_readers = {}
+_readers_lock = threading.Lock()
+
+def batch_reader(gitpath):
+    """
+    The `BatchReader` for a repo, started when it is first needed
+    """
+    key = os.path.realpath(gitpath)
+    with _readers_lock:
+        if key not in _readers:
+            if len(_readers)==0:
+                atexit.register(close_readers)
+            _readers[key] = BatchReader(gitpath)
+        return _readers[key]
+
+def close_readers():
+    with _readers_lock:
+        for reader in _readers.values():
+            reader.close()
+        _readers.clear()
+
+def read_blob(gitpath, commit, path):
+    """
+    Read the contents of a file in a commit (using the shared `batch_reader`)
+    """
+    name = '{0}:{1}'.format(commit, path)
+    obj_type, data = batch_reader(gitpath).read(name)
+    if obj_type != 'blob':
+        raise GitError("{0} is a {1}, not a file".format(name, obj_type))
+    return data
+
+def changed_paths(gitpath, old, new, paths):
+    """
+    List which of ``paths`` changed between two commits
+    """
+    if len(paths)==0:
+        return []
+    changed = run(gitpath, 'diff', '--name-only', '-z', old, new, '--', *paths)
+    return [path.decode('utf-8') for path in changed.split(b'\0') if path != b'']
+
+def changed_files(gitpath, staged=False):
+    """
+    List the files that are modified or staged in the working tree of a repo (or only
+    the ``staged`` files), with a single ``git status``. Untracked files are not listed
+    and a renamed file is listed as both its old and its new name.
+    """
+    status = run(gitpath, 'status', '--porcelain', '-z', '--untracked-files=no', '--no-renames')
+    files = []
+    for entry in status.split(b'\0'):
+        if entry == b'' or (staged and entry[:1] in b' ?'):
+            continue
+        files.append(entry[3:].decode('utf-8'))
+    return files
+
+def write_tree(gitpath, tree, files):
+    """
+    Create a new tree from ``tree`` (or an empty tree if ``tree`` is None) with the
+    files in ``files`` replaced. ``files`` maps paths to the ids of the new blobs,
+    or None to remove a file. Return the id of the new tree.
+    """
+    entries = {}
+    if tree is not None:
+        for entry in run(gitpath, 'ls-tree', '-z', tree).split(b'\0'):
+            if entry != b'':
+                info, name = entry.split(b'\t', 1)
+                entries[name.decode('utf-8')] = info.decode('utf-8').split()
+    subtrees = {}
+    for path, blob in files.items():
+        if '/' in path:
+            subdir, subpath = path.split('/', 1)
+            subtrees.setdefault(subdir, {})[subpath] = blob
+        elif blob is None:
+            entries.pop(path, None)
+        else:
+            entries[path] = ['100644', 'blob', blob]
+    for subdir, subfiles in subtrees.items():
+        subtree = entries[subdir][2] if subdir in entries else None
+        entries[subdir] = ['040000', 'tree', write_tree(gitpath, subtree, subfiles)]
+    mktree = b''.join(['{0} {1} {2}\t{3}\0'.format(mode, obj_type, sha, name).encode('utf-8')
+                       for name, (mode, obj_type, sha) in entries.items()])
+    return run(gitpath, 'mktree', '-z', input=mktree).decode('utf-8').strip()
+
+def commit_files(gitpath, parent, files, commit_msg):
+    """
+    Create a commit on top of ``parent`` with the contents of a set of files changed,
+    directly from git objects (without using the index or working tree).
+    ``files`` maps paths to their new contents (bytes), or None to remove a file.
+    Return the id of the new commit.
+    """
+    with metrics.phase('commit'):
+        blobs = {}
+        for path, data in files.items():
+            if data is None:
+                blobs[path] = None
+            else:
+                blobs[path] = run(gitpath, 'hash-object', '-w', '--stdin', input=data).decode('utf-8').strip()
+        return commit_blobs(gitpath, parent, blobs, commit_msg)
+
+def hash_files(gitpath, paths):
+    """
+    Store files from disk (for example large lockfiles) as blobs in the repo with a
+    single ``git hash-object`` and return their ids
+    """
+    if len(paths)==0:
+        return []
+    ids = run(gitpath, 'hash-object', '-w', '--no-filters', '--stdin-paths',
+              input=''.join([os.path.abspath(path)+'\n' for path in paths]).encode('utf-8'))
+    return ids.decode('utf-8').split()
+
+def commit_blobs(gitpath, parent, blobs, commit_msg):
+    """
+    Create a commit on top of ``parent`` with a set of files replaced by blobs that are
+    already in the repo. ``blobs`` maps paths to the ids of the blobs, or None to remove
+    a file. Return the id of the new commit.
+    """
+    tree = write_tree(gitpath, '{0}^{{tree}}'.format(parent), blobs)
+    return run(gitpath, 'commit-tree', tree, '-p', parent,
+               input=commit_msg.encode('utf-8')).decode('utf-8').strip()
+
+def push_commit(gitpath, commit, branch, expected):
+    """
+    Push a commit to a branch on the remote, only if the branch on the remote is still at
+    the ``expected`` commit (compare-and-swap). Raise `PushRejected` if the branch has moved.
+    """
+    push_refs(gitpath, [(commit, branch, expected)])
+    # Record the new tip of the remote branch
+    run(gitpath, 'update-ref', remote_ref(branch), commit, expected)
+    logger.info("Push successful")
+
+def push_refs(gitpath, updates):
+    """
+    Push a list of ``(commit, branch, expected)`` updates to the remote, each one only if
+    the branch on the remote is still at the ``expected`` commit (or does not exist, if
+    ``expected`` is None). Several updates are pushed atomically: either all of the
+    branches are updated or none of them. Raise `PushRejected` if any branch has moved.
+    """
+    args = ['push', '--porcelain']
+    if len(updates)>1:
+        args.append('--atomic')
+    for commit, branch, expected in updates:
+        args.append('--force-with-lease=refs/heads/{0}:{1}'.format(branch, expected or ''))
+    args.append('origin')
+    for commit, branch, expected in updates:
+        args.append('{0}:refs/heads/{1}'.format(commit, branch))
+    try:
+        with metrics.phase('push'):
+            run(gitpath, *args)
+    except GitError as e:
+        if any([msg in str(e) for msg in ('stale info', 'fetch first', 'non-fast-forward')]) or is_ref_race(str(e)):
+            raise PushRejected("The remote rejected the push: {0}".format(e))
+        raise
+
+def compact_history(gitpath, branch, keep=0, archive=None):
+    """
+    Replace the history of a branch on the remote with a snapshot commit of the branch
+    ``keep`` commits ago, followed by copies of the last ``keep`` commits, so that
+    fetching or cloning the branch no longer depends on the number of lock operations
+    that were made. The snapshot has no parent, so the old commits are no longer
+    reachable from the branch.
+
+    If ``archive`` is the name of a branch the old history is kept on it for auditing:
+    the first compaction creates it at the old tip, later ones add a merge of the
+    previous archive and the old tip. Both branches are pushed atomically and only if
+    neither has moved since they were fetched (raise `PushRejected` otherwise).
+
+    Return the old and the new tip of the branch (the same commit if there was nothing
+    to compact).
+    """
+    old = fetch(gitpath, branch, keep+1)
+    commits = run(gitpath, 'rev-list', '--first-parent', '--max-count={0}'.format(keep+1),
+                  old).decode('utf-8').split()
+    base = commits[-1]
+    # The parents are read from the commit itself, since a shallow fetch hides them
+    if len(commits) <= keep or b'\nparent ' not in run(gitpath, 'cat-file', 'commit', base):
+        # The branch is already no longer than the snapshot and the kept commits
+        return old, old
+    with metrics.phase('commit'):
+        new = run(gitpath, 'commit-tree', base+'^{tree}', input="Snapshot of the lock history "
+                  "up to {0}\n".format(base).encode('utf-8')).decode('utf-8').strip()
+        # Copy the kept commits onto the snapshot, oldest first
+        for commit in reversed(commits[:-1]):
+            info = run(gitpath, 'log', '-1', '--format=%an%x00%ae%x00%ad%x00%B', commit)
+            name, email, date, message = info.decode('utf-8').split('\0', 3)
+            env = {'GIT_AUTHOR_NAME': name, 'GIT_AUTHOR_EMAIL': email, 'GIT_AUTHOR_DATE': date}
+            new = run(gitpath, 'commit-tree', commit+'^{tree}', '-p', new, env=env,
+                      input=message.encode('utf-8')).decode('utf-8').strip()
+        updates = [(new, branch, old)]
+        if archive is not None:
+            archive_tip = run(gitpath, 'ls-remote', 'origin', 'refs/heads/{0}'.format(archive)).split()
+            if len(archive_tip)==0:
+                updates.append((old, archive, None))
+            else:
+                archive_tip = fetch(gitpath, archive, 1)
+                merge = run(gitpath, 'commit-tree', old+'^{tree}', '-p', archive_tip, '-p', old,
+                            input="Archive the lock history up to {0}\n".format(old).encode('utf-8'))
+                updates.append((merge.decode('utf-8').strip(), archive, archive_tip))
+    push_refs(gitpath, updates)
+    run(gitpath, 'update-ref', remote_ref(branch), new)
+    return old, new
@@ -0,0 +1,347 @@
+"""
+Audit history of the locks of a package.
+
+Every change to the locks is a commit of the lockfile in the lock repo, so the history
+of a file is in ``git log -p`` of the lockfile. Reading the whole log for every
+question gets slower as the history grows, so a `History` keeps an index of every lock
+that was held (a hold: the path, the user, and when the lock was taken and released)
+in an sqlite database in ``.git/gitlock``. The index is updated from the commits that
+were made since the last indexed commit, and queries for a file, a user or a range of
+times only look up the matching rows.
+"""
+import os
+import json
+import sqlite3
+import logging
+import datetime
+from collections import OrderedDict
+
+import gitlock.utils as utils
+import gitlock.git_io
+import gitlock.query
+import gitlock.metrics as metrics
+from gitlock.lockfile import ShardedLockFile, parse_row
+
+logger = logging.getLogger('gitlock.history')
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS holds (path TEXT NOT NULL, user TEXT NOT NULL, "
+    "start TEXT NOT NULL, end TEXT, start_commit TEXT, end_commit TEXT)",
+    # A lock is identified by its path, user and time, so replaying a commit (for
+    # example a copy made by `gitlock compact`) does not add it twice
+    "CREATE UNIQUE INDEX IF NOT EXISTS holds_path ON holds (path, user, start)",
+    "CREATE INDEX IF NOT EXISTS holds_user ON holds (user, start)",
+    "CREATE INDEX IF NOT EXISTS holds_start ON holds (start)",
+    "CREATE INDEX IF NOT EXISTS holds_end ON holds (end)",
+    "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)",
+]
+
+# Formats of the dates accepted by `parse_time`, besides ages
+DATE_FORMATS = ['%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S']
+
+# Length of a hold in seconds, with holds that are still open ending at :now
+DURATION = "(julianday(COALESCE(end, :now))-julianday(start))*86400"
+
+def parse_time(value, now=None):
+    """
+    Convert an age (see `gitlock.query.parse_age`) or a date like ``2026-09-01`` or
+    ``2026-09-01 14:00`` to a lock time
+    """
+    try:
+        return gitlock.query.lock_time(value, now)
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            return str(datetime.datetime.strptime(value.strip(), date_format))
+        except ValueError:
+            pass
+    raise ValueError("Could not parse the time {0}, expected an age like 30m, 12h or 3d or a "
+                     "date like 2026-09-01 or '2026-09-01 14:00'".format(value))
+
+def format_duration(seconds):
+    """
+    Format a number of seconds like ``45s``, ``12m``, ``4h 12m`` or ``3d 4h``
+    """
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return '{0}s'.format(seconds)
+    minutes, hours, days = seconds//60 % 60, seconds//3600 % 24, seconds//86400
+    if days > 0:
+        return '{0}d {1}h'.format(days, hours)
+    if hours > 0:
+        return '{0}h {1}m'.format(hours, minutes)
+    return '{0}m'.format(minutes)
+
+def parse_log(lines):
+    """
+    Generate the commits in the output of ``git log -p`` with the format used by
+    `History.update`, as ``(commit, time, is_root, removed, added)`` tuples. ``removed``
+    and ``added`` map the paths of the lockfile rows that the commit removed and added
+    to their ``(user, time)``.
+    """
+    commit = None
+    for line in lines:
+        if line.startswith(b'\0'):
+            if commit is not None:
+                yield commit
+            fields = line[1:].decode('utf-8').split()
+            time = str(datetime.datetime.fromtimestamp(int(fields[1])))
+            commit = (fields[0], time, len(fields)==2, OrderedDict(), OrderedDict())
+        elif commit is not None and line[:2] in (b'-"', b'+"'):
+            row = parse_row(line[1:])
+            if row is not None:
+                commit[3 if line[:1] == b'-' else 4][row[0]] = (row[1], row[2])
+    if commit is not None:
+        yield commit
+
+class Hold(object):
+    """
+    A lock on a path that ``user`` held from ``start`` until ``end`` (None if it is
+    still held)
+    """
+    def __init__(self, path, user, start, end, start_commit, end_commit, seconds):
+        self.path = path
+        self.user = user
+        self.start = start
+        self.end = end
+        self.start_commit = start_commit
+        self.end_commit = end_commit
+        self.seconds = seconds
+
+    def to_dict(self):
+        return OrderedDict([(key, getattr(self, key)) for key in
+                            ['path', 'user', 'start', 'end', 'seconds', 'start_commit', 'end_commit']])
+
+class History(object):
+    """
+    Index of the locks held in a package (see the module documentation)
+    """
+    def __init__(self, repo, path=None):
+        self.repo = repo
+        if path is None:
+            path = utils.get_cache_path(repo.git_dir, '{0}.history.sqlite'.format(repo.pkg))
+        self.path = path
+        self.db = sqlite3.connect(path)
+        with self.db:
+            for statement in SCHEMA:
+                self.db.execute(statement)
+        self.open = None
+
+    def get_state(self, key):
+        row = self.db.execute("SELECT value FROM state WHERE key=?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_state(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+    def lockfile_paths(self):
+        """
+        Paths in the lock repo of the lockfile of the package and of its shards
+        """
+        shard_dir = os.path.dirname(ShardedLockFile.shard_path(self.repo.lockfile_path, ''))
+        return [self.repo.lockfile_relpath, self.repo.relpath(shard_dir)]
+
+    def update(self, archive=None, ttl=0):
+        """
+        Fetch the history of the lock branch (and of the ``archive`` branch that
+        `gitlock compact` keeps the old history on) and index the commits that are not
+        indexed yet. The remote is not fetched if it was checked less than ``ttl``
+        seconds ago (see `gitlock.lock.Repo.is_fresh`) and the index is up to date.
+        Returns the number of commits that were indexed.
+        """
+        indexed = self.get_state('commit')
+        if indexed is not None:
+            try:
+                gitlock.git_io.run(self.repo.gitpath, 'cat-file', '-e', indexed+'^{commit}')
+            except gitlock.git_io.GitError:
+                logger.warning("The last indexed commit {0} is no longer in the lock repo, "
+                               "indexing the history again".format(indexed))
+                with self.db:
+                    self.db.execute("DELETE FROM holds")
+                    self.db.execute("DELETE FROM state WHERE key='commit'")
+                indexed = None
+        branches = [self.repo.branch] + ([archive] if archive is not None else [])
+        if indexed is None or indexed != self.repo.read_tip() or not self.repo.is_fresh(ttl):
+            # Only the commits after the last indexed commit are fetched
+            gitlock.git_io.fetch_history(self.repo.gitpath, branches, indexed)
+        tips = [gitlock.git_io.read_ref(self.repo.git_dir, gitlock.git_io.remote_ref(branch))
+                for branch in branches]
+        tip = tips[0]
+        if tip == indexed:
+            return 0
+        revs = [rev for rev in tips if rev is not None]
+        if indexed is not None:
+            revs.append('^'+indexed)
+        # Parents before children, and the histories that `compact` disconnected (the
+        # archive and each snapshot) in the order they were made
+        lines = gitlock.git_io.iter_lines(self.repo.gitpath, 'log', '--reverse', '--date-order', '-p',
+                                          '-U0', '--no-renames', '--no-color', '--no-ext-diff',
+                                          '--format=%x00%H %at %P', *revs + ['--'] + self.lockfile_paths())
+        count = 0
+        with metrics.phase('index') as record, self.db:
+            self.open = OrderedDict([(path, (user, start)) for path, user, start in self.db.execute(
+                "SELECT path, user, start FROM holds WHERE end IS NULL")])
+            for commit in parse_log(lines):
+                self.apply(*commit)
+                count += 1
+            self.set_state('commit', tip)
+            record['commits'] = count
+        logger.info("Indexed {0} commits of the lock history of {1}".format(count, self.repo.pkg))
+        return count
+
+    def apply(self, commit, time, is_root, removed, added):
+        """
+        Update the holds with the rows of the lockfile that a commit changed
+        """
+        for path in list(removed) + [path for path in added if path not in removed]:
+            old = removed.get(path)
+            new = added.get(path)
+            if old == new:
+                # The row was only moved or padded
+                continue
+            if old is not None and old[0] != 'None':
+                # A dense lockfile records when the lock was released, a sparse lockfile
+                # removes the row
+                self.close(path, old, commit, time if new is None else new[1])
+            if new is not None and new[0] != 'None':
+                self.start(path, new, commit)
+        if is_root:
+            # The first commit of the history, or a snapshot made by `compact`: any
+            # lock that is not in the snapshot was released before it
+            for path, lock in list(self.open.items()):
+                if added.get(path) != lock:
+                    self.close(path, lock, commit, time)
+
+    def start(self, path, lock, commit):
+        if self.open.get(path) == lock:
+            return
+        if path in self.open:
+            # The release was not in the indexed history
+            self.close(path, self.open[path], commit, lock[1])
+        self.db.execute("INSERT OR IGNORE INTO holds (path, user, start, start_commit) "
+                        "VALUES (?, ?, ?, ?)", (path, lock[0], lock[1], commit))
+        self.db.execute("UPDATE holds SET end=NULL, end_commit=NULL WHERE path=? AND user=? AND "
+                        "start=?", (path, lock[0], lock[1]))
+        self.open[path] = lock
+
+    def close(self, path, lock, commit, time):
+        if self.open.get(path) != lock:
+            return
+        self.db.execute("UPDATE holds SET end=?, end_commit=? WHERE path=? AND user=? AND start=?",
+                        (time, commit, path, lock[0], lock[1]))
+        del self.open[path]
+
+    def where(self, paths=None, user=None, since=None, until=None):
+        """
+        SQL condition and parameters for the holds that match the filters (see `holds`)
+        """
+        conditions = []
+        params = {'now': str(datetime.datetime.now())}
+        path_conditions = []
+        for n, path in enumerate(paths or []):
+            if gitlock.query.is_pattern(path):
+                path_conditions.append("path GLOB :path{0}".format(n))
+                params['path{0}'.format(n)] = path
+                continue
+            path = path.rstrip('/')
+            if path in ('', '.'):
+                path_conditions.append("1")
+                continue
+            # The path, anything below it, and the directories above it
+            parents = path.split('/')
+            parents = ['/'.join(parents[:m]) for m in range(1, len(parents)+1)]
+            for m, parent in enumerate(parents):
+                params['path{0}_{1}'.format(n, m)] = parent
+            path_conditions.append("path IN ({0})".format(', '.join(
+                [':path{0}_{1}'.format(n, m) for m in range(len(parents))])))
+            path_conditions.append("(path > :below{0} AND path < :after{0})".format(n))
+            params['below{0}'.format(n)] = path+'/'
+            params['after{0}'.format(n)] = path+'0' # '0' is the character after '/'
+        if len(path_conditions)>0:
+            conditions.append('('+' OR '.join(path_conditions)+')')
+        if user is not None:
+            conditions.append("user = :user")
+            params['user'] = user
+        if until is not None:
+            conditions.append("start < :until")
+            params['until'] = parse_time(until)
+        if since is not None:
+            conditions.append("(end IS NULL OR end > :since)")
+            params['since'] = parse_time(since)
+        return ' AND '.join(conditions) or '1', params
+
+    def holds(self, paths=None, user=None, since=None, until=None, reverse=False, limit=None,
+              offset=0):
+        """
+        List of the holds (`Hold`) sorted by the time that the lock was taken.
+
+        ``paths`` is a list of paths and glob patterns: a hold matches if it is on a path,
+        on a file below it or on a directory above it, or matches a pattern. Only the holds
+        of ``user`` and the holds that overlap the time from ``since`` to ``until`` (ages
+        or dates, see `parse_time`) are listed.
+        """
+        where, params = self.where(paths, user, since, until)
+        sql = ("SELECT path, user, start, end, start_commit, end_commit, {0} FROM holds WHERE {1} "
+               "ORDER BY start {2}, path".format(DURATION, where, 'DESC' if reverse else 'ASC'))
+        if limit is not None or offset:
+            sql += " LIMIT :limit OFFSET :offset"
+            params.update(limit=-1 if limit is None else limit, offset=offset)
+        return [Hold(*row) for row in self.db.execute(sql, params)]
+
+    def user_stats(self, **filters):
+        """
+        Number of holds and files, and average, total and longest hold time (in seconds)
+        of each user, for the holds that match the filters (see `holds`)
+        """
+        where, params = self.where(**filters)
+        return self.db.execute(
+            "SELECT user, COUNT(*), COUNT(DISTINCT path), AVG({0}), SUM({0}), MAX({0}) FROM holds "
+            "WHERE {1} GROUP BY user ORDER BY COUNT(*) DESC, user".format(DURATION, where), params).fetchall()
+
+    def contended(self, top=10, **filters):
+        """
+        The ``top`` most contended paths: the paths held by the most users (and then the
+        most often), with the number of users and holds and the total hold time
+        """
+        where, params = self.where(**filters)
+        params['top'] = top
+        return self.db.execute(
+            "SELECT path, COUNT(DISTINCT user), COUNT(*), SUM({0}) FROM holds WHERE {1} GROUP BY path "
+            "ORDER BY COUNT(DISTINCT user) DESC, COUNT(*) DESC, path LIMIT :top".format(DURATION, where),
+            params).fetchall()
+
+    def close_db(self):
+        self.db.close()
+
+def write_holds(holds, stream, output='text'):
+    """
+    Write holds as JSON lines, or as a table with a column for the path, user, start,
+    end and length of each hold
+    """
+    if output == 'json':
+        for hold in holds:
+            stream.write(json.dumps(hold.to_dict())+'\n')
+        return
+    rows = [(hold.path, hold.user, hold.start, hold.end or 'still locked', format_duration(hold.seconds))
+            for hold in holds]
+    write_rows(rows, ('PATH', 'USER', 'LOCKED', 'UNLOCKED', 'HELD'), stream)
+
+def write_rows(rows, header, stream):
+    widths = [max([len(row[n]) for row in rows+[header]]) for n in range(len(header)-1)]
+    for row in [header]+rows:
+        stream.write('  '.join(['{0:<{1}}'.format(value, width) for value, width in zip(row, widths)] +
+                               [row[-1]])+'\n')
+
+def write_stats(history, stream, top=10, **filters):
+    """
+    Write the hold times of each user and the most contended paths
+    """
+    rows = [(user, str(holds), str(files), format_duration(average), format_duration(total),
+             format_duration(longest))
+            for user, holds, files, average, total, longest in history.user_stats(**filters)]
+    write_rows(rows, ('USER', 'HOLDS', 'FILES', 'AVERAGE', 'TOTAL', 'LONGEST'), stream)
+    stream.write('\nMost contended:\n')
+    rows = [(path, str(users), str(holds), format_duration(total))
+            for path, users, holds, total in history.contended(top, **filters)]
+    write_rows(rows, ('PATH', 'USERS', 'HOLDS', 'TOTAL'), stream)
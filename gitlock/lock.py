@@ -1,35 +1,175 @@
 import os
-import csv
+import sys
+import time
+import logging
 import datetime
+import fnmatch
 from collections import OrderedDict
 
-import git
-
 import gitlock.utils as utils
 import gitlock.git_io
+import gitlock.metrics as metrics
+import gitlock.query
+from gitlock.lockfile import Lock, LockFile, ShardedLockFile, PackageIndex
+
+logger = logging.getLogger('gitlock.lock')
 
 def get_username(username):
     """
     If a username is not specified, use the global user.name from ~/.gitconfig
     """
-    from git.config import GitConfigParser
     if username is None:
         gitconfig_name = os.path.expanduser('~/.gitconfig')
         if not os.path.isfile(gitconfig_name):
             raise ValueError("You must enter a username if you do not have a ~/.gitconfig file")
-        gitconfig = GitConfigParser(gitconfig_name, read_only=True)
-        username = gitconfig.get('user','name')
+        try:
+            # Read with git itself, so that GitPython is not imported (see `Repo.check`)
+            username = gitlock.git_io.run(os.path.dirname(gitconfig_name), 'config', '--file',
+                                          gitconfig_name, 'user.name').decode('utf-8').strip()
+        except gitlock.git_io.GitError:
+            username = ''
         if username == '':
             raise ValueError("Could not load user.name from ~/.gitconfig")
     return username
 
 
-class Lock(object):
-    def __init__(self, repo, filename, user, time):
-        self.filename = filename
-        self.user = user
-        self.time = time
-        self.locked = user != 'None'
+def get_commit_msg(action, locks, username):
+    """
+    Commit message for locking or unlocking a set of files
+    """
+    if len(locks)==1:
+        return '{0} {1} by {2}'.format(action, locks[0].filename, username)
+    msg = '{0} {1} files by {2}\n\n'.format(action, len(locks), username)
+    return msg + '\n'.join([lock.filename for lock in locks])
+
+
+def display_locks(locks, username=None, sortby='user', directories=(), output='text', pkg=None,
+                  **query):
+    """
+    Print a set of locks.
+
+    By default the locks are listed for each user. Locks on ``directories`` are shown
+    with a trailing ``/`` and locks on files inside a directory locked by the same user
+    are collapsed into the directory lock.
+
+    Any other keyword arguments are filters for `gitlock.query.LockIndex.query`. Locks
+    sorted by path or time (or with ``output='table'``) are shown as a table, and with
+    ``output='json'`` each lock is written as a line of JSON (including the ``pkg``, if
+    it is given).
+    """
+    if len(query)>0 or sortby != 'user' or output != 'text':
+        results = gitlock.query.LockIndex(locks).query(user=username, sortby=sortby, **query)
+        if output == 'json':
+            gitlock.query.write_json(results, sys.stdout, pkg)
+            return
+        elif output == 'table' or sortby != 'user':
+            gitlock.query.write_table(results, sys.stdout, directories)
+            return
+        locks = OrderedDict([(lock.filename, lock) for lock in results])
+
+    # Count the locks inside each directory locked by the same user
+    collapsed = {}
+    for filename, lock in locks.items():
+        outer = None
+        parent = os.path.dirname(filename)
+        while parent != '':
+            if parent in locks and locks[parent].user == lock.user:
+                outer = parent
+            parent = os.path.dirname(parent)
+        if outer is not None:
+            collapsed[filename] = outer
+    counts = {}
+    for filename, outer in collapsed.items():
+        counts[outer] = counts.get(outer, 0) + 1
+
+    def describe(lock):
+        filename = lock.filename
+        if filename in directories:
+            filename += '/'
+        desc = '\t{0}: at {1}'.format(filename, lock.time)
+        if lock.filename in counts:
+            desc += ' (including {0} locks inside it)'.format(counts[lock.filename])
+        return desc
+
+    # Group the locks by user in a single pass
+    by_user = OrderedDict()
+    if username is not None:
+        by_user[username] = []
+    for filename, lock in locks.items():
+        if filename not in collapsed and (username is None or lock.user==username):
+            by_user.setdefault(lock.user, []).append(lock)
+    for user, user_locks in by_user.items():
+        print("{0}'s locked files:".format(user))
+        print('\n'.join([describe(lock) for lock in user_locks]))
+
+
+def diff_locks(old, new):
+    """
+    Changes between two sets of locked files (mapping filenames to `Lock`).
+
+    Each change is a dict with the ``event`` ('locked', 'unlocked', or 'stolen' if the
+    lock was taken over by another user), the ``path``, and the ``user`` and ``time`` of
+    the lock. Stolen locks also have the ``previous`` user.
+    """
+    events = []
+    for filename in sorted(set(old) | set(new)):
+        before = old.get(filename)
+        after = new.get(filename)
+        if before is None:
+            event = OrderedDict([('event', 'locked'), ('path', filename),
+                                 ('user', after.user), ('time', after.time)])
+        elif after is None:
+            event = OrderedDict([('event', 'unlocked'), ('path', filename),
+                                 ('user', before.user), ('time', before.time)])
+        elif after.user != before.user:
+            event = OrderedDict([('event', 'stolen'), ('path', filename), ('user', after.user),
+                                 ('time', after.time), ('previous', before.user)])
+        else:
+            continue
+        events.append(event)
+    return events
+
+def describe_event(event):
+    """
+    One line description of a change returned by `diff_locks`
+    """
+    if event['event'] == 'locked':
+        return "{0} locked by {1} at {2}".format(event['path'], event['user'], event['time'])
+    elif event['event'] == 'unlocked':
+        return "{0} unlocked by {1}".format(event['path'], event['user'])
+    return "{0} taken over by {1} from {2} at {3}".format(event['path'], event['user'],
+                                                        event['previous'], event['time'])
+
+
+class Report(OrderedDict):
+    """
+    Per-file result of a lock or unlock request.
+
+    Each entry maps a filename to a ``(status, message)`` tuple. The report evaluates
+    to ``True`` only if the whole request was applied.
+    """
+    success = False
+    headers = {
+        ('lock', True): "Successfully locked the requested files:",
+        ('lock', False): "Unable to get the requested locks, no files were locked:",
+        ('unlock', True): "Successfully unlocked the requested files:",
+        ('unlock', False): "Unable to release the requested locks, no files were unlocked:",
+        ('check', True): "None of the changed files are locked by other users",
+        ('check', False): "Some of the changed files are locked by other users:",
+    }
+
+    def __init__(self, action=None, *args, **kwargs):
+        super(Report, self).__init__(*args, **kwargs)
+        self.action = action
+
+    def __bool__(self):
+        return self.success
+
+    def display(self):
+        if (self.action, self.success) in self.headers:
+            print(self.headers[(self.action, self.success)])
+        for filename, (status, message) in self.items():
+            print("\t{0}: {1}".format(filename, message))
 
 
 class Repo(object):
@@ -38,122 +178,825 @@ class Repo(object):
         Initialize a repo with a gitlock for a specific package
         """
         self.gitpath = utils.get_gitpath(gitpath)
-        self.lock_repo = git.Repo(self.gitpath)
+        self.git_dir = utils.get_git_dir(self.gitpath)
+        self._lock_repo = None
+        self._package_index = None
         self.pkg = pkg
-        self.locks = OrderedDict()
+        self.locks = None
+        self.head = None
         self.lockfile_path = utils.get_lockfile_path(self.gitpath, self.pkg)
-        config_path = utils.get_config_path(self.gitpath, self.pkg)
-        self.config = utils.load_config(config_path)
+        self.lockfile_relpath = os.path.relpath(self.lockfile_path, self.gitpath).replace(os.sep, '/')
+        self.config = utils.load_lock_cfg(self.gitpath, self.pkg)
+        # The 'plumbing' backend builds commits directly from git objects, without a
+        # working tree or index, and is always used for bare lock repos
+        self.backend = self.config.get('backend', 'worktree')
+        if not os.path.exists(os.path.join(self.gitpath, '.git')):
+            self.backend = 'plumbing'
+        self.branch = self.config.get('branch') or gitlock.git_io.current_branch(self.git_dir)
+        # Only the tip of the lock branch is fetched by default (0 fetches the whole history)
+        self.fetch_depth = self.config.get('fetch_depth', 1) or None
 
-    def update_all_locks(self):
+    @property
+    def lock_repo(self):
+        """
+        GitPython repo for the lock repo, only created when a command needs to pull or
+        commit (reading the locks does not import GitPython)
+        """
+        if self._lock_repo is None:
+            import git
+            self._lock_repo = git.Repo(self.gitpath)
+        return self._lock_repo
+
+    def local_tip(self):
+        """
+        Commit of the lock repo that the local lockfile was loaded from
+        """
+        if self.backend == 'plumbing':
+            # None if the remote branch has not been fetched yet
+            return gitlock.git_io.read_ref(self.git_dir, gitlock.git_io.remote_ref(self.branch))
+        return gitlock.git_io.read_ref(self.git_dir, 'HEAD')
+
+    def read_tip(self):
+        """
+        Commit of the lock repo that read-only queries read the locks from: the last
+        fetched commit of the remote branch (or HEAD if it has not been fetched yet)
+        """
+        tip = gitlock.git_io.read_ref(self.git_dir, gitlock.git_io.remote_ref(self.branch))
+        if tip is None and self.backend != 'plumbing':
+            tip = gitlock.git_io.read_ref(self.git_dir, 'HEAD')
+        return tip
+
+    def parse_lockfile(self, head, from_git=False):
+        """
+        Parse the lockfile at commit ``head`` of the lock repo. With the plumbing backend
+        (or if ``from_git`` is True) the lockfile is read from the git objects, otherwise
+        it is read from the working tree.
+        """
+        from_git = from_git or self.backend == 'plumbing'
+        if from_git:
+            data = gitlock.git_io.read_blob(self.gitpath, head, self.lockfile_relpath)
+        else:
+            data = None
+        with metrics.phase('parse') as record:
+            locks = LockFile(self.lockfile_path, data)
+            if locks.shards is not None:
+                if from_git:
+                    locks = ShardedLockFile(locks, lambda path: self.read_file(head, path),
+                                            lambda path: self.list_dir(head, path))
+                else:
+                    locks = ShardedLockFile(locks)
+            record['bytes'] = locks.size
+        metrics.set_value('lockfile_bytes', locks.size)
+        return locks
+
+    def load_lockfile(self, head):
+        """
+        Load the lockfile at commit ``head`` of the lock repo
+        """
+        self.locks = self.parse_lockfile(head)
+        self.head = head
+        return self.locks
+
+    def relpath(self, path):
+        """
+        Path of a file in the lock repo, relative to the root of the repo
+        """
+        return os.path.relpath(path, self.gitpath).replace(os.sep, '/')
+
+    def read_file(self, head, path):
+        """
+        Contents of a file in commit ``head`` of the lock repo, or None if it does not exist
         """
-        Pull changes to the lock file from the remote repository and update the local lockfile
+        try:
+            return gitlock.git_io.read_blob(self.gitpath, head, self.relpath(path))
+        except gitlock.git_io.GitError:
+            return None
+
+    def list_dir(self, head, path):
+        """
+        Names of the files in a directory in commit ``head`` of the lock repo
+        """
+        try:
+            names = gitlock.git_io.run(self.gitpath, 'ls-tree', '--name-only', '-z',
+                                       '{0}:{1}'.format(head, self.relpath(path)))
+        except gitlock.git_io.GitError:
+            return []
+        return [name.decode('utf-8') for name in names.split(b'\0') if name != b'']
+
+    def lockfile_paths(self, head=None):
+        """
+        Paths of the lockfile of the package and of all of its shards
+        """
+        shard_dir = os.path.dirname(ShardedLockFile.shard_path(self.lockfile_path, ''))
+        if self.backend == 'plumbing':
+            names = self.list_dir(head, shard_dir)
+        elif os.path.isdir(shard_dir):
+            names = os.listdir(shard_dir)
+        else:
+            names = []
+        return [self.lockfile_path] + [os.path.join(shard_dir, name) for name in sorted(names)
+                                       if name.endswith('.txt')]
+
+    def has_lockfile(self, head=None):
+        """
+        Whether a lockfile has been built for the package. With the plumbing backend the
+        lock branch is fetched unless the commit ``head`` to check is given.
+        """
+        if self.backend == 'plumbing':
+            if head is None:
+                head = gitlock.git_io.fetch(self.gitpath, self.branch, self.fetch_depth)
+            try:
+                gitlock.git_io.run(self.gitpath, 'cat-file', '-e',
+                                   '{0}:{1}'.format(head, self.lockfile_relpath))
+            except gitlock.git_io.GitError:
+                return False
+            return True
+        return os.path.isfile(self.lockfile_path)
+
+    def fetch_locks(self):
         """
-        import csv
-        if not gitlock.git_io.pull(self.lock_repo):
+        Fetch the lock branch from the remote, without touching the working tree or
+        loading the lockfile. Returns the new commit (see `read_tip`).
+        """
+        return gitlock.git_io.fetch(self.gitpath, self.branch, self.fetch_depth)
+
+    def pull_locks(self):
+        """
+        Pull changes to the lock repo from the remote (with the plumbing backend the remote
+        branch is only fetched), without loading the lockfile. Returns the new commit.
+        """
+        if self.backend == 'plumbing':
+            return self.fetch_locks()
+        if not gitlock.git_io.pull(self.lock_repo, self.fetch_depth, self.branch):
             raise gitlock.git_io.GitError("There was an error pulling the data from the remote origin")
-        with open(self.lockfile_path, 'r') as f:
-            self.locks = OrderedDict([(row[0],Lock(self, *row)) 
-                                    for row in csv.reader(f, delimiter=" ", quotechar='"')])
+        return self.local_tip()
 
+    def update_all_locks(self):
+        """
+        Pull changes to the lock file from the remote repository and update the local lockfile.
+        With the plumbing backend the remote branch is only fetched.
+        """
+        head = self.pull_locks()
+        if self.locks is None or self.head != head:
+            self.load_lockfile(head)
         return self.locks
 
-    def get_locked_info(self, username=None, sortby='user', display=True):
+    def reset_to_remote(self):
+        """
+        Fetch the lock branch after a rejected push and reload the lockfile from the new
+        tip of the remote. In the working tree the commit that was rejected (see
+        `save_lockfile`) is replaced by the remote tip with a single reset, instead of
+        rewinding it and then pulling.
         """
-        Load the information about the currently locked files
+        if self.backend == 'plumbing':
+            return self.load_lockfile(self.fetch_locks())
+        try:
+            head = self.fetch_locks()
+        except:
+            # Do not leave the rejected commit checked out
+            self.locks = None
+            gitlock.git_io.reset_keep(self.lock_repo, self.head)
+            raise
+        gitlock.git_io.reset_keep(self.lock_repo, head)
+        return self.load_lockfile(head)
+
+    def is_fresh(self, ttl=0):
         """
-        self.update_all_locks()
-        if username is None:
-            locks = OrderedDict([(filename, lock) for filename, lock in self.locks.items() 
-                                 if lock.user!="None"])
+        Check whether the local lock repo is up to date with the remote by comparing the
+        remote ref with the last fetched commit (see `read_tip`), without fetching. If the
+        remote was checked less than ``ttl`` seconds ago it is assumed not to have changed.
+        """
+        head = self.read_tip()
+        if self.checked_recently(head, ttl):
+            return True
+        tip = gitlock.git_io.remote_tip(self.gitpath, self.branch)
+        self.record_remote_tip(tip)
+        return tip == head
+
+    def checked_recently(self, head, ttl):
+        """
+        True if the remote was checked less than ``ttl`` seconds ago (see
+        `record_remote_tip`) and its tip was then ``head``
+        """
+        state = utils.load_json(utils.get_cache_path(self.git_dir, 'remote.json')) or {}
+        return state.get('tip') == head and time.time()-state.get('checked', 0) < ttl
+
+    def record_remote_tip(self, tip):
+        """
+        Record the tip of the remote branch that was just read, and when it was read
+        """
+        utils.dump_json(utils.get_cache_path(self.git_dir, 'remote.json'),
+                        {'tip': tip, 'checked': time.time()})
+
+    def read_locked(self, ttl=0, offline=False):
+        """
+        Load the currently locked files for a read-only query.
+
+        The lock branch is only fetched if the remote has changed (see `is_fresh`) and the
+        lockfile is read directly from the fetched commit, so the working tree of the lock
+        repo is never merged or read. The locked files are cached for each commit of the
+        lock repo, so when nothing has changed the lockfile is not parsed again. If
+        ``offline`` is True the remote is not checked at all.
+        """
+        if not offline and not self.is_fresh(ttl):
+            self.fetch_locks()
+        head = self.read_tip()
+        if self.locks is not None and self.head == head:
+            # The lockfile is already loaded (for example in a lock server)
+            return self.locks.locked()
+        cache_path = utils.get_cache_path(self.git_dir, '{0}.locked.json'.format(self.pkg))
+        with metrics.phase('read_cache'):
+            cache = utils.load_json(cache_path)
+        if cache is not None and cache['head'] == head:
+            metrics.count('cache_hits')
+            return OrderedDict([(row[0], Lock(self, *row)) for row in cache['locks']])
+        if self.backend == 'plumbing':
+            locks = self.load_lockfile(head).locked()
         else:
-            locks = OrderedDict([(filename, lock) for filename, lock in self.locks.items() 
+            # The working tree may be at another commit, so it is not loaded in self.locks
+            locks = self.parse_lockfile(head, from_git=True).locked()
+        rows = [[lock.filename, lock.user, lock.time] for lock in locks.values()]
+        utils.dump_json(cache_path, {'head': head, 'locks': rows})
+        return locks
+
+    def get_locked_info(self, username=None, sortby='user', display=True, ttl=None, output='text',
+                        **query):
+        """
+        Load the information about the currently locked files.
+
+        The remote is only pulled if it has changed since the last pull, and is assumed
+        unchanged if it was checked less than ``ttl`` seconds ago (by default the
+        ``info_ttl`` in the package configuration, or 0). The ``output`` format and any
+        ``query`` filters are passed to `display_locks`.
+        """
+        if ttl is None:
+            ttl = self.config.get('info_ttl', 0)
+        locks = self.read_locked(ttl)
+        if username is not None:
+            locks = OrderedDict([(filename, lock) for filename, lock in locks.items()
                                  if lock.user==username])
 
         if display:
-            if sortby == 'user':
-                if username is None:
-                    users = list(set([lock.user for filename, lock in locks.items()]))
-                else:
-                    users = [username]
-                for user in users:
-                    print("{0}'s locked files:".format(user))
-                    print('\n'.join(['\t{0}: at {1}'.format(lock.filename, lock.time) for filename, lock 
-                                     in locks.items() if lock.user==user]))
-            else:
-                raise ValueError("sortby parameter {0} is not yet supported".format(sortby))
+            directories = [filename for filename in locks if self.is_directory(filename)]
+            display_locks(locks, username, sortby, directories, output, **query)
         return locks
 
-    def lock(self, filename, username=None):
+    def watch(self, interval=5.0):
         """
-        Attempt to lock a file
+        Poll the remote for changes to the locks every ``interval`` seconds.
+
+        Yields the locked files and the list of changes since the previous poll (see
+        `diff_locks`), starting with the current locks and no changes. While the remote
+        has not moved each poll is a single ``git ls-remote``, and the lockfile is only
+        parsed again if the new commits changed the lockfiles of this package.
         """
-        got_lock = False
-        username = get_username(username)
-        locks = self.update_all_locks()
-        if filename not in locks:
-            print("Could not find {0} in the lock file. "
-                  "The the filename or add it to lockfiles".format(filename))
-        else:
-            lock = locks[filename]
+        locks = self.read_locked()
+        head = self.read_tip()
+        pkg_dir = os.path.dirname(self.lockfile_relpath)
+        yield locks, []
+        while True:
+            time.sleep(interval)
+            events = []
+            try:
+                with metrics.phase('poll'):
+                    if not self.is_fresh():
+                        self.fetch_locks()
+                    # The lock repo may also have been updated by other commands
+                    new_head = self.read_tip()
+                    if new_head != head:
+                        try:
+                            changed = len(gitlock.git_io.changed_paths(self.gitpath, head, new_head,
+                                                                       [pkg_dir]))>0
+                        except gitlock.git_io.GitError:
+                            # The old commit is not available, for example after a compaction
+                            changed = True
+                        if changed:
+                            new_locks = self.read_locked(offline=True)
+                            events = diff_locks(locks, new_locks)
+                            locks = new_locks
+                        head = new_head
+            except gitlock.git_io.GitError as e:
+                logger.warning("Unable to poll the remote for new locks: {0}".format(e))
+            yield locks, events
+
+    def check(self, username, staged=False, ttl=None):
+        """
+        Check the files that are changed in the working tree of the package (or only the
+        ``staged`` files) against the files locked by other users, for example before a
+        commit.
+
+        The locks are read from the cache of the lock repo (see `read_locked`) and the
+        remote is only checked if it was last checked more than ``ttl`` seconds ago (by
+        default the ``check_ttl`` in the package configuration, or 60). If the remote
+        cannot be reached the local lock repo is used.
+        """
+        if ttl is None:
+            ttl = self.config.get('check_ttl', 60)
+        try:
+            locks = self.read_locked(ttl)
+        except gitlock.git_io.GitError as e:
+            logger.warning("Unable to check the remote for new locks, using the local "
+                           "lock repo: {0}".format(e))
+            locks = self.read_locked(offline=True)
+        with metrics.phase('status'):
+            changed = gitlock.git_io.changed_files(self.config['pkg_path'], staged)
+        # Files and directories locked by other users
+        others = dict([(filename, lock) for filename, lock in locks.items() if lock.user != username])
+        report = Report('check')
+        for filename in changed:
+            path = filename
+            while path != '':
+                if path in others:
+                    lock = others[path]
+                    if path == filename:
+                        report[filename] = ('locked', "locked by {0} since {1}".format(lock.user, lock.time))
+                    else:
+                        report[filename] = ('conflict', "in {0}, locked by {1} since {2}".format(
+                                            path, lock.user, lock.time))
+                    break
+                path = os.path.dirname(path)
+        report.success = len(report)==0
+        return report
+
+    def package_index(self):
+        """
+        `PackageIndex` of the package commit that the lockfile was built from (or of the
+        checked out commit of the package, if the lockfile commit is not available), used
+        to check that files exist when the lockfile is sparse
+        """
+        pkg_path = self.config['pkg_path']
+        head = gitlock.git_io.read_ref(utils.get_git_dir(pkg_path), 'HEAD')
+        for commit in [self.locks.commit, head]:
+            if commit is None:
+                continue
+            if self._package_index is not None and self._package_index.commit == commit:
+                return self._package_index
+            try:
+                cache_path = utils.get_cache_path(self.git_dir, '{0}.index'.format(self.pkg))
+                with metrics.phase('package_index'):
+                    self._package_index = PackageIndex(pkg_path, commit, cache_path)
+                return self._package_index
+            except gitlock.git_io.GitError:
+                logger.info("Commit {0} is not in the package repo".format(commit))
+        raise gitlock.git_io.GitError("Unable to list the files of the package in {0}".format(pkg_path))
+
+    def get_lock(self, filename):
+        """
+        Get the lock for a file, or None if the file is not in the package.
+
+        A sparse lockfile only has rows for locked files, so for any other file in the
+        package a new (unlocked) `Lock` is returned.
+        """
+        if filename in self.locks:
+            return self.locks[filename]
+        if self.locks.sparse and filename in self.package_index():
+            return Lock(self, filename, "None", "")
+        return None
+
+    def is_directory(self, filename):
+        """
+        Whether a path in the package is a directory
+        """
+        return os.path.isdir(os.path.join(self.config['pkg_path'], filename))
+
+    def expand_filenames(self, filenames):
+        """
+        Expand a filename, list of filenames, or glob patterns into entries in the lockfile.
+
+        Glob patterns only match files, not the directories that contain them. Patterns
+        that do not match anything are returned unchanged so that they can be reported.
+        """
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        expanded = []
+        dirs = None
+        for pattern in filenames:
+            if not any(c in pattern for c in '*?['):
+                expanded.append(pattern)
+                continue
+            if dirs is None:
+                if self.locks.sparse:
+                    index = self.package_index()
+                    files = sorted(index.files | set(self.locks))
+                    dirs = index.dirs
+                else:
+                    files = self.locks
+                    dirs = set([os.path.dirname(filename) for filename in self.locks])
+            matches = [filename for filename in fnmatch.filter(files, pattern)
+                       if filename not in dirs]
+            if len(matches)==0:
+                expanded.append(pattern)
+            expanded += matches
+        # Remove duplicates while preserving the order
+        return list(OrderedDict.fromkeys(expanded))
+
+    def transact(self, prepare, optimistic=False):
+        """
+        Pull the lockfile, prepare a set of lock changes and push them to the remote.
+
+        ``prepare`` is called after each pull and returns a ``(report, changes, commit_msg)``
+        tuple, where ``changes`` are the keyword arguments for `LockFile.write`
+        (for example ``{'locks': [modified locks]}``). If another client pushed
+        first, the new remote tip is fetched and the changes are prepared again on it (so
+        conflicts are checked again), straight away the first time and after waiting with
+        exponential backoff if the client keeps being rejected. If the commits that were
+        pushed first did not change any of the lockfiles (or shards) that were read, the
+        changes cannot conflict, so they are rebased onto the new tip without counting
+        as a retry (up to ``push_rebases`` times).
+
+        If ``optimistic`` is True and the lockfile is already loaded, the first attempt
+        skips the pull and relies on the remote to reject the push if it has changed.
+        The pull is only skipped if no other process committed to the lock repo since
+        the lockfile was loaded, since a push on top of that commit would not be rejected.
+        """
+        with utils.repo_lock(self.git_dir):
+            retries = self.config.get('push_retries', 8)
+            max_rebases = self.config.get('push_rebases', 32)
+            pulled = (optimistic and self.locks is not None and self.head is not None and
+                      self.head == self.local_tip())
+            attempt = 0
+            rebases = 0
+            while True:
+                if not pulled:
+                    self.update_all_locks()
+                pulled = False
+                with metrics.phase('prepare'):
+                    report, changes, commit_msg = prepare()
+                if not report.success or not any(changes.values()):
+                    return report
+                try:
+                    self.save_lockfile(commit_msg=commit_msg, rewind=False, **changes)
+                    return report
+                except gitlock.git_io.PushRejected as e:
+                    metrics.count('push_rejected')
+                    head, paths = self.head, [self.relpath(path) for path in self.locks.paths()]
+                    self.reset_to_remote()
+                    pulled = True
+                    if (rebases < max_rebases and
+                            len(gitlock.git_io.changed_paths(self.gitpath, head, self.head, paths))==0):
+                        # Only other lockfiles (or shards) were changed, so there is no conflict
+                        logger.info("{0}, rebasing onto {1}".format(e, self.head))
+                        metrics.count('rebased')
+                        rebases += 1
+                        continue
+                    if attempt == retries:
+                        break
+                    # The first retry prepares the changes again on the new tip straight
+                    # away, only a client that keeps losing backs off (and pulls again)
+                    delay = 0
+                    if attempt > 0:
+                        delay = gitlock.git_io.backoff_delay(attempt-1,
+                                                             self.config.get('backoff_base', 0.1),
+                                                             self.config.get('backoff_cap', 5.0))
+                        with metrics.phase('backoff'):
+                            time.sleep(delay)
+                        pulled = False
+                    logger.info("{0}, retrying after {1:.2f} seconds".format(e, delay))
+                    metrics.count('retries')
+                    attempt += 1
+            raise gitlock.git_io.GitError("Unable to push the lock changes after {0} attempts "
+                                          "because other users kept pushing first, no locks "
+                                          "were changed".format(retries+1))
+
+    def prepare_lock(self, filenames, username):
+        """
+        Check whether a set of files can be locked by ``username`` and update the locks
+        if all of them can be locked
+        """
+        report = Report('lock')
+        changed = []
+        filenames = self.expand_filenames(filenames)
+        # Only the shards of the lockfile that hold these files need to be loaded
+        self.locks.load_paths(filenames, [f for f in filenames if self.is_directory(f)])
+        for filename in filenames:
+            lock = self.get_lock(filename)
+            if lock is None:
+                report[filename] = ('missing', "could not be found in the lock file")
+                continue
             if lock.locked:
                 if lock.user==username:
-                    print("You have had '{0}' locked since {1}".format(filename, lock.time))
+                    report[filename] = ('held', "you have had it locked since {0}".format(lock.time))
                 else:
-                    print("Unable to get lock, '{0}' is currently locked by {1} since {2}".format(
-                          filename, lock.user, lock.time))
+                    report[filename] = ('locked', "locked by {0} since {1}".format(lock.user, lock.time))
             else:
-                lock.user = username
-                commit_msg = 'lock {0} by {1}'.format(filename, username)
-                got_lock = self.save_lockfile(lock, commit_msg)
-                print("Successfully locked {0}".format(filename))
-        return got_lock
-
-    def save_lockfile(self, lock, commit_msg):
-        """
-        Save a modified file's locked permission
-        """
-        idx = list(self.locks.keys()).index(lock.filename)
-        with open(self.lockfile_path, 'r') as f:
-            files = f.readlines()
-        old_files = files[:]
-        # Replace the selected file entry with a lock
-        lock.time = str(datetime.datetime.now())
-        files[idx] = '"' + '" "'.join([lock.filename, lock.user, lock.time]) + '"\n'
-        #Re-write the lock file
-        with open(self.lockfile_path, 'w+') as f:
-            f.write("".join(files))
+                conflicts = self.locks.trie.conflicts(filename, username)
+                parent = self.locks.trie.parent_lock(filename)
+                if len(conflicts)>0:
+                    msg = "conflicts with the lock on {0} by {1} since {2}".format(
+                        conflicts[0].filename, conflicts[0].user, conflicts[0].time)
+                    if len(conflicts)>1:
+                        msg += " (and {0} other locks)".format(len(conflicts)-1)
+                    report[filename] = ('locked', msg)
+                elif parent is not None:
+                    report[filename] = ('held', "covered by your lock on {0}".format(parent.filename))
+                else:
+                    changed.append(lock)
+                    report[filename] = ('granted', "locked")
+
+        report.success = all([status in ('granted', 'held') for status, msg in report.values()])
+        if not report.success:
+            for filename, (status, msg) in report.items():
+                if status == 'granted':
+                    report[filename] = ('available', "available, but not locked")
+            changed = []
+        lock_time = str(datetime.datetime.now())
+        for lock in changed:
+            lock.user = username
+            lock.time = lock_time
+            self.locks.trie.add(lock)
+        return report, {'locks': changed}, get_commit_msg('lock', changed, username)
+
+    def lock(self, filenames, username=None):
+        """
+        Attempt to lock one or more files, or files matching glob patterns.
+
+        The files are locked all-or-nothing in a single commit: if any file cannot be
+        found or is locked by another user, no locks are taken. Requests that other
+        processes on the host make at the same time are committed together (see
+        `gitlock.spool`).
+        """
+        import gitlock.spool
+
+        username = get_username(username)
+        report = gitlock.spool.submit(self, [('lock', filenames, username)])[0]
+        report.display()
+        return report
+
+    def prepare_requests(self, requests):
+        """
+        Prepare several lock and unlock requests, given as ``(action, filenames, username)``
+        tuples, to be committed together (a group commit). Each request is checked on top
+        of the requests before it and is applied all-or-nothing on its own.
+
+        Returns the report of each request, the combined changes and the commit message.
+        """
+        reports = []
+        changed = OrderedDict()
+        removed = OrderedDict()
+        commit_msgs = []
+        for action, filenames, username in requests:
+            if action == 'lock':
+                report, changes, commit_msg = self.prepare_lock(filenames, username)
+            elif action == 'unlock':
+                report, changes, commit_msg = self.prepare_unlock(filenames, username)
+            else:
+                raise ValueError("Unknown action {0}".format(action))
+            reports.append(report)
+            if len(changes['locks'])>0 or len(changes.get('removed', ()))>0:
+                commit_msgs.append(commit_msg)
+            for lock in changes['locks']:
+                removed.pop(lock.filename, None)
+                changed[lock.filename] = lock
+            for filename in changes.get('removed', ()):
+                changed.pop(filename, None)
+                if filename in self.locks:
+                    removed[filename] = True
+        if len(commit_msgs)==1:
+            commit_msg = commit_msgs[0]
+        else:
+            commit_msg = "Group commit of {0} requests\n\n{1}".format(
+                len(commit_msgs), "\n".join([msg.split('\n')[0] for msg in commit_msgs]))
+        return reports, {'locks': list(changed.values()), 'removed': list(removed)}, commit_msg
+
+    def save_lockfile(self, locks, commit_msg, removed=(), commit=None, rewind=True):
+        """
+        Save the modified locked permissions of one or more files in a single commit.
+        Optionally remove the entries for ``removed`` files and update the package
+        ``commit`` that the lockfile was built from.
+
+        If ``rewind`` is False and another client pushed first, the rejected commit is
+        left in the working tree for `reset_to_remote`.
+        """
+        if isinstance(locks, Lock):
+            locks = [locks]
+        with metrics.phase('write') as record:
+            undo = self.locks.write(locks, removed, commit)
+            record['bytes'] = self.locks.written
+        metrics.set_value('lockfile_bytes', self.locks.size)
         # Attempt to push the changes to the remote
-        error = gitlock.git_io.update_remote(commit_msg, self.lockfile_path, self.lock_repo)
+        error = self.push_lockfile(commit_msg, rewind)
         if error is not None:
+            if (not rewind and self.backend != 'plumbing' and
+                    isinstance(error, gitlock.git_io.PushRejected)):
+                raise error
             # Resore the lockfile if there was an error while saving
-            print("Restoring lockfile")
-            with open(self.lockfile_path, 'w+') as f:
-                f.write("".join(old_files))
+            logger.info("Restoring lockfile")
+            self.locks.restore(undo)
             raise error
         return True
 
-    def unlock(self, filename, username=None):
+    def push_lockfile(self, commit_msg, rewind=True):
         """
-        Unlock a file, if the file is locked by the current user
+        Commit the current lockfile and push it to the remote.
+
+        Returns None if the push was successful, otherwise the error (see
+        `gitlock.git_io.update_remote` for ``rewind``).
         """
-        unlocked = False
-        username = get_username(username)
-        locks = self.update_all_locks()
-        if filename not in locks:
-            raise Exception("Could not find {0} in the lock file".format(filename))
+        modified = self.locks.modified()
+        if self.backend == 'plumbing':
+            try:
+                files = OrderedDict([(self.relpath(path), lockfile.data())
+                                     for path, lockfile in modified.items()])
+                commit = gitlock.git_io.commit_files(self.gitpath, self.head, files, commit_msg)
+                gitlock.git_io.push_commit(self.gitpath, commit, self.branch, self.head)
+            except gitlock.git_io.GitError as e:
+                return e
+            self.head = commit
+            return None
+        error = gitlock.git_io.update_remote(commit_msg, list(modified), self.lock_repo, rewind=rewind,
+                                              branch=self.branch)
+        if error is None:
+            self.head = self.local_tip()
+        return error
 
-        lock = locks[filename]
-        if username!=lock.user:
-            if lock.locked:
-                print("You do not have a lock on {0}, it is currently locked by {1}".format(filename,
-                                                                                            lock.user))
+    def replace_lockfile(self, data, commit_msg):
+        """
+        Replace the whole lockfile with ``data`` (bytes) and push it to the remote
+        """
+        self.replace_lockfiles({self.lockfile_path: data}, commit_msg)
+
+    def temp_dir(self):
+        """
+        Directory for the temporary files of lockfiles that are being built, or None if
+        they are written next to the lockfiles (in the working tree of the lock repo) so
+        that they can be renamed into place
+        """
+        if self.backend == 'plumbing':
+            return os.path.dirname(utils.get_cache_path(self.git_dir, 'build', self.pkg, ''))
+        return None
+
+    def stale_lockfiles(self, files, head=None):
+        """
+        Paths of the lockfile and shards of the package in commit ``head`` of the lock
+        repo (or in the working tree) that are not in ``files``
+        """
+        return [path for path in self.lockfile_paths(head) if path not in files and
+                (self.backend == 'plumbing' or os.path.isfile(path))]
+
+    def replace_lockfiles(self, files, commit_msg):
+        """
+        Replace the lockfile and its shards with the contents (bytes) in ``files`` (see
+        `gitlock.lockfile.format_lockfiles`) and push them to the remote. Any other
+        shards of the lockfile are removed.
+        """
+        tmp_dir = self.temp_dir()
+        tmp_files = OrderedDict()
+        try:
+            for path, data in files.items():
+                tmp_files[path] = None
+                if data is None:
+                    continue
+                if tmp_dir is None:
+                    tmp_files[path] = '{0}.{1}.tmp'.format(path, os.getpid())
+                else:
+                    tmp_files[path] = os.path.join(tmp_dir, '{0}.tmp'.format(len(tmp_files)))
+                utils.create_path(os.path.dirname(tmp_files[path]))
+                with open(tmp_files[path], 'wb') as f:
+                    f.write(data)
+        except:
+            for tmp_path in tmp_files.values():
+                if tmp_path is not None and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            raise
+        self.install_lockfiles(tmp_files, commit_msg)
+
+    def install_lockfiles(self, files, commit_msg, head=None):
+        """
+        Replace lockfiles with the temporary files in ``files``, by path of the lockfile
+        (see `gitlock.lockfile.LockfileWriter`), and push them to the remote. A path
+        mapped to None is removed. If the lockfile of the package is replaced, any other
+        shards of it are removed too (and the directory of the shards, once it is empty).
+
+        In the working tree the old lockfiles are moved aside and the new ones renamed
+        into place, so they are never copied in memory. With the plumbing backend the
+        files are stored as blobs on top of ``head`` (by default the commit the locks were
+        loaded from, or the fetched tip). The temporary files are always removed.
+        """
+        try:
+            if self.backend == 'plumbing' and head is None:
+                if self.locks is not None:
+                    # Only replace the lockfiles that ``files`` were built from
+                    head = self.head
+                else:
+                    head = gitlock.git_io.fetch(self.gitpath, self.branch, self.fetch_depth)
+            files = OrderedDict(files)
+            if self.lockfile_path in files:
+                for path in self.stale_lockfiles(files, head):
+                    files[path] = None
+            size = sum([os.path.getsize(tmp_path) for tmp_path in files.values() if tmp_path is not None])
+            metrics.set_value('lockfile_bytes', size)
+            self.locks = None
+            if self.backend == 'plumbing':
+                paths = [path for path, tmp_path in files.items() if tmp_path is not None]
+                with metrics.phase('commit', bytes=size):
+                    blobs = OrderedDict([(self.relpath(path), None) for path in files])
+                    ids = gitlock.git_io.hash_files(self.gitpath, [files[path] for path in paths])
+                    for path, blob in zip(paths, ids):
+                        blobs[self.relpath(path)] = blob
+                    commit = gitlock.git_io.commit_blobs(self.gitpath, head, blobs, commit_msg)
+                gitlock.git_io.push_commit(self.gitpath, commit, self.branch, head)
+                return
+            # Move the old lockfiles aside as a backup
+            backups = OrderedDict()
+            error = None
+            try:
+                with metrics.phase('write', bytes=size):
+                    for path, tmp_path in files.items():
+                        backups[path] = None
+                        if os.path.isfile(path):
+                            backups[path] = '{0}.{1}.bak'.format(path, os.getpid())
+                            os.replace(path, backups[path])
+                        if tmp_path is not None:
+                            utils.create_path(os.path.dirname(path))
+                            os.replace(tmp_path, path)
+                # Attempt to push the changes to the remote
+                error = gitlock.git_io.update_remote(commit_msg, list(files), self.lock_repo,
+                                                      branch=self.branch)
+            except BaseException as e:
+                error = e
+            if error is not None:
+                # Resore the lockfiles if there was an error while saving
+                logger.info("Restoring lockfile")
+                for path, backup in backups.items():
+                    if backup is not None:
+                        os.replace(backup, path)
+                    elif os.path.isfile(path):
+                        os.remove(path)
+                raise error
+            for backup in backups.values():
+                if backup is not None:
+                    os.remove(backup)
+            # Remove the shard directory if all of its shards were removed
+            for directory in set([os.path.dirname(path) for path, tmp_path in files.items()
+                                  if tmp_path is None]):
+                if os.path.isdir(directory) and len(os.listdir(directory))==0:
+                    os.rmdir(directory)
+        finally:
+            for tmp_path in files.values():
+                if tmp_path is not None and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def prepare_unlock(self, filenames, username):
+        """
+        Check whether a set of files can be unlocked by ``username`` and update the locks
+        if all of them can be unlocked
+        """
+        report = Report('unlock')
+        changed = []
+        filenames = self.expand_filenames(filenames)
+        # Only the shards of the lockfile that hold these files need to be loaded
+        self.locks.load_paths(filenames, [f for f in filenames if self.is_directory(f)])
+        for filename in filenames:
+            lock = self.get_lock(filename)
+            if lock is None:
+                report[filename] = ('missing', "could not be found in the lock file")
+                continue
+            if username!=lock.user:
+                if lock.locked:
+                    report[filename] = ('locked', "you do not have a lock, it is currently "
+                                                  "locked by {0}".format(lock.user))
+                else:
+                    parent = self.locks.trie.parent_lock(filename)
+                    if parent is None:
+                        report[filename] = ('unlocked', "already unlocked")
+                    else:
+                        report[filename] = ('unlocked', "not locked itself, but covered by the "
+                                            "lock on {0} by {1}".format(parent.filename, parent.user))
             else:
-                print("'{0}' is already unlocked")
-        else:
+                changed.append(lock)
+                report[filename] = ('released', "unlocked")
+
+        report.success = all([status in ('released', 'unlocked') for status, msg in report.values()])
+        if not report.success:
+            for filename, (status, msg) in report.items():
+                if status == 'released':
+                    report[filename] = ('held', "still locked by you")
+            changed = []
+        lock_time = str(datetime.datetime.now())
+        for lock in changed:
+            self.locks.trie.remove(lock.filename)
+        commit_msg = get_commit_msg('unlock', changed, username)
+        if self.locks.sparse:
+            # Only locked files have rows in a sparse lockfile
+            return report, {'locks': [], 'removed': [lock.filename for lock in changed]}, commit_msg
+        for lock in changed:
             lock.user = "None"
-            commit_msg = "unlock {0} by {1}".format(filename, username)
-            unlocked = self.save_lockfile(lock, commit_msg)
-            print("'{0}' has successfully been unlocked".format(filename))
-        return unlocked
+            lock.time = lock_time
+        return report, {'locks': changed}, commit_msg
 
+    def unlock(self, filenames, username=None):
+        """
+        Unlock one or more files, or files matching glob patterns, if they are locked by
+        the current user.
+
+        The files are unlocked all-or-nothing in a single commit: if any file cannot be
+        found or is locked by another user, no locks are released. Requests that other
+        processes on the host make at the same time are committed together (see
+        `gitlock.spool`).
+        """
+        import gitlock.spool
+
+        username = get_username(username)
+        report = gitlock.spool.submit(self, [('unlock', filenames, username)])[0]
+        report.display()
+        return report
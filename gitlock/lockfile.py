@@ -0,0 +1,789 @@
+import io
+import os
+import zlib
+import contextlib
+from urllib.parse import quote, unquote
+from collections import OrderedDict
+
+# Width reserved for the user and time fields of each record. The time field is padded
+# with spaces (inside its quotes, so that each row still has exactly three fields) to
+# this width, so that a lock can be changed by rewriting only its own bytes.
+USER_WIDTH = 40
+TIME_WIDTH = 26
+# Width of the header row (long enough for a SHA-256 commit id)
+HEADER_WIDTH = len('# commit ') + 64
+# Header row of lockfiles that only have rows for the files that are locked
+SPARSE_HEADER = '# format sparse'
+# Key of the shard for the files at the top of the package. Git does not allow '.' as a
+# path component and `quote` does not escape it, so this never clashes with a directory.
+ROOT_SHARD = '%2E'
+
+class Lock(object):
+    def __init__(self, repo, filename, user, time):
+        self.filename = filename
+        self.user = user
+        self.time = time
+
+    @property
+    def locked(self):
+        return self.user != 'None'
+
+class PathTrie(object):
+    """
+    Trie of locked paths.
+
+    A lock on a directory covers every file under it, so a path conflicts with locks
+    on any of its parent directories and on any path below it. Each node counts the
+    locks held by each user in its subtree, so that both checks take O(path depth).
+    """
+    def __init__(self, locks=()):
+        self.root = {'children': {}, 'lock': None, 'holders': {}}
+        for lock in locks:
+            self.add(lock)
+
+    def _walk(self, filename, create=False):
+        """
+        List of the nodes from the root to ``filename``, or None if the path is not
+        in the trie (and ``create`` is False)
+        """
+        nodes = [self.root]
+        for part in filename.split('/'):
+            children = nodes[-1]['children']
+            if part not in children:
+                if not create:
+                    return None
+                children[part] = {'children': {}, 'lock': None, 'holders': {}}
+            nodes.append(children[part])
+        return nodes
+
+    def add(self, lock):
+        nodes = self._walk(lock.filename, create=True)
+        if nodes[-1]['lock'] is not None:
+            self.remove(lock.filename)
+        for node in nodes:
+            node['holders'][lock.user] = node['holders'].get(lock.user, 0) + 1
+        nodes[-1]['lock'] = lock
+
+    def remove(self, filename):
+        nodes = self._walk(filename)
+        if nodes is None or nodes[-1]['lock'] is None:
+            return
+        user = nodes[-1]['lock'].user
+        for node in nodes:
+            node['holders'][user] -= 1
+            if node['holders'][user] == 0:
+                del node['holders'][user]
+        nodes[-1]['lock'] = None
+
+    def parent_lock(self, filename):
+        """
+        The lock on the closest parent directory of ``filename``, if there is one
+        """
+        node = self.root
+        lock = None
+        for part in filename.split('/')[:-1]:
+            node = node['children'].get(part)
+            if node is None:
+                break
+            if node['lock'] is not None:
+                lock = node['lock']
+        return lock
+
+    def conflicts(self, filename, username):
+        """
+        List of the locks held by users other than ``username`` that conflict with a lock
+        on ``filename``: locks on its parent directories, on the path itself, and on
+        anything below it
+        """
+        conflicts = []
+        node = self.root
+        for part in filename.split('/'):
+            node = node['children'].get(part)
+            if node is None:
+                return conflicts
+            if node['lock'] is not None and node['lock'].user != username:
+                conflicts.append(node['lock'])
+        below = sum([count for user, count in node['holders'].items() if user != username])
+        if node['lock'] is not None and node['lock'].user != username:
+            below -= 1
+        if below > 0:
+            # Only walk the subtree to report the conflicts when there are any
+            stack = list(node['children'].values())
+            while len(stack)>0:
+                child = stack.pop()
+                if child['lock'] is not None and child['lock'].user != username:
+                    conflicts.append(child['lock'])
+                stack += [c for c in child['children'].values() if
+                          any([user != username for user in c['holders']])]
+        return conflicts
+
+def record_width(filename):
+    """
+    Minimum width (in bytes) of a record for a given filename
+    """
+    return len(filename.encode('utf-8')) + len('"" "" ""') + USER_WIDTH + TIME_WIDTH
+
+def format_row(filename, user, time, width=None):
+    """
+    Format a row of the lockfile, padded with spaces to ``width`` bytes.
+    If ``width`` is None the row is padded to the record width for the filename.
+
+    The padding is added to the end of the quoted time field, so readers that split
+    the row into three quoted fields (like older versions of gitlock) still can.
+    """
+    row = '"{0}" "{1}" "{2}"'.format(filename, user, time)
+    if width is None:
+        width = record_width(filename)
+    return row[:-1] + ' '*(width-len(row.encode('utf-8'))) + '"'
+
+class PackageIndex(object):
+    """
+    Paths of the files and directories in a commit of a package.
+
+    The paths are listed with ``git ls-tree`` and cached in ``cache_path``, so that the
+    package is only listed again when the commit changes.
+    """
+    def __init__(self, pkg_path, commit, cache_path=None):
+        import gitlock.git_io
+
+        self.commit = commit
+        data = None
+        if cache_path is not None and os.path.isfile(cache_path):
+            with open(cache_path, 'rb') as f:
+                data = f.read()
+            if not data.startswith(commit.encode('utf-8')+b'\0'):
+                data = None
+        if data is None:
+            entries = [commit.encode('utf-8')]
+            for entry in gitlock.git_io.run(pkg_path, 'ls-tree', '-r', '-t', '-z', commit).split(b'\0'):
+                if entry != b'':
+                    info, path = entry.split(b'\t', 1)
+                    entries.append((b'd' if info.split()[1] == b'tree' else b'f') + path)
+            data = b'\0'.join(entries)
+            if cache_path is not None:
+                tmp_path = '{0}.{1}.tmp'.format(cache_path, os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, cache_path)
+        self.files = set()
+        self.dirs = set()
+        for entry in data.split(b'\0')[1:]:
+            if entry[:1] == b'd':
+                self.dirs.add(entry[1:].decode('utf-8'))
+            else:
+                self.files.add(entry[1:].decode('utf-8'))
+
+    def __contains__(self, path):
+        return path in self.files or path in self.dirs
+
+def shard_key(filename, shards):
+    """
+    Key of the shard that the row for ``filename`` is stored in. ``shards`` is a
+    ``(method, size)`` tuple: with the 'prefix' method the key is the directory of the
+    file truncated to ``size`` levels, with the 'hash' method it is one of ``size``
+    shards chosen by a hash of the path.
+    """
+    method, size = shards
+    if method == 'hash':
+        return '{0:03d}'.format(zlib.crc32(filename.encode('utf-8')) % size)
+    prefix = '/'.join(filename.split('/')[:-1][:size])
+    if prefix == '':
+        return ROOT_SHARD
+    return quote(prefix, safe='')
+
+def parse_shards(spec):
+    """
+    Parse a shard specification like ``prefix:1`` or ``hash:16`` into a ``(method, size)``
+    tuple, or None for ``none``
+    """
+    if spec is None or spec == 'none':
+        return None
+    method, size = spec.split(':') if ':' in spec else (spec, 1 if spec == 'prefix' else 16)
+    if method not in ('prefix', 'hash'):
+        raise ValueError("Unknown shard method {0}, use 'prefix' or 'hash'".format(method))
+    return (method, int(size))
+
+def format_shards(shards):
+    """
+    Format the header row that records how a lockfile is sharded
+    """
+    return '# shards {0} {1}'.format(*shards)
+
+def format_lockfiles(path, rows, commit=None, sparse=False, shards=None):
+    """
+    Format a lockfile with a list of ``(filename, user, time)`` rows. If ``shards`` is
+    not None the rows are split into shards (see `ShardedLockFile`).
+
+    Return an OrderedDict with the contents of each file, by path.
+    """
+    header = []
+    if commit is not None:
+        header.append(format_header(commit))
+    if sparse:
+        header.append(SPARSE_HEADER)
+    if shards is None:
+        data = '\n'.join(header+[format_row(*row) for row in rows])
+        return OrderedDict([(path, data.encode('utf-8'))])
+    header.append(format_shards(shards))
+    files = OrderedDict([(path, '\n'.join(header).encode('utf-8'))])
+    groups = OrderedDict()
+    for row in rows:
+        groups.setdefault(shard_key(row[0], shards), []).append(format_row(*row))
+    for key, shard_rows in groups.items():
+        files[ShardedLockFile.shard_path(path, key)] = '\n'.join(shard_rows).encode('utf-8')
+    return files
+
+class LockfileWriter(object):
+    """
+    Write a lockfile (and its shards) one row at a time to temporary files, so that
+    lockfiles for packages of any size can be built with constant memory. The files are
+    the same as the ones formatted by `format_lockfiles`.
+
+    The temporary files are created next to the lockfiles, so that they can be renamed
+    into place atomically, or in ``tmp_dir`` if it is given. At most ``max_open`` shards
+    are kept open at the same time.
+    """
+    def __init__(self, path, commit=None, sparse=False, shards=None, tmp_dir=None, max_open=64):
+        self.path = path
+        self.shards = shards
+        self.tmp_dir = tmp_dir
+        self.max_open = max_open
+        self.files = OrderedDict()
+        self.started = set()
+        self.open_files = OrderedDict()
+        self.rows = 0
+        self.bytes = 0
+        header = []
+        if commit is not None:
+            header.append(format_header(commit))
+        if sparse:
+            header.append(SPARSE_HEADER)
+        if shards is not None:
+            header.append(format_shards(shards))
+        for line in header:
+            self._write(path, line)
+
+    def temp_path(self, path):
+        """
+        Path of the temporary file that a lockfile is written to
+        """
+        if self.tmp_dir is None:
+            return '{0}.{1}.tmp'.format(path, os.getpid())
+        return os.path.join(self.tmp_dir, '{0}.tmp'.format(len(self.files)))
+
+    def _open(self, path):
+        f = self.open_files.pop(path, None)
+        if f is None:
+            if path not in self.files:
+                self.files[path] = self.temp_path(path)
+                os.makedirs(os.path.dirname(self.files[path]), exist_ok=True)
+                f = open(self.files[path], 'wb')
+            else:
+                f = open(self.files[path], 'ab')
+            if len(self.open_files) >= self.max_open:
+                self.open_files.popitem(last=False)[1].close()
+        self.open_files[path] = f
+        return f
+
+    def _write(self, path, line):
+        data = line.encode('utf-8')
+        if path in self.started:
+            data = b'\n' + data
+        else:
+            self.started.add(path)
+        self._open(path).write(data)
+        self.bytes += len(data)
+
+    def write(self, filename, user, time):
+        """
+        Add the row for a file
+        """
+        path = self.path
+        if self.shards is not None:
+            path = ShardedLockFile.shard_path(self.path, shard_key(filename, self.shards))
+        self._write(path, format_row(filename, user, time))
+        self.rows += 1
+
+    def close(self):
+        """
+        Finish writing and return an OrderedDict with the path of the temporary file of
+        each lockfile, by the path of the lockfile
+        """
+        self._open(self.path)
+        for f in self.open_files.values():
+            f.close()
+        self.open_files.clear()
+        return self.files
+
+    def abort(self):
+        """
+        Remove the temporary files
+        """
+        self.close()
+        for tmp_path in self.files.values():
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+def format_header(commit):
+    """
+    Format the header row that records the package commit the lockfile was built from
+    """
+    header = '# commit {0}'.format(commit)
+    return header + ' '*(HEADER_WIDTH-len(header))
+
+def parse_row(line):
+    """
+    Split a row of the lockfile into its ``(filename, user, time)`` fields.
+    Return None for blank lines.
+    """
+    fields = line.strip().split(b'" "', 2)
+    if len(fields) != 3:
+        return None
+    return [fields[0][1:].decode('utf-8'), fields[1].decode('utf-8'),
+            fields[2][:-1].rstrip(b' ').decode('utf-8')]
+
+class LockFile(object):
+    """
+    Indexed view of a lockfile on disk.
+
+    Loading the lockfile only builds an index of the byte offset of each row and
+    materializes `Lock` objects for the files that are currently locked. Locks for other
+    files are created on demand and changes are written in place, so that changing a
+    lock only touches the bytes of its own row. Removed rows are blanked out and new
+    rows are appended to the end of the file.
+
+    An optional header row records the commit of the package that the lockfile was
+    built from. A sparse lockfile (with a ``# format sparse`` header row) only has rows
+    for the files that are locked, the other files of the package are unlocked.
+
+    If ``data`` is given the lockfile is kept in memory (for example when it was read
+    directly from a git object) instead of being read from and written to ``path``.
+    If ``missing_ok`` is True a lockfile that does not exist yet is empty.
+    """
+    def __init__(self, path, data=None, missing_ok=False):
+        self.path = path
+        self.buffer = None if data is None else io.BytesIO(data)
+        self.missing_ok = missing_ok
+        self.load()
+
+    @contextlib.contextmanager
+    def open(self, mode='rb'):
+        """
+        Open the lockfile on disk, or the in-memory buffer
+        """
+        if self.buffer is None:
+            if self.missing_ok and not os.path.exists(self.path):
+                if mode == 'rb':
+                    yield io.BytesIO()
+                    return
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                mode = mode.replace('r+', 'w+')
+            with open(self.path, mode) as f:
+                yield f
+        else:
+            if 'w' in mode:
+                self.buffer = io.BytesIO()
+            self.buffer.seek(0)
+            yield self.buffer
+
+    def data(self):
+        """
+        Contents of the lockfile
+        """
+        with self.open('rb') as f:
+            return f.read()
+
+    def load(self):
+        """
+        Build the index of rows in the lockfile
+        """
+        self.index = OrderedDict()
+        self._locks = {}
+        self.commit = None
+        self.sparse = False
+        self.shards = None
+        self.changed = False
+        self.written = 0
+        self.blank = 0
+        self._header = None
+        self._trie = None
+        offset = 0
+        line = b''
+        with self.open('rb') as f:
+            for line in f:
+                fields = line.split(b'" "', 2)
+                if len(fields)==3:
+                    filename = fields[0].lstrip()[1:].decode('utf-8')
+                    self.index[filename] = (offset, len(line.rstrip(b'\n')))
+                    if fields[1] != b'None':
+                        self._locks[filename] = Lock(None, *parse_row(line))
+                elif line.startswith(b'# commit '):
+                    self.commit = line.split()[2].decode('utf-8')
+                    self._header = (offset, len(line.rstrip(b'\n')))
+                elif line.rstrip() == SPARSE_HEADER.encode('utf-8'):
+                    self.sparse = True
+                elif line.startswith(b'# shards '):
+                    method, size = line.split()[2:4]
+                    self.shards = (method.decode('utf-8'), int(size))
+                elif line.strip() == b'':
+                    self.blank += len(line)
+                offset += len(line)
+        self.size = offset
+        self._newline = line.endswith(b'\n')
+
+    def __contains__(self, filename):
+        return filename in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, filename):
+        if filename not in self._locks:
+            offset, length = self.index[filename]
+            with self.open('rb') as f:
+                f.seek(offset)
+                self._locks[filename] = Lock(None, *parse_row(f.read(length)))
+        return self._locks[filename]
+
+    @property
+    def trie(self):
+        """
+        `PathTrie` of the locked files, built the first time it is needed
+        """
+        if self._trie is None:
+            self._trie = PathTrie(self.locked().values())
+        return self._trie
+
+    def locked(self):
+        """
+        OrderedDict of the locks that are currently held, in lockfile order
+        """
+        locks = sorted([lock for lock in self._locks.values() if lock.locked],
+                       key=lambda lock: self.index[lock.filename][0])
+        return OrderedDict([(lock.filename, lock) for lock in locks])
+
+    def load_paths(self, filenames, directories=()):
+        """
+        Make sure that the rows needed to check the locks on a set of files are loaded.
+        All of the rows of a single lockfile are always loaded (see `ShardedLockFile`).
+        """
+        pass
+
+    def paths(self):
+        """
+        Paths of the lockfiles that have been read
+        """
+        return [self.path]
+
+    def modified(self):
+        """
+        OrderedDict of the lockfiles (by path) that have been written since they were loaded
+        """
+        return OrderedDict([(self.path, self)] if self.changed else [])
+
+    def write(self, locks, removed=(), commit=None):
+        """
+        Write the rows for a set of modified (or new) locks, remove the rows of the
+        ``removed`` filenames and, if ``commit`` is not None, update the package commit
+        in the header.
+
+        Return the information needed to `restore` the previous rows.
+        """
+        self._trie = None
+        rows = []
+        new_rows = []
+        for lock in locks:
+            self._locks[lock.filename] = lock
+            if lock.filename in self.index:
+                offset, length = self.index[lock.filename]
+                row = format_row(lock.filename, lock.user, lock.time, width=length)
+                rows.append((offset, length, row.encode('utf-8')))
+            else:
+                new_rows.append(lock)
+        for filename in removed:
+            offset, length = self.index[filename]
+            rows.append((offset, length, b' '*length))
+        if commit is not None:
+            self.commit = commit
+            if self._header is not None:
+                offset, length = self._header
+                rows.append((offset, length, format_header(commit).encode('utf-8')))
+
+        blank = self.blank + sum([length for offset, length, row in rows if row.strip() == b''])
+        if (any([len(row)>length for offset, length, row in rows]) or
+                (commit is not None and self._header is None) or
+                (len(removed)>0 and blank > self.size//2)):
+            # Rows from older lockfiles are not padded (and have no header),
+            # so rewrite the whole file with fixed width records. The file is also
+            # compacted when more than half of it is blank rows.
+            old = self.data()
+            self.rewrite(removed)
+            self.changed = True
+            self.written = self.size
+            return [(None, old)]
+
+        undo = []
+        size = self.size
+        with self.open('r+b') as f:
+            for offset, length, row in rows:
+                f.seek(offset)
+                undo.append((offset, f.read(length)))
+                f.seek(offset)
+                f.write(row)
+            if len(new_rows)>0:
+                undo.append((self.size, None))
+                f.seek(self.size)
+                offset = self.size
+                if self.size>0 and not self._newline:
+                    f.write(b'\n')
+                    offset += 1
+                for n, lock in enumerate(new_rows):
+                    row = format_row(lock.filename, lock.user, lock.time).encode('utf-8')
+                    if n>0:
+                        f.write(b'\n')
+                        offset += 1
+                    f.write(row)
+                    self.index[lock.filename] = (offset, len(row))
+                    offset += len(row)
+                self.size = offset
+                self._newline = False
+        for filename in removed:
+            del self.index[filename]
+            self._locks.pop(filename, None)
+        self.blank = blank
+        self.changed = True
+        self.written = sum([len(row) for offset, length, row in rows]) + self.size-size
+        return undo
+
+    def restore(self, undo):
+        """
+        Restore the rows replaced by `write`
+        """
+        if len(undo)==1 and undo[0][0] is None:
+            with self.open('wb') as f:
+                f.write(undo[0][1])
+        else:
+            with self.open('r+b') as f:
+                for offset, data in reversed(undo):
+                    if data is None:
+                        f.truncate(offset)
+                    else:
+                        f.seek(offset)
+                        f.write(data)
+        if self.missing_ok and self.buffer is None and os.path.getsize(self.path)==0:
+            # The lockfile did not exist before it was written
+            os.remove(self.path)
+        self.load()
+
+    def rewrite(self, removed=()):
+        """
+        Rewrite the whole lockfile with padded records, including any modified or new
+        locks and the header
+        """
+        removed = set(removed)
+        written = set()
+        if self.buffer is None:
+            tmp_path = self.path+'.tmp'
+            dst = open(tmp_path, 'wb')
+        else:
+            dst = io.BytesIO()
+        with self.open('rb') as src:
+            sep = b''
+            if self.commit is not None:
+                dst.write(format_header(self.commit).encode('utf-8'))
+                sep = b'\n'
+            if self.sparse:
+                dst.write(sep+SPARSE_HEADER.encode('utf-8'))
+                sep = b'\n'
+            if self.shards is not None:
+                dst.write(sep+format_shards(self.shards).encode('utf-8'))
+                sep = b'\n'
+            for line in src:
+                row = parse_row(line)
+                if row is None or row[0] in removed:
+                    continue
+                if row[0] in self._locks:
+                    lock = self._locks[row[0]]
+                    row = [lock.filename, lock.user, lock.time]
+                written.add(row[0])
+                dst.write(sep+format_row(*row).encode('utf-8'))
+                sep = b'\n'
+            for filename, lock in self._locks.items():
+                if filename not in written and filename not in removed:
+                    dst.write(sep+format_row(lock.filename, lock.user, lock.time).encode('utf-8'))
+                    sep = b'\n'
+        if self.buffer is None:
+            dst.close()
+            os.replace(tmp_path, self.path)
+        else:
+            self.buffer = dst
+        self.load()
+
+class ShardedLockFile(object):
+    """
+    Lock table of a package split into several lockfiles (shards).
+
+    The main lockfile only has the header rows, including a ``# shards <method> <size>``
+    row, and the rows of each file are stored in the shard ``locks/<key>.txt`` next to it
+    (see `shard_key`). Shards are only loaded when they are needed, so that checking and
+    changing a lock only reads and writes the shards involved. Otherwise it can be used
+    like a `LockFile`.
+
+    If the lockfiles are kept in memory, ``read`` is a function that returns the
+    contents of a lockfile by path (or None if it does not exist) and ``listdir`` a
+    function that lists the names of the files in a directory.
+    """
+    def __init__(self, manifest, read=None, listdir=None):
+        self.path = manifest.path
+        self.manifest = manifest
+        self.shards = manifest.shards
+        self.sparse = manifest.sparse
+        self.commit = manifest.commit
+        self.read = read
+        self.listdir = listdir
+        self.loaded = OrderedDict()
+        self.written = 0
+        self._trie = None
+
+    @staticmethod
+    def shard_path(path, key):
+        """
+        Path of the shard with a given key for the main lockfile at ``path``
+        """
+        return os.path.join(os.path.dirname(path), 'locks', key+'.txt')
+
+    def keys(self):
+        """
+        Keys of all of the shards that exist
+        """
+        shard_dir = os.path.dirname(self.shard_path(self.path, ROOT_SHARD))
+        if self.listdir is not None:
+            names = self.listdir(shard_dir)
+        elif os.path.isdir(shard_dir):
+            names = os.listdir(shard_dir)
+        else:
+            names = []
+        return sorted(set([name[:-len('.txt')] for name in names if name.endswith('.txt')] +
+                          list(self.loaded)))
+
+    def shard(self, key):
+        """
+        `LockFile` of a shard, loaded the first time that it is needed
+        """
+        if key not in self.loaded:
+            path = self.shard_path(self.path, key)
+            if self.read is None:
+                self.loaded[key] = LockFile(path, missing_ok=True)
+            else:
+                self.loaded[key] = LockFile(path, self.read(path) or b'')
+            self._trie = None
+        return self.loaded[key]
+
+    def load_paths(self, filenames, directories=()):
+        """
+        Load the shards needed to check the locks on a set of files: the shards of the
+        files and their parent directories and, for ``directories``, the shards of all
+        of the files inside them
+        """
+        keys = set()
+        for filename in filenames:
+            path = filename
+            while path != '':
+                keys.add(shard_key(path, self.shards))
+                path = os.path.dirname(path)
+        if len(directories)>0:
+            if self.shards[0] == 'hash':
+                keys.update(self.keys())
+            else:
+                for key in self.keys():
+                    prefix = '' if key == ROOT_SHARD else unquote(key)
+                    if any([prefix == d or prefix.startswith(d+'/') for d in directories]):
+                        keys.add(key)
+        for key in sorted(keys):
+            self.shard(key)
+
+    def paths(self):
+        return [self.path] + [shard.path for shard in self.loaded.values()]
+
+    def modified(self):
+        files = OrderedDict()
+        for lockfile in [self.manifest] + list(self.loaded.values()):
+            if lockfile.changed:
+                files[lockfile.path] = lockfile
+        return files
+
+    @property
+    def size(self):
+        return self.manifest.size + sum([shard.size for shard in self.loaded.values()])
+
+    def __contains__(self, filename):
+        return filename in self.shard(shard_key(filename, self.shards))
+
+    def __getitem__(self, filename):
+        return self.shard(shard_key(filename, self.shards))[filename]
+
+    def __iter__(self):
+        for key in self.keys():
+            for filename in self.shard(key):
+                yield filename
+
+    def __len__(self):
+        return sum([len(self.shard(key)) for key in self.keys()])
+
+    @property
+    def trie(self):
+        """
+        `PathTrie` of the locked files in the shards that have been loaded
+        """
+        if self._trie is None:
+            self._trie = PathTrie([lock for shard in self.loaded.values()
+                                   for lock in shard.locked().values()])
+        return self._trie
+
+    def locked(self):
+        """
+        OrderedDict of the locks that are currently held, in all of the shards
+        """
+        locks = OrderedDict()
+        for key in self.keys():
+            locks.update(self.shard(key).locked())
+        return locks
+
+    def write(self, locks, removed=(), commit=None):
+        """
+        Write the modified locks (and remove the ``removed`` rows) in the shards that
+        they belong to and, if ``commit`` is not None, update the header of the main
+        lockfile. Return the information needed to `restore` the previous rows.
+        """
+        self._trie = None
+        changes = OrderedDict()
+        for lock in locks:
+            changes.setdefault(shard_key(lock.filename, self.shards), ([], []))[0].append(lock)
+        for filename in removed:
+            changes.setdefault(shard_key(filename, self.shards), ([], []))[1].append(filename)
+        undo = []
+        self.written = 0
+        for key, (shard_locks, shard_removed) in changes.items():
+            shard = self.shard(key)
+            undo.append((key, shard.write(shard_locks, shard_removed)))
+            self.written += shard.written
+        if commit is not None:
+            self.commit = commit
+            undo.append((None, self.manifest.write([], (), commit)))
+            self.written += self.manifest.written
+        return undo
+
+    def restore(self, undo):
+        """
+        Restore the rows replaced by `write`
+        """
+        for key, shard_undo in reversed(undo):
+            if key is None:
+                self.manifest.restore(shard_undo)
+                self.commit = self.manifest.commit
+            else:
+                self.loaded[key].restore(shard_undo)
+        self._trie = None
@@ -0,0 +1,194 @@
+"""
+Timing and profiling of gitlock operations.
+
+Each phase of an operation (pulling the lock repo, parsing and writing the lockfile,
+committing and pushing) is timed with `phase`. The totals for each phase are kept in
+memory (see `summary` and `display`) and each finished phase is also sent to the
+registered sinks, for example a `JsonLinesSink` that writes one JSON object per line
+for a monitoring system.
+"""
+import os
+import re
+import sys
+import json
+import time
+import logging
+import importlib
+import threading
+import contextlib
+from collections import OrderedDict
+
+logger = logging.getLogger('gitlock.metrics')
+
+class JsonLinesSink(object):
+    """
+    Sink that writes each record as a line of JSON to a stream or (appends it to) a file
+    """
+    def __init__(self, stream):
+        if isinstance(stream, str):
+            stream = open(stream, 'a')
+            self.owned = True
+        else:
+            self.owned = False
+        self.stream = stream
+
+    def __call__(self, record):
+        self.stream.write(json.dumps(record)+'\n')
+        self.stream.flush()
+
+    def close(self):
+        if self.owned:
+            self.stream.close()
+
+def load_sink(spec):
+    """
+    Load a metrics sink from a specification: ``-`` for JSON lines on stderr, ``module:name``
+    for a callable (that receives each record as a dict) in an importable module, or the
+    path of a file to append JSON lines to
+    """
+    if spec == '-':
+        return JsonLinesSink(sys.stderr)
+    if re.match(r'^[\w.]+:[\w.]+$', spec) and not os.path.exists(spec):
+        module_name, name = spec.split(':')
+        sink = importlib.import_module(module_name)
+        for attr in name.split('.'):
+            sink = getattr(sink, attr)
+        return sink
+    return JsonLinesSink(spec)
+
+class Metrics(object):
+    """
+    Collection of the phase timings, counters and values recorded by gitlock
+    """
+    def __init__(self):
+        self.sinks = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """
+        Clear all of the recorded metrics (the sinks are kept)
+        """
+        with self._lock:
+            self.phases = OrderedDict()
+            self.counters = OrderedDict()
+            self.values = OrderedDict()
+
+    def add_sink(self, sink):
+        """
+        Send each record to ``sink``, a callable that receives the record as a dict
+        """
+        self.sinks.append(sink)
+
+    def emit(self, record):
+        record['time'] = time.time()
+        record['pid'] = os.getpid()
+        for sink in self.sinks:
+            try:
+                sink(record)
+            except Exception as e:
+                logger.warning("Error sending metrics to {0}: {1}".format(sink, e))
+
+    @contextlib.contextmanager
+    def phase(self, name, **fields):
+        """
+        Time a phase of an operation. The record of the phase is yielded so that the
+        number of ``bytes`` (or other fields) can be set while the phase is running.
+        """
+        stack = self._local.__dict__.setdefault('stack', [])
+        record = OrderedDict([('type', 'phase'), ('phase', name),
+                              ('parent', stack[-1] if len(stack)>0 else None)])
+        record.update(fields)
+        with self._lock:
+            # Phases are listed in the order they start
+            if name not in self.phases:
+                self.phases[name] = OrderedDict([('depth', len(stack)), ('calls', 0),
+                                                 ('seconds', 0), ('bytes', None)])
+        stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            record['error'] = type(e).__name__
+            raise
+        finally:
+            stack.pop()
+            record['seconds'] = time.perf_counter()-start
+            with self._lock:
+                totals = self.phases.setdefault(name, OrderedDict([
+                    ('depth', len(stack)), ('calls', 0), ('seconds', 0), ('bytes', None)]))
+                totals['calls'] += 1
+                totals['seconds'] += record['seconds']
+                if record.get('bytes') is not None:
+                    totals['bytes'] = (totals['bytes'] or 0) + record['bytes']
+            if len(self.sinks)>0:
+                self.emit(record)
+
+    def count(self, name, n=1):
+        """
+        Increment a counter (for example the number of retries)
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set_value(self, name, value):
+        """
+        Record the latest value of a measurement (for example the size of the lockfile)
+        """
+        with self._lock:
+            self.values[name] = value
+        if len(self.sinks)>0:
+            self.emit(OrderedDict([('type', 'value'), ('name', name), ('value', value)]))
+
+    def summary(self):
+        """
+        Totals of all of the phases, counters and values recorded since the last reset
+        """
+        with self._lock:
+            return OrderedDict([
+                ('phases', OrderedDict([(name, OrderedDict([(k, v) for k, v in totals.items()
+                                                            if k != 'depth']))
+                                        for name, totals in self.phases.items()])),
+                ('counters', OrderedDict(self.counters)),
+                ('values', OrderedDict(self.values)),
+            ])
+
+    def display(self, stream=None):
+        """
+        Print a summary of the recorded metrics
+        """
+        stream = stream or sys.stderr
+        print("{0:<32}{1:>7}{2:>11}{3:>12}".format("phase", "calls", "seconds", "bytes"), file=stream)
+        with self._lock:
+            for name, totals in self.phases.items():
+                print("{0:<32}{1:>7}{2:>11.4f}{3:>12}".format(
+                    '  '*totals['depth']+name, totals['calls'], totals['seconds'],
+                    '' if totals['bytes'] is None else totals['bytes']), file=stream)
+            for name, value in list(self.counters.items())+list(self.values.items()):
+                print("{0:<32}{1}".format(name, value), file=stream)
+
+    def close(self):
+        """
+        Send the summary to the sinks and close them
+        """
+        if len(self.sinks)==0:
+            return
+        record = OrderedDict([('type', 'summary')])
+        record.update(self.summary())
+        self.emit(record)
+        for sink in self.sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+        self.sinks = []
+
+# Metrics recorded by this process
+metrics = Metrics()
+phase = metrics.phase
+count = metrics.count
+set_value = metrics.set_value
+add_sink = metrics.add_sink
+summary = metrics.summary
+display = metrics.display
+reset = metrics.reset
+close = metrics.close
@@ -0,0 +1,242 @@
+"""
+Operations on several packages of a lock repo at once.
+
+All of the packages in a lock repo share one branch, so a `MultiRepo` checks the remote
+and fetches (or pulls) the lock repo once for all of them, reads their lockfiles in a
+thread pool, and makes the lock changes to every package in a single commit and push.
+"""
+import os
+import time
+import logging
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import gitlock.utils as utils
+import gitlock.git_io
+import gitlock.metrics as metrics
+from gitlock.lock import Repo, get_username
+
+logger = logging.getLogger('gitlock.multi')
+
+def cancel(report):
+    """
+    Mark a successful report as not applied, because the request failed for another
+    package
+    """
+    for filename, (status, msg) in report.items():
+        if status == 'granted':
+            report[filename] = ('available', "available, but not locked")
+        elif status == 'released':
+            report[filename] = ('held', "still locked by you")
+    report.success = False
+
+class MultiRepo(object):
+    """
+    A set of packages in the same lock repo
+    """
+    def __init__(self, pkgs, gitpath=None):
+        self.gitpath = utils.get_gitpath(gitpath)
+        if len(pkgs)==0:
+            raise ValueError("No packages are configured in {0}".format(self.gitpath))
+        self.repos = OrderedDict([(pkg, Repo(pkg, self.gitpath)) for pkg in pkgs])
+        # The fetch, commit and push are made through the first package
+        self.repo = list(self.repos.values())[0]
+        for pkg, repo in self.repos.items():
+            if repo.branch != self.repo.branch or repo.backend != self.repo.backend:
+                raise gitlock.git_io.GitError(
+                    "The packages {0} and {1} use different branches or backends of the lock "
+                    "repo and cannot be changed together".format(self.repo.pkg, pkg))
+        self.config = self.repo.config
+        self.threads = self.config.get('threads', 8)
+        self.head = None
+
+    def map(self, func, pkgs=None):
+        """
+        Call ``func`` for the repo of each package (by default all of them) in a thread
+        pool and return the results by package
+        """
+        repos = [self.repos[pkg] for pkg in (pkgs or self.repos)]
+        if len(repos)==1:
+            return OrderedDict([(repos[0].pkg, func(repos[0]))])
+        with ThreadPoolExecutor(min(self.threads, len(repos))) as pool:
+            return OrderedDict(zip([repo.pkg for repo in repos], pool.map(func, repos)))
+
+    def read_locked(self, ttl=0, offline=False):
+        """
+        Load the locked files of every package for a read-only query (see
+        `Repo.read_locked`), with a single check of the remote and at most one fetch
+        """
+        if not offline and not self.repo.is_fresh(ttl):
+            self.repo.fetch_locks()
+        return self.map(lambda repo: repo.read_locked(offline=True))
+
+    def update_all_locks(self, pkgs=None):
+        """
+        Pull the lock repo once and load the lockfiles of the packages (by default all of them)
+        """
+        self.head = head = self.repo.pull_locks()
+
+        def load(repo):
+            if repo.locks is None or repo.head != head:
+                repo.load_lockfile(head)
+            return repo.locks
+        return self.map(load, pkgs)
+
+    def transact(self, prepares, commit_msg=None):
+        """
+        Pull the lock repo, prepare the lock changes of several packages and push them to
+        the remote in a single commit.
+
+        ``prepares`` maps packages to ``prepare`` functions (see `Repo.transact`). The
+        changes are only pushed if the reports of all of the packages are successful,
+        otherwise no package is changed. Returns the report of each package. If another
+        client pushed first, the changes are prepared again on the new tip (after a backoff
+        from the second retry on), and rebased without counting as a retry if none of the
+        lockfiles that were read changed. ``commit_msg`` replaces the combined commit message of the packages.
+        """
+        with utils.repo_lock(self.repo.git_dir):
+            retries = self.config.get('push_retries', 8)
+            max_rebases = self.config.get('push_rebases', 32)
+            pulled = False
+            attempt = 0
+            rebases = 0
+            while True:
+                if not pulled:
+                    self.update_all_locks(list(prepares))
+                pulled = False
+                results = OrderedDict()
+                with metrics.phase('prepare'):
+                    for pkg, prepare in prepares.items():
+                        results[pkg] = prepare()
+                reports = OrderedDict([(pkg, report) for pkg, (report, changes, msg) in results.items()])
+                if not all(reports.values()):
+                    for report in reports.values():
+                        cancel(report)
+                    # The successful packages were already changed in memory
+                    for repo in self.repos.values():
+                        repo.locks = None
+                    return reports
+                changes = OrderedDict([(pkg, changes) for pkg, (report, changes, msg) in results.items()
+                                       if any(changes.values())])
+                if len(changes)==0:
+                    return reports
+                msgs = [(pkg, results[pkg][2]) for pkg in changes]
+                if commit_msg is not None:
+                    msg = commit_msg
+                elif len(msgs)==1:
+                    msg = msgs[0][1]
+                else:
+                    msg = "Change locks in {0} packages\n\n{1}".format(len(msgs), "\n".join(
+                        ["{0}: {1}".format(pkg, pkg_msg.split('\n')[0]) for pkg, pkg_msg in msgs]))
+                try:
+                    self.save_lockfiles(changes, msg)
+                    return reports
+                except gitlock.git_io.PushRejected as e:
+                    metrics.count('push_rejected')
+                    head = self.head
+                    paths = [self.repo.relpath(path) for pkg in prepares
+                             for path in self.repos[pkg].locks.paths()]
+                    self.update_all_locks(list(prepares))
+                    pulled = True
+                    if (rebases < max_rebases and
+                            len(gitlock.git_io.changed_paths(self.gitpath, head, self.head, paths))==0):
+                        logger.info("{0}, rebasing onto {1}".format(e, self.head))
+                        metrics.count('rebased')
+                        rebases += 1
+                        continue
+                    if attempt == retries:
+                        break
+                    # As in `Repo.transact` only the later retries back off
+                    delay = 0
+                    if attempt > 0:
+                        delay = gitlock.git_io.backoff_delay(attempt-1,
+                                                             self.config.get('backoff_base', 0.1),
+                                                             self.config.get('backoff_cap', 5.0))
+                        with metrics.phase('backoff'):
+                            time.sleep(delay)
+                        pulled = False
+                    logger.info("{0}, retrying after {1:.2f} seconds".format(e, delay))
+                    metrics.count('retries')
+                    attempt += 1
+            raise gitlock.git_io.GitError("Unable to push the lock changes after {0} attempts "
+                                          "because other users kept pushing first, no locks "
+                                          "were changed".format(retries+1))
+
+    def save_lockfiles(self, changes, commit_msg):
+        """
+        Write the ``changes`` (keyword arguments of `LockFile.write`) of each package and
+        push all of them in a single commit
+        """
+        undo = OrderedDict()
+        with metrics.phase('write') as record:
+            for pkg, pkg_changes in changes.items():
+                locks = self.repos[pkg].locks
+                undo[pkg] = locks.write(pkg_changes.get('locks', []), pkg_changes.get('removed', ()),
+                                        pkg_changes.get('commit'))
+            record['bytes'] = sum([self.repos[pkg].locks.written for pkg in changes])
+        modified = OrderedDict()
+        for pkg in changes:
+            modified.update(self.repos[pkg].locks.modified())
+        head = self.head
+        error = None
+        if self.repo.backend == 'plumbing':
+            try:
+                files = OrderedDict([(self.repo.relpath(path), lockfile.data())
+                                     for path, lockfile in modified.items()])
+                head = gitlock.git_io.commit_files(self.gitpath, head, files, commit_msg)
+                gitlock.git_io.push_commit(self.gitpath, head, self.repo.branch, self.head)
+            except gitlock.git_io.GitError as e:
+                error = e
+        else:
+            error = gitlock.git_io.update_remote(commit_msg, list(modified), self.repo.lock_repo,
+                                                  branch=self.repo.branch)
+            head = self.repo.local_tip()
+        if error is not None:
+            logger.info("Restoring lockfiles")
+            for pkg, pkg_undo in undo.items():
+                self.repos[pkg].locks.restore(pkg_undo)
+            raise error
+        self.head = head
+        for pkg in changes:
+            self.repos[pkg].head = head
+
+    def package_of(self, path):
+        """
+        Package whose repo contains ``path`` (the package with the longest matching path)
+        """
+        path = os.path.abspath(path)
+        matches = [(len(repo.config['pkg_path']), pkg) for pkg, repo in self.repos.items()
+                   if path == repo.config['pkg_path'] or
+                   path.startswith(repo.config['pkg_path'].rstrip(os.sep)+os.sep)]
+        if len(matches)==0:
+            return None
+        return max(matches)[1]
+
+    def change_locks(self, action, filenames, username=None):
+        """
+        Lock or unlock files in several packages in a single commit. ``filenames`` are
+        paths (or glob patterns) relative to the current directory, and each one is locked
+        in the package that contains it.
+        """
+        username = get_username(username)
+        by_pkg = OrderedDict()
+        for filename in filenames:
+            pkg = self.package_of(filename)
+            if pkg is None:
+                raise ValueError("{0} is not in any of the packages {1}".format(filename, list(self.repos)))
+            by_pkg.setdefault(pkg, []).append(
+                os.path.relpath(os.path.abspath(filename), self.repos[pkg].config['pkg_path']))
+        prepares = OrderedDict()
+        for pkg, pkg_filenames in by_pkg.items():
+            prepare = getattr(self.repos[pkg], 'prepare_'+action)
+            prepares[pkg] = functools.partial(prepare, pkg_filenames, username)
+        return self.transact(prepares)
+
+def display_reports(reports):
+    """
+    Print the report of each package
+    """
+    for pkg, report in reports.items():
+        print("{0}:".format(pkg))
+        report.display()
@@ -0,0 +1,169 @@
+"""
+Queries on the locked files of a package.
+
+A `LockIndex` sorts the locks by path and by time and groups them by user once, so
+that a query only looks at the locks of one user, the locks under a path prefix, or
+the locks in a range of times, instead of scanning every lock. The results of
+`LockIndex.query` are generated lazily, so a page of results (``limit`` and
+``offset``) can be written as JSON lines or as a table without formatting the rest.
+"""
+import re
+import json
+import bisect
+import fnmatch
+import datetime
+import itertools
+from collections import OrderedDict
+
+# Sort orders supported by `LockIndex.query`
+SORT_KEYS = OrderedDict([
+    ('user', lambda lock: (lock.user, lock.filename)),
+    ('path', lambda lock: lock.filename),
+    ('time', lambda lock: (lock.time, lock.filename)),
+])
+
+# Units accepted by `parse_age`
+AGE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+def parse_age(age):
+    """
+    Convert an age like ``90``, ``30m``, ``12h``, ``3d`` or ``2w`` to a `datetime.timedelta`
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d*)?)\s*([smhdw]?)\s*$', age)
+    if match is None:
+        raise ValueError("Could not parse the age {0}, expected a number of seconds or a "
+                         "number followed by one of {1}".format(age, sorted(AGE_UNITS)))
+    value, unit = match.groups()
+    return datetime.timedelta(seconds=float(value)*AGE_UNITS[unit or 's'])
+
+def lock_time(age, now=None):
+    """
+    Lock time (as written in the lockfile) of a lock that is ``age`` old
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    return str(now-parse_age(age))
+
+def is_pattern(path):
+    return any(c in path for c in '*?[')
+
+class LockIndex(object):
+    """
+    Index of a set of locks (mapping filenames to `Lock`) by path, time and user.
+
+    Lock times are written as ``str(datetime)``, which sorts in time order, so the
+    locks older or newer than a given time are a range of the sorted times.
+    """
+    def __init__(self, locks):
+        self.by_path = sorted(locks.values(), key=SORT_KEYS['path'])
+        self.paths = [lock.filename for lock in self.by_path]
+        self.by_time = sorted(self.by_path, key=SORT_KEYS['time'])
+        self.times = [lock.time for lock in self.by_time]
+        self.by_user = OrderedDict()
+        for lock in self.by_path:
+            self.by_user.setdefault(lock.user, []).append(lock)
+
+    def __len__(self):
+        return len(self.by_path)
+
+    def users(self):
+        return sorted(self.by_user)
+
+    def under(self, prefix):
+        """
+        Locks on ``prefix`` and on every path below it
+        """
+        prefix = prefix.rstrip('/')
+        if prefix in ('', '.'):
+            return list(self.by_path)
+        start = bisect.bisect_left(self.paths, prefix)
+        end = bisect.bisect_left(self.paths, prefix+'0') # '0' is the character after '/'
+        return [lock for lock in self.by_path[start:end]
+                if lock.filename == prefix or lock.filename.startswith(prefix+'/')]
+
+    def between(self, after=None, before=None):
+        """
+        Locks taken after the lock time ``after`` and before ``before``
+        """
+        start = 0 if after is None else bisect.bisect_right(self.times, after)
+        end = len(self.times) if before is None else bisect.bisect_left(self.times, before)
+        return self.by_time[start:end]
+
+    def query(self, user=None, paths=None, older_than=None, newer_than=None, sortby='path',
+              reverse=False, limit=None, offset=0):
+        """
+        Generate the locks that match all of the filters, sorted by ``sortby``
+        ('user', 'path' or 'time').
+
+        ``paths`` is a list of path prefixes or glob patterns (a lock matches if it is
+        on or below any prefix, or matches any pattern). ``older_than`` and ``newer_than``
+        are ages (see `parse_age`). Only ``limit`` results after the first ``offset``
+        results are generated.
+        """
+        if sortby not in SORT_KEYS:
+            raise ValueError("sortby must be one of {0}, got {1}".format(list(SORT_KEYS), sortby))
+        before = None if older_than is None else lock_time(older_than)
+        after = None if newer_than is None else lock_time(newer_than)
+        prefixes = [path for path in paths or [] if not is_pattern(path)]
+        patterns = [path for path in paths or [] if is_pattern(path)]
+
+        # Start from the smallest set of candidates that the indices give directly, and
+        # keep track of the order of the candidates
+        if user is not None:
+            candidates = self.by_user.get(user, [])
+            order = ('user', 'path')
+        elif len(prefixes)==1 and len(patterns)==0:
+            candidates = self.under(prefixes[0])
+            order = ('path',)
+        elif before is not None or after is not None:
+            candidates = self.between(after, before)
+            order = ('time',)
+        else:
+            candidates = self.by_path
+            order = ('path',)
+
+        def match(lock):
+            if user is not None and lock.user != user:
+                return False
+            if before is not None and not lock.time < before:
+                return False
+            if after is not None and not lock.time > after:
+                return False
+            if paths:
+                return (any([lock.filename == prefix.rstrip('/') or
+                             lock.filename.startswith(prefix.rstrip('/')+'/') or prefix in ('', '.')
+                             for prefix in prefixes]) or
+                        any([fnmatch.fnmatch(lock.filename, pattern) for pattern in patterns]))
+            return True
+
+        if sortby in order:
+            # The candidates are already sorted, so the results are only filtered lazily
+            results = (lock for lock in (reversed(candidates) if reverse else candidates)
+                       if match(lock))
+        else:
+            results = sorted([lock for lock in candidates if match(lock)], key=SORT_KEYS[sortby],
+                             reverse=reverse)
+        stop = None if limit is None else offset+limit
+        return itertools.islice(results, offset, stop)
+
+def write_json(locks, stream, pkg=None):
+    """
+    Write each lock as a line of JSON (with the package name, if ``pkg`` is given)
+    """
+    for lock in locks:
+        row = OrderedDict([('path', lock.filename), ('user', lock.user), ('time', lock.time)])
+        if pkg is not None:
+            row['pkg'] = pkg
+        stream.write(json.dumps(row)+'\n')
+
+def write_table(locks, stream, directories=()):
+    """
+    Write the locks as a table with a column for the path, user and time of each lock.
+    Locks on ``directories`` are shown with a trailing ``/``.
+    """
+    rows = [(lock.filename+('/' if lock.filename in directories else ''), lock.user, lock.time)
+            for lock in locks]
+    header = ('PATH', 'USER', 'LOCKED SINCE')
+    widths = [max([len(row[n]) for row in rows+[header]]) for n in range(2)]
+    for row in [header]+rows:
+        stream.write('{0:<{w0}}  {1:<{w1}}  {2}\n'.format(*row, w0=widths[0], w1=widths[1]))
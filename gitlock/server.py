@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import signal
+import time
+import socket
+import logging
+import threading
+import socketserver
+from collections import OrderedDict
+
+import gitlock.utils as utils
+import gitlock.lock
+
+logger = logging.getLogger('gitlock.server')
+
+class ServerError(Exception):
+    pass
+
+def get_socket_path(gitpath):
+    """
+    Location of the socket for a lock server running on the lock repo at ``gitpath``
+    """
+    return utils.get_cache_path(utils.get_git_dir(gitpath), 'server.sock')
+
+def send(gitpath, request, timeout=60):
+    """
+    Send a request to the lock server for the lock repo at ``gitpath``.
+
+    Return the response, or None if no server is running.
+    """
+    socket_path = get_socket_path(gitpath)
+    if not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        # The server is no longer running
+        sock.close()
+        return None
+    with sock, sock.makefile('rwb') as stream:
+        stream.write(json.dumps(request).encode('utf-8')+b'\n')
+        stream.flush()
+        response = json.loads(stream.readline().decode('utf-8'))
+    if 'error' in response:
+        raise ServerError(response['error'])
+    return response
+
+class Request(object):
+    """
+    A request waiting in the queue of the lock server
+    """
+    def __init__(self, data):
+        self.data = data
+        self.response = None
+        self.done = threading.Event()
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = Request(json.loads(self.rfile.readline().decode('utf-8')))
+        except ValueError as e:
+            response = {'error': "Invalid request: {0}".format(e)}
+        else:
+            if request.data.get('op') == 'ping':
+                request.response = {'pid': os.getpid()}
+                request.done.set()
+            else:
+                self.server.lock_server.queue(request)
+            request.done.wait()
+            response = request.response
+        self.wfile.write(json.dumps(response).encode('utf-8')+b'\n')
+
+class LockServer(object):
+    """
+    Resident lock server for a lock repo.
+
+    The server keeps a `gitlock.lock.Repo` (with its parsed lockfile) for each package
+    in memory and answers lock, unlock and info requests received on a Unix domain
+    socket. Requests that arrive within ``window`` seconds of each other are applied
+    together in a single commit and push (group commit), each one all-or-nothing.
+    """
+    def __init__(self, gitpath=None, window=0.05):
+        self.gitpath = utils.get_gitpath(gitpath)
+        self.window = window
+        self.repos = {}
+        self.pending = []
+        self.condition = threading.Condition()
+        self.socket_path = get_socket_path(self.gitpath)
+
+    def get_repo(self, pkg):
+        if pkg not in self.repos:
+            self.repos[pkg] = gitlock.lock.Repo(pkg, self.gitpath)
+        return self.repos[pkg]
+
+    def queue(self, request):
+        with self.condition:
+            self.pending.append(request)
+            self.condition.notify()
+
+    def next_batch(self):
+        """
+        Wait for a request, then collect all of the requests that arrive in the
+        group commit window
+        """
+        with self.condition:
+            while len(self.pending)==0:
+                self.condition.wait()
+        time.sleep(self.window)
+        with self.condition:
+            batch, self.pending = self.pending, []
+        return batch
+
+    def process(self, batch):
+        """
+        Apply a batch of requests, grouped by package, with one commit for each package
+        """
+        packages = OrderedDict()
+        for request in batch:
+            packages.setdefault(request.data.get('pkg'), []).append(request)
+        for pkg, requests in packages.items():
+            try:
+                self.process_package(pkg, requests)
+            except Exception as e:
+                logger.exception("Error processing requests for {0}".format(pkg))
+                for request in requests:
+                    if request.response is None or request.data['op'] in ('lock', 'unlock'):
+                        request.response = {'error': "{0}: {1}".format(type(e).__name__, e)}
+            for request in requests:
+                request.done.set()
+
+    def process_package(self, pkg, requests):
+        repo = self.get_repo(pkg)
+        writes = [r for r in requests if r.data['op'] in ('lock', 'unlock')]
+        reads = [r for r in requests if r.data['op'] not in ('lock', 'unlock')]
+        for request in reads:
+            if request.data['op'] != 'info':
+                request.response = {'error': "Unknown operation {0}".format(request.data['op'])}
+
+        def prepare():
+            reports, changes, commit_msg = repo.prepare_requests(
+                [(r.data['op'], r.data['filenames'], r.data['user']) for r in writes])
+            for request, report in zip(writes, reports):
+                request.response = {
+                    'success': report.success,
+                    'report': [[filename, status, msg] for filename, (status, msg) in report.items()]
+                }
+            # Each request has its own report, all of the changes are committed together
+            report = gitlock.lock.Report()
+            report.success = True
+            return report, changes, commit_msg
+
+        if len(writes)>0:
+            repo.transact(prepare, optimistic=True)
+            logger.info("Applied {0} requests for {1}".format(len(writes), pkg))
+        for request in reads:
+            if request.response is None:
+                ttl = request.data.get('ttl')
+                if ttl is None:
+                    ttl = repo.config.get('info_ttl', 0)
+                locks = repo.read_locked(ttl)
+                request.response = {
+                    'locks': [[lock.filename, lock.user, lock.time] for lock in locks.values()]
+                }
+
+    def run(self):
+        """
+        Serve requests until the process is interrupted
+        """
+        if send(self.gitpath, {'op': 'ping'}) is not None:
+            raise ServerError("A lock server is already running on {0}".format(self.socket_path))
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = socketserver.ThreadingUnixStreamServer(self.socket_path, RequestHandler)
+        server.daemon_threads = True
+        server.lock_server = self
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        # Make sure that the socket is removed when the server is terminated
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        logger.info("Serving locks for {0} on {1}".format(self.gitpath, self.socket_path))
+        try:
+            while True:
+                self.process(self.next_batch())
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.remove(self.socket_path)
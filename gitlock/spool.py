@@ -0,0 +1,136 @@
+"""
+Local queue of lock requests for the gitlock processes on one host.
+
+Processes that change the lock repo take turns with `gitlock.utils.repo_lock`. Before
+waiting for its turn, a process writes its lock or unlock requests to a spool
+directory in ``.git/gitlock``. The process that holds the lock applies every request
+in the spool of the package in a single pull, commit and push (a group commit, see
+`gitlock.lock.Repo.prepare_requests`) and writes the report of each request next to
+it, so the processes that were waiting only have to read their report when their
+turn comes.
+"""
+import os
+import time
+import random
+import logging
+
+import gitlock.utils as utils
+import gitlock.git_io
+from gitlock.lock import Report
+
+logger = logging.getLogger('gitlock.spool')
+
+# Seconds after which the results of processes that did not collect them are removed
+RESULT_EXPIRE = 3600
+
+def get_spool_dir(repo):
+    """
+    Directory with the queued requests of the package of ``repo``
+    """
+    return os.path.dirname(utils.get_cache_path(repo.git_dir, 'spool', repo.pkg, ''))
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def submit(repo, requests):
+    """
+    Apply lock and unlock requests, given as ``(action, filenames, username)`` tuples,
+    together with the requests that other processes are waiting to apply, and return
+    their reports. Each request is applied all-or-nothing on its own.
+    """
+    spool_dir = get_spool_dir(repo)
+    name = '{0:.6f}-{1}-{2:06d}'.format(time.time(), os.getpid(), random.randrange(10**6))
+    request_path = os.path.join(spool_dir, name+'.request')
+    result_path = os.path.join(spool_dir, name+'.result')
+    utils.dump_json(request_path, {'pid': os.getpid(), 'requests': [
+        [action, [filenames] if isinstance(filenames, str) else list(filenames), username]
+        for action, filenames, username in requests]})
+    try:
+        with utils.repo_lock(repo.git_dir):
+            result = utils.load_json(result_path)
+            if result is None:
+                process(repo)
+                result = utils.load_json(result_path)
+    finally:
+        for path in (request_path, result_path):
+            if os.path.exists(path):
+                os.remove(path)
+    if result is None:
+        raise gitlock.git_io.GitError("The requests were not applied")
+    if 'error' in result:
+        raise gitlock.git_io.GitError(result['error'])
+    reports = []
+    for action, success, rows in result['reports']:
+        report = Report(action, [(filename, (status, msg)) for filename, status, msg in rows])
+        report.success = success
+        reports.append(report)
+    return reports
+
+def pending(spool_dir):
+    """
+    Requests in the spool, oldest first, as ``(name, requests)`` tuples. Requests of
+    processes that are no longer running are removed.
+    """
+    batch = []
+    now = time.time()
+    for filename in sorted(os.listdir(spool_dir)):
+        path = os.path.join(spool_dir, filename)
+        if filename.endswith('.result'):
+            if now-os.path.getmtime(path) > RESULT_EXPIRE:
+                os.remove(path)
+            continue
+        if not filename.endswith('.request'):
+            continue
+        name = filename[:-len('.request')]
+        data = utils.load_json(path)
+        if data is None or os.path.exists(os.path.join(spool_dir, name+'.result')):
+            continue
+        if not is_running(data['pid']):
+            logger.info("Dropping the requests of process {0}, which is no longer running".format(data['pid']))
+            os.remove(path)
+            continue
+        batch.append((name, [tuple(request) for request in data['requests']]))
+    return batch
+
+def process(repo):
+    """
+    Apply all of the requests in the spool of the package of ``repo`` in a single
+    transaction and write their results. Must be called while holding the repo lock.
+    """
+    spool_dir = get_spool_dir(repo)
+    batch = []
+    results = []
+
+    def prepare():
+        # Requests that arrived while the lock repo was pulled are included too
+        batch[:] = pending(spool_dir)
+        reports, changes, commit_msg = repo.prepare_requests(
+            [request for name, requests in batch for request in requests])
+        results[:] = []
+        for name, requests in batch:
+            results.append(reports[:len(requests)])
+            reports = reports[len(requests):]
+        report = Report()
+        report.success = True
+        return report, changes, commit_msg
+
+    try:
+        repo.transact(prepare)
+    except Exception as e:
+        for name, requests in batch:
+            utils.dump_json(os.path.join(spool_dir, name+'.result'),
+                            {'error': "{0}: {1}".format(type(e).__name__, e)})
+        raise
+    for (name, requests), reports in zip(batch, results):
+        utils.dump_json(os.path.join(spool_dir, name+'.result'), {'reports': [
+            [report.action, report.success,
+             [[filename, status, msg] for filename, (status, msg) in report.items()]]
+            for report in reports]})
+    if len(batch)>1:
+        logger.info("Applied {0} queued requests for {1}".format(len(batch), repo.pkg))
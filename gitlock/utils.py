@@ -1,7 +1,12 @@
 import os
+import logging
+import threading
+import contextlib
 from collections import OrderedDict
 import errno
 
+logger = logging.getLogger('gitlock.utils')
+
 def get_full_path(path):
     """
     If a ~ is present in the path, expand it. Return the absolute path to a (potentially) relative path.
@@ -37,7 +42,7 @@ def check_required(args, required):
 def get_gitpath(gitpath):
     if gitpath is None:
         gitlock_cfg_path = get_gitlock_cfg_path()
-        gitlock_config = load_config(gitlock_cfg_path)
+        gitlock_config = load_config(gitlock_cfg_path, gitlock_cfg_path+'.json')
         gitpath = gitlock_config['gitpath']
     gitpath = get_full_path(gitpath)
     return gitpath
@@ -60,15 +65,139 @@ def get_lockfile_path(gitpath, pkg):
     """
     return get_full_path(os.path.join(gitpath, 'repos', pkg, 'locks.txt'))
 
-def load_config(path):
+def get_git_dir(gitpath):
+    """
+    Path to the git directory of the lock repo at ``gitpath``
+    """
+    git_dir = os.path.join(gitpath, '.git')
+    if os.path.isdir(git_dir):
+        return git_dir
+    if os.path.isfile(git_dir):
+        # The git directory is somewhere else (for example a worktree or submodule)
+        with open(git_dir, 'r') as f:
+            line = f.read().strip()
+        if line.startswith('gitdir: '):
+            return os.path.join(gitpath, line[len('gitdir: '):])
+    return gitpath
+
+def get_cache_path(git_dir, *names):
+    """
+    Path to a cache file for the lock repo. Caches are stored in the ``.git`` directory
+    of the lock repo so that they are never committed.
+    """
+    path = os.path.join(git_dir, 'gitlock', *names)
+    create_path(os.path.dirname(path))
+    return path
+
+def load_json(path):
+    """
+    Load a json file, or return None if it does not exist or cannot be read
+    """
+    import json
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def dump_json(path, data):
     """
-    Load a configuration file
+    Atomically write a json file
     """
+    import json
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+# Locks on the lock repos held by this process, by path of the lock file
+_repo_locks = {}
+_repo_locks_guard = threading.Lock()
+
+@contextlib.contextmanager
+def repo_lock(git_dir):
+    """
+    Hold an exclusive lock on the lock repo, shared by every gitlock process on the host,
+    while its refs, working tree or lockfiles are read and changed (for example from
+    the pull to the push of a lock change).
+
+    The lock can be taken again by a thread that already holds it, and the threads of a
+    process wait for each other before the lock file is locked (with ``flock``).
+    """
+    import fcntl
+    import gitlock.metrics as metrics
+
+    path = get_cache_path(git_dir, 'repo.lock')
+    with _repo_locks_guard:
+        held = _repo_locks.setdefault(path, {'lock': threading.RLock(), 'count': 0, 'file': None})
+    with held['lock']:
+        if held['count'] == 0:
+            f = open(path, 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX|fcntl.LOCK_NB)
+            except (IOError, OSError):
+                logger.info("Waiting for another gitlock process to release the lock repo")
+                with metrics.phase('wait'):
+                    fcntl.flock(f, fcntl.LOCK_EX)
+            held['file'] = f
+        held['count'] += 1
+        try:
+            yield
+        finally:
+            held['count'] -= 1
+            if held['count'] == 0:
+                fcntl.flock(held['file'], fcntl.LOCK_UN)
+                held['file'].close()
+                held['file'] = None
+
+def load_config(path, cache_path=None):
+    """
+    Load a configuration file.
+
+    If ``cache_path`` is given the configuration is also cached there as json, so that
+    PyYAML is only imported when the configuration file has changed.
+    """
+    if cache_path is not None:
+        stat = os.stat(path)
+        key = [stat.st_mtime_ns, stat.st_size]
+        cache = load_json(cache_path)
+        if cache is not None and cache.get('key') == key:
+            return cache['config']
     import yaml
     with open(path, 'r') as file:
-        config = yaml.load(file)
+        config = yaml.load(file, Loader=yaml.Loader)
+    if cache_path is not None:
+        dump_json(cache_path, {'key': key, 'config': config})
     return config
 
+def load_lock_cfg(gitpath, pkg):
+    """
+    Load the configuration file of a package (cached in the lock repo)
+    """
+    return load_config(get_config_path(gitpath, pkg),
+                       get_cache_path(get_git_dir(gitpath), '{0}.cfg.json'.format(pkg)))
+
+def list_packages(gitpath):
+    """
+    Names of the packages that are configured in a lock repo
+    """
+    repos_path = os.path.join(get_full_path(gitpath), 'repos')
+    if not os.path.isdir(repos_path):
+        return []
+    return sorted([pkg for pkg in os.listdir(repos_path)
+                   if os.path.isfile(os.path.join(repos_path, pkg, 'locks.cfg'))])
+
+def get_packages(gitpath, pkg, all_packages=False):
+    """
+    List of packages from a comma separated ``pkg`` argument, or every package in the
+    lock repo if ``all_packages`` is True
+    """
+    if all_packages:
+        return list_packages(get_gitpath(gitpath))
+    if pkg is None:
+        raise ValueError("You must specify a package (or --all)")
+    return [name for name in pkg.split(',') if name != '']
+
 def edit_git_cfg(gitpath, user):
     """
     Create or edit the gitlock configuration file
@@ -113,13 +242,212 @@ def edit_lock_cfg(pkg, gitpath=None, pkg_path=None, user=None):
         yaml.dump(config, stream)
     return config
 
-def create_lockfile(gitpath, pkg, pkg_path, overwrite=False, update=False):
+# First line of the pre-commit hook installed by `install_hook`
+HOOK_MARKER = '# gitlock pre-commit hook'
+
+def install_hook(gitpath, pkg, overwrite=False, user=None):
     """
-    Build a text file with a list of all of the files in a package with no locks
+    Install a git pre-commit hook in the package repo that runs ``gitlock check --staged``,
+    so that commits that change files locked by other users are refused
+    """
+    import sys
+    import gitlock.git_io as git_io
+
+    gitpath = get_gitpath(gitpath)
+    pkg_path = load_lock_cfg(gitpath, pkg)['pkg_path']
+    hooks = git_io.run(pkg_path, 'rev-parse', '--git-path', 'hooks').decode('utf-8').strip()
+    hook_path = os.path.join(pkg_path, hooks, 'pre-commit')
+    if os.path.isfile(hook_path) and not overwrite:
+        with open(hook_path, 'r') as f:
+            if HOOK_MARKER not in f.read():
+                print("A pre-commit hook already exists in {0}, use -o True to replace it".format(
+                      hook_path))
+                return
+    # Use the same gitlock script and python as this command, if possible
+    script = os.path.abspath(sys.argv[0])
+    if os.path.basename(script) == 'gitlock' and os.path.isfile(script):
+        command = '"{0}" "{1}"'.format(sys.executable, script)
+    else:
+        command = 'gitlock'
+    command += ' check {0} -g "{1}" --staged'.format(pkg, gitpath)
+    if user is not None:
+        command += ' -u "{0}"'.format(user)
+    create_path(os.path.dirname(hook_path))
+    with open(hook_path, 'w') as f:
+        f.write("#!/bin/sh\n{0}\n# Refuse commits of files that are locked by other users\n"
+                "exec {1}\n".format(HOOK_MARKER, command))
+    os.chmod(hook_path, 0o755)
+    print("Installed the pre-commit hook in {0}".format(hook_path))
+
+def get_package_changes(git_repo, base, head):
+    """
+    List the changes to the files in a package between two commits, as a list of
+    ``(status, filename, old_filename)`` tuples, where ``old_filename`` is only set for
+    renamed and copied files
+    """
+    diff = git_repo.git.diff('--name-status', '-M', '-z', base, head).split('\0')
+    diff = [d for d in diff if d != '']
+    changes = []
+    n = 0
+    while n < len(diff):
+        status = diff[n][0]
+        if status in 'RC':
+            changes.append((status, diff[n+2], diff[n+1]))
+            n += 3
+        else:
+            changes.append((status, diff[n+1], None))
+            n += 2
+    return changes
+
+def prepare_update(repo, git_repo):
+    """
+    Function that prepares the update of a lockfile (see `update_lockfile`), for
+    `gitlock.lock.Repo.transact`
     """
-    import git
     import datetime
     import gitlock.lock
+    from gitlock.lockfile import Lock
+
+    head = git_repo.head.commit
+
+    def prepare():
+        locks = repo.locks
+        report = gitlock.lock.Report()
+        report.success = True
+        # Package commit that the lockfile is moved from, None if it is already up to date
+        report.moved_from = None
+        if locks.commit == head.hexsha:
+            return report, {}, None
+        report.moved_from = locks.commit
+        lock_time = str(datetime.datetime.now())
+        added = OrderedDict()
+        removed = OrderedDict()
+
+        def add(filename, lock=None):
+            if locks.sparse and lock is None:
+                return
+            removed.pop(filename, None)
+            if filename in added or filename in locks:
+                if lock is not None:
+                    new_lock = added.get(filename) or locks[filename]
+                    new_lock.user, new_lock.time = lock.user, lock.time
+                    added[filename] = new_lock
+            elif lock is None:
+                added[filename] = Lock(repo, filename, "None", lock_time)
+            else:
+                added[filename] = Lock(repo, filename, lock.user, lock.time)
+            parent = os.path.dirname(filename)
+            if parent != '' and (parent not in locks or parent in removed) and parent not in added:
+                add(parent)
+
+        deleted = []
+        for status, filename, old_filename in get_package_changes(git_repo, locks.commit, head.hexsha):
+            if status in 'AC':
+                add(filename)
+                report[filename] = ('added', "added")
+            elif status == 'D':
+                deleted.append(filename)
+            elif status == 'R':
+                old_lock = locks[old_filename] if old_filename in locks else None
+                add(filename, old_lock)
+                report[filename] = ('renamed', "renamed from {0}".format(old_filename))
+                if old_lock is not None:
+                    removed[old_filename] = True
+                    deleted.append(old_filename)
+
+        # Remove deleted files and directories that no longer exist, unless they are locked
+        checked = set()
+        for filename in deleted:
+            path = filename
+            while path != '' and path not in checked:
+                checked.add(path)
+                if path != filename:
+                    try:
+                        head.tree[path]
+                        break
+                    except KeyError:
+                        pass
+                if path in locks and path not in added:
+                    if locks[path].locked and path not in removed:
+                        report[path] = ('kept', "deleted but locked by {0}".format(locks[path].user))
+                    else:
+                        removed[path] = True
+                        report[path] = ('removed', "removed")
+                path = os.path.dirname(path)
+        changes = {'locks': list(added.values()), 'removed': list(removed), 'commit': head.hexsha}
+        return report, changes, "Update lockfile to {0}".format(head.hexsha)
+    return prepare
+
+def display_update(report, head):
+    if report.moved_from is None:
+        print("The lockfile is already up to date with {0}".format(head))
+    elif len(report)==0:
+        print("No files were added, deleted or renamed, moved the lockfile from {0} to {1}".format(
+              report.moved_from, head))
+    else:
+        print("Updated the lockfile to {0}:".format(head))
+        report.display()
+
+def update_lockfile(repo, git_repo):
+    """
+    Update a lockfile with the files added, deleted or renamed in the package since the
+    commit that the lockfile was built from. Locks are carried over to renamed files and
+    files that are deleted while they are locked are kept in the lockfile. A sparse
+    lockfile only has rows for locked files, so only the header and the rows of locked
+    files that were renamed change.
+    """
+    report = repo.transact(prepare_update(repo, git_repo))
+    display_update(report, git_repo.head.commit.hexsha)
+    return report
+
+def update_lockfiles(gitpath, pkgs):
+    """
+    Update the lockfiles of several packages (see `update_lockfile`) with one pull of the
+    lock repo and a single commit. Lockfiles that cannot be updated incrementally are
+    rebuilt separately (see `create_lockfile`).
+    """
+    import git
+    import gitlock.multi
+
+    multi = gitlock.multi.MultiRepo(pkgs, gitpath)
+    with repo_lock(multi.repo.git_dir):
+        multi.update_all_locks()
+        prepares = OrderedDict()
+        heads = OrderedDict()
+        for pkg, repo in multi.repos.items():
+            git_repo = git.Repo(repo.config['pkg_path'])
+            try:
+                if repo.locks.commit is not None and git_repo.commit(repo.locks.commit):
+                    prepares[pkg] = prepare_update(repo, git_repo)
+                    heads[pkg] = git_repo.head.commit.hexsha
+                    continue
+            except (ValueError, git.BadName):
+                pass
+            logger.info("The package commit of the lockfile for {0} is unknown, rebuilding it".format(pkg))
+            create_lockfile(gitpath, pkg, None, update=True)
+        if len(prepares)>0:
+            reports = multi.transact(prepares)
+            for pkg, report in reports.items():
+                print("{0}:".format(pkg))
+                display_update(report, heads[pkg])
+
+def create_lockfile(gitpath, pkg, pkg_path, overwrite=False, update=False, lockfile_format=None,
+                    shards=None):
+    """
+    Build a text file with a list of all of the files in a package with no locks.
+
+    If ``update`` is True and the lockfile records the package commit it was built from,
+    only the changes to the package since that commit are applied.
+
+    ``lockfile_format`` is either 'dense' (a row for every file in the package) or
+    'sparse' (only rows for locked files). By default the format of the existing lockfile
+    is kept, or the ``format`` in the package configuration is used for a new lockfile.
+    In the same way ``shards`` (for example 'prefix:1', 'hash:16' or 'none', see
+    `gitlock.lockfile.parse_shards`) sets how the lockfile is split into shards.
+    """
+    import git
+    import gitlock.lock
+    from gitlock.lockfile import parse_shards
     
     gitpath = get_gitpath(gitpath)
     if pkg_path is None:
@@ -128,48 +456,229 @@ def create_lockfile(gitpath, pkg, pkg_path, overwrite=False, update=False):
         pkg_path = config['pkg_path']
     
     git_repo = git.Repo(pkg_path)
-    lock_time = str(datetime.datetime.now())
-    files = ['"{0}" "{1}" "{2}"'.format(f.path, "None", lock_time) for f in git_repo.tree().traverse()]
 
-    # Create the package if it does not exist
-    lockfile_path = get_lockfile_path(gitpath, pkg)
-    if os.path.isfile(lockfile_path) and not overwrite and not update:
-        print("The lockfile already exists for {0}".format(pkg))
-    else:
+    with repo_lock(get_git_dir(gitpath)):
         repo = gitlock.lock.Repo(pkg, gitpath)
-        if os.path.isfile(lockfile_path) and update:
+        exists = repo.has_lockfile()
+        if exists and not overwrite and not update:
+            print("The lockfile already exists for {0}".format(pkg))
+            return
+        if exists and (update or lockfile_format is None or shards is None):
+            repo.update_all_locks()
+        if lockfile_format is None:
+            if exists:
+                lockfile_format = 'sparse' if repo.locks.sparse else 'dense'
+            else:
+                lockfile_format = repo.config.get('format', 'dense')
+        if shards is None:
+            shards = repo.locks.shards if exists else parse_shards(repo.config.get('shards'))
+        else:
+            shards = parse_shards(shards)
+        if exists and update:
+            try:
+                if repo.locks.commit is not None and git_repo.commit(repo.locks.commit):
+                    return update_lockfile(repo, git_repo)
+            except (ValueError, git.BadName):
+                pass
+            logger.info("The package commit of the lockfile is unknown, rebuilding the lockfile")
+
+        locks = None
+        if exists and update:
             locks = repo.get_locked_info(display=False)
-            for filename, lock in locks.items():
-                entry = '"' + '" "'.join([lock.filename, lock.user, lock.time]) + '"'
-                idx = [n for n,f in enumerate(files) if f.startswith('"'+filename+'"')]
-                if len(idx)==1:
-                    files[idx[0]] = entry
-                elif len(idx)==0:
-                    files.append(entry)
-                else:
-                    raise Exception("Multiple entries for {0}".format(filename))
             commit_msg = "Update lockfile"
         else:
             commit_msg = "Rebuild lockfile"
-            create_path(os.path.dirname(lockfile_path))
-            locks = None
-        # Backup the lockfile
-        new_file = True
-        if os.path.isfile(lockfile_path):
-            new_file = False
-            with open(lockfile_path, 'r') as f:
-                old_files = f.readlines()
-        # Write the lockfile
-        with open(lockfile_path, 'w+') as f:
-            f.write("\n".join(files))
-        print('finished writing', lockfile_path)
-        
-        # Attempt to push the changes to the remote
-        error = gitlock.git_io.update_remote(commit_msg, lockfile_path, repo.lock_repo)
-        if error is not None and not new_file:
-            # Resore the lockfile if there was an error while saving
-            print("Restoring lockfile")
-            with open(lockfile_path, 'w+') as f:
-                f.write("".join(old_files))
-            raise error
-        
\ No newline at end of file
+        files = build_lockfile(repo, pkg_path, git_repo.head.commit.hexsha, lockfile_format, shards, locks)
+        repo.install_lockfiles(files, commit_msg)
+        print('finished writing', repo.lockfile_path)
+
+def build_lockfile(repo, pkg_path, commit, lockfile_format, shards, locks=None):
+    """
+    Write the lockfile of the package at ``pkg_path`` for ``commit`` to temporary files,
+    streaming the files of the package from git so that memory use does not grow with
+    the size of the package, and return the temporary files (see
+    `gitlock.lock.Repo.install_lockfiles`). Files in ``locks`` (by filename) keep their
+    locks, including files that are no longer in the package.
+    """
+    import datetime
+    import gitlock.git_io
+    import gitlock.metrics as metrics
+    from gitlock.lockfile import LockfileWriter
+
+    locks = locks or {}
+    writer = LockfileWriter(repo.lockfile_path, commit, lockfile_format == 'sparse', shards,
+                            repo.temp_dir())
+    try:
+        with metrics.phase('traverse') as record:
+            written = set()
+            if lockfile_format != 'sparse':
+                lock_time = str(datetime.datetime.now())
+                for path in gitlock.git_io.iter_tree(pkg_path, commit):
+                    lock = locks.get(path)
+                    if lock is None:
+                        writer.write(path, "None", lock_time)
+                    else:
+                        writer.write(lock.filename, lock.user, lock.time)
+                        written.add(path)
+            for filename, lock in locks.items():
+                if filename not in written:
+                    writer.write(lock.filename, lock.user, lock.time)
+            record['bytes'] = writer.bytes
+        return writer.close()
+    except:
+        writer.abort()
+        raise
+
+def build_lockfiles(gitpath, pkgs, overwrite=False, lockfile_format=None, shards=None):
+    """
+    Build the lockfiles of several packages (see `create_lockfile`) in parallel, with one
+    pull of the lock repo and a single commit. Lockfiles that already exist are only
+    rebuilt if ``overwrite`` is True.
+    """
+    import gitlock.git_io
+    import gitlock.multi
+    from gitlock.lockfile import parse_shards
+
+    multi = gitlock.multi.MultiRepo(pkgs, gitpath)
+    with repo_lock(multi.repo.git_dir):
+        head = multi.repo.pull_locks()
+        exists = multi.map(lambda repo: repo.has_lockfile(head))
+        for pkg in pkgs:
+            if exists[pkg] and not overwrite:
+                print("The lockfile already exists for {0}".format(pkg))
+        pkgs = [pkg for pkg in pkgs if overwrite or not exists[pkg]]
+        if len(pkgs)==0:
+            return
+
+        def build(repo):
+            try:
+                pkg_format = lockfile_format
+                pkg_shards = parse_shards(shards)
+                if exists[repo.pkg] and (lockfile_format is None or shards is None):
+                    locks = repo.load_lockfile(head)
+                    if lockfile_format is None:
+                        pkg_format = 'sparse' if locks.sparse else 'dense'
+                    if shards is None:
+                        pkg_shards = locks.shards
+                else:
+                    pkg_format = pkg_format or repo.config.get('format', 'dense')
+                    if shards is None:
+                        pkg_shards = parse_shards(repo.config.get('shards'))
+                pkg_path = repo.config['pkg_path']
+                commit = gitlock.git_io.run(pkg_path, 'rev-parse', 'HEAD').decode('utf-8').strip()
+                return build_lockfile(repo, pkg_path, commit, pkg_format, pkg_shards)
+            except Exception as e:
+                return e
+
+        results = multi.map(build, pkgs)
+        errors = [result for result in results.values() if isinstance(result, Exception)]
+        files = OrderedDict()
+        for pkg, result in results.items():
+            if isinstance(result, Exception):
+                continue
+            if len(errors)>0:
+                for tmp_path in result.values():
+                    os.remove(tmp_path)
+                continue
+            files.update(result)
+            for path in multi.repos[pkg].stale_lockfiles(result, head):
+                files[path] = None
+        if len(errors)>0:
+            raise errors[0]
+        if len(pkgs)==1:
+            commit_msg = "Rebuild lockfile"
+        else:
+            commit_msg = "Rebuild lockfiles of {0} packages\n\n{1}".format(len(pkgs), "\n".join(pkgs))
+        multi.repo.install_lockfiles(files, commit_msg, head)
+        for pkg in pkgs:
+            print('finished writing', multi.repos[pkg].lockfile_path)
+
+def migrate_lockfile(gitpath, pkg, lockfile_format=None, shards=None):
+    """
+    Convert a lockfile to the 'sparse' format (only rows for locked files) or back to the
+    'dense' format (a row for every file in the package), and/or split it into ``shards``
+    (or merge the shards back into one lockfile with 'none'), keeping all of the locks
+    """
+    import datetime
+    import gitlock.lock
+    from gitlock.lockfile import format_lockfiles, parse_shards
+
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    with repo_lock(repo.git_dir):
+        locks = repo.update_all_locks()
+        if lockfile_format is None:
+            lockfile_format = 'sparse' if locks.sparse else 'dense'
+        shards = locks.shards if shards is None else parse_shards(shards)
+        if locks.sparse == (lockfile_format == 'sparse') and locks.shards == shards:
+            print("The lockfile for {0} is already {1}".format(pkg, describe_format(lockfile_format, shards)))
+            return
+        locked = locks.locked()
+        if lockfile_format == 'sparse':
+            rows = []
+            commit = locks.commit
+        elif locks.sparse:
+            # List all of the files and directories of the package
+            index = repo.package_index()
+            commit = index.commit
+            lock_time = str(datetime.datetime.now())
+            rows = [(path, "None", lock_time) for path in sorted(index.files | index.dirs)
+                    if path not in locked]
+        else:
+            commit = locks.commit
+            rows = [(filename, "None", locks[filename].time) for filename in locks
+                    if filename not in locked]
+        rows += [(lock.filename, lock.user, lock.time) for lock in locked.values()]
+        files = format_lockfiles(repo.lockfile_path, rows, commit, lockfile_format == 'sparse', shards)
+        description = describe_format(lockfile_format, shards)
+        repo.replace_lockfiles(files, "Migrate lockfile to the {0} format".format(description))
+        print("Migrated the lockfile for {0} to the {1} format ({2} locks)".format(
+              pkg, description, len(locked)))
+
+def compact_lock_repo(gitpath, pkg=None, keep=0, archive=None):
+    """
+    Squash the history of the lock branch into a snapshot commit, keeping the last ``keep``
+    commits and, optionally, the old history on an ``archive`` branch (see
+    `gitlock.git_io.compact_history`). The branch and retry settings are read from the
+    configuration of ``pkg`` if it is given.
+    """
+    import time
+    import gitlock.git_io as git_io
+
+    gitpath = get_gitpath(gitpath)
+    git_dir = get_git_dir(gitpath)
+    config = {}
+    branch = None
+    if pkg is not None:
+        config = load_lock_cfg(gitpath, pkg)
+        branch = config.get('branch')
+    branch = branch or git_io.current_branch(git_dir)
+    retries = config.get('push_retries', 8)
+    with repo_lock(git_dir):
+        for attempt in range(retries+1):
+            try:
+                old, new = git_io.compact_history(gitpath, branch, keep, archive)
+                break
+            except git_io.PushRejected as e:
+                if attempt == retries:
+                    raise
+                delay = git_io.backoff_delay(attempt, config.get('backoff_base', 0.1),
+                                             config.get('backoff_cap', 5.0))
+                logger.info("{0}, retrying in {1:.2f} seconds".format(e, delay))
+                time.sleep(delay)
+        if old == new:
+            print("The history of {0} is already compact".format(branch))
+            return
+        if os.path.exists(os.path.join(gitpath, '.git')):
+            # Nothing is left unpushed in a lock repo, so the working tree can follow the remote
+            git_io.run(gitpath, 'reset', '--keep', '--quiet', new)
+    print("Compacted the history of {0} into {1} (it was {2})".format(branch, new, old))
+    if archive is not None:
+        print("The old history is on the {0} branch".format(archive))
+
+def describe_format(lockfile_format, shards):
+    """
+    Short description of the format of a lockfile, for example 'sparse' or 'dense, hash:16 shards'
+    """
+    if shards is None:
+        return lockfile_format
+    return "{0}, {1}:{2} shards".format(lockfile_format, *shards)
@@ -1,23 +1,1054 @@
-#input from user
+"""
+Tests of gitlock against a local bare repo that stands in for the remote of the lock repo,
+and a small package repo with the layout of afw
+"""
+import os
+import subprocess
+from collections import OrderedDict
+
+import pytest
+
+import gitlock.utils as utils
+import gitlock.lock
+import gitlock.git_io
+
 pkg = 'afw'
-repo_path = '/Users/fred/LSST/afw'
+pkg_files = [
+    'python/lsst/afw/geom/coordinateBase.cc',
+    'include/lsst/afw/table/io/FitsReader.h',
+    'include/lsst/afw/table/io/FitsSchemaInputMapper.h',
+    'include/lsst/afw/table/io/FitsWriter.h',
+    'include/lsst/afw/table/io/InputArchive.h',
+]
+
+def git(cwd, *args):
+    """
+    Run a git command and return its output as a string, without surrounding whitespace
+    """
+    return subprocess.run(['git'] + list(args), cwd=cwd, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, check=True).stdout.decode('utf-8').strip()
+
+def write_files(path, files, content='x\n'):
+    for filename in files:
+        filename = os.path.join(path, filename)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as f:
+            f.write(content)
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    """
+    Empty home directory with the git identity of the default user
+    """
+    home = tmp_path/'home'
+    home.mkdir()
+    monkeypatch.setenv('HOME', str(home))
+    for key in ('GIT_CONFIG_GLOBAL', 'GIT_CONFIG_SYSTEM', 'GIT_DIR', 'GIT_WORK_TREE'):
+        monkeypatch.delenv(key, raising=False)
+    git(str(home), 'config', '--global', 'user.name', 'fred')
+    git(str(home), 'config', '--global', 'user.email', 'fred@example.com')
+    git(str(home), 'config', '--global', 'init.defaultBranch', 'master')
+    return home
+
+@pytest.fixture
+def package(tmp_path, home):
+    """
+    Package repo with the files of ``pkg_files`` in a single commit
+    """
+    path = str(tmp_path/pkg)
+    os.makedirs(path)
+    git(path, 'init', '-q')
+    write_files(path, pkg_files)
+    git(path, 'add', '.')
+    git(path, 'commit', '-q', '-m', 'init')
+    return path
+
+@pytest.fixture
+def origin(tmp_path, home):
+    """
+    Bare repo with an initial commit, the remote of the lock repos
+    """
+    path = str(tmp_path/'origin.git')
+    git(str(tmp_path), 'init', '-q', '--bare', path)
+    seed = str(tmp_path/'seed')
+    git(str(tmp_path), 'clone', '-q', path, seed)
+    write_files(seed, ['README'], 'gitlock test locks\n')
+    git(seed, 'add', 'README')
+    git(seed, 'commit', '-q', '-m', 'init')
+    git(seed, 'push', '-q', 'origin', 'master')
+    return path
+
+@pytest.fixture
+def clone(tmp_path, origin, package):
+    """
+    Function that clones the lock repo (bare for the plumbing backend) and writes the
+    package configuration file. Extra ``config`` entries are added to the configuration.
+    """
+    def clone(name, backend='worktree', **config):
+        path = str(tmp_path/name)
+        git(str(tmp_path), 'clone', '-q', *(['--bare'] if backend == 'plumbing' else []) + [origin, path])
+        utils.edit_lock_cfg(pkg, path, package)
+        if len(config)>0:
+            import yaml
+            config_path = utils.get_config_path(path, pkg)
+            data = utils.load_config(config_path)
+            data.update(config)
+            with open(config_path, 'w') as f:
+                yaml.dump(data, f)
+        return path
+    return clone
+
+@pytest.fixture
+def gitpath(clone, package):
+    """
+    Lock repo with the lockfile of the package
+    """
+    path = clone('locks')
+    utils.create_lockfile(path, pkg, package)
+    return path
+
+def locked(gitpath):
+    """
+    Locked files and their users, as seen by a new client
+    """
+    return {filename: lock.user for filename, lock in
+            gitlock.lock.Repo(pkg, gitpath).get_locked_info(display=False).items()}
+
+def test_lock_unlock(gitpath):
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    assert repo.lock('include/lsst/afw/table/io/FitsReader.h', 'fred')
+    assert repo.lock('include/lsst/afw/table/io/FitsSchemaInputMapper.h', 'cyndi')
+    assert repo.lock('include/lsst/afw/table/io/FitsWriter.h', 'sophie')
+    assert repo.lock('include/lsst/afw/table/io/InputArchive.h', 'fred')
+    assert locked(gitpath) == {
+        'include/lsst/afw/table/io/FitsReader.h': 'fred',
+        'include/lsst/afw/table/io/FitsSchemaInputMapper.h': 'cyndi',
+        'include/lsst/afw/table/io/FitsWriter.h': 'sophie',
+        'include/lsst/afw/table/io/InputArchive.h': 'fred',
+    }
+
+    # Locking a file that is already held is reported, without a new commit
+    head = git(gitpath, 'rev-parse', 'HEAD')
+    report = repo.lock('include/lsst/afw/table/io/FitsReader.h', 'fred')
+    assert report and report['include/lsst/afw/table/io/FitsReader.h'][0] == 'held'
+    assert git(gitpath, 'rev-parse', 'HEAD') == head
+
+    report = repo.unlock('include/lsst/afw/table/io/InputArchive.h', 'cyndi')
+    assert not report
+    assert report['include/lsst/afw/table/io/InputArchive.h'][0] == 'locked'
+    assert repo.unlock('include/lsst/afw/table/io/InputArchive.h', 'fred')
+    assert 'include/lsst/afw/table/io/InputArchive.h' not in locked(gitpath)
+
+def test_lock_batch_all_or_nothing(gitpath):
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    assert repo.lock('include/lsst/afw/table/io/FitsWriter.h', 'sophie')
+    head = git(gitpath, 'rev-parse', 'HEAD')
+    report = repo.lock(pkg_files+['include/lsst/afw/missing.h'], 'fred')
+    assert not report
+    assert report['include/lsst/afw/table/io/FitsWriter.h'][0] == 'locked'
+    assert report['include/lsst/afw/missing.h'][0] == 'missing'
+    assert git(gitpath, 'rev-parse', 'HEAD') == head
+    assert locked(gitpath) == {'include/lsst/afw/table/io/FitsWriter.h': 'sophie'}
+
+    # A batch is a single commit
+    files = [f for f in pkg_files if f != 'include/lsst/afw/table/io/FitsWriter.h']
+    assert repo.lock(files, 'fred')
+    assert git(gitpath, 'rev-list', '--count', head+'..HEAD') == '1'
+    # The glob also matches the file locked by sophie, so nothing is unlocked
+    assert not repo.unlock('include/lsst/afw/table/io/*.h', 'fred')
+    assert repo.unlock('include/lsst/afw/table/io/Fits[RS]*.h', 'fred')
+    assert locked(gitpath) == {'include/lsst/afw/table/io/FitsWriter.h': 'sophie',
+                               'include/lsst/afw/table/io/InputArchive.h': 'fred',
+                               'python/lsst/afw/geom/coordinateBase.cc': 'fred'}
+
+def test_default_user(gitpath):
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    assert repo.lock('python/lsst/afw/geom/coordinateBase.cc')
+    assert locked(gitpath) == {'python/lsst/afw/geom/coordinateBase.cc': 'fred'}
+
+def test_clients_share_remote(gitpath, clone):
+    other = clone('other')
+    assert gitlock.lock.Repo(pkg, gitpath).lock('include/lsst/afw/table/io/FitsReader.h', 'fred')
+    report = gitlock.lock.Repo(pkg, other).lock('include/lsst/afw/table/io/FitsReader.h', 'cyndi')
+    assert not report
+    assert report['include/lsst/afw/table/io/FitsReader.h'][0] == 'locked'
+    assert locked(other) == {'include/lsst/afw/table/io/FitsReader.h': 'fred'}
+
+def make_lockfile(path, rows, commit=None):
+    from gitlock.lockfile import format_header, format_row
+    lines = [] if commit is None else [format_header(commit)]
+    lines += [format_row(*row) for row in rows]
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+
+def test_lockfile_write_restore(tmp_path):
+    from gitlock.lockfile import Lock, LockFile
+
+    path = str(tmp_path/'locks.txt')
+    make_lockfile(path, [('a.h', 'None', 't0'), ('b.h', 'fred', 't1'), ('c.h', 'None', 't0')], 'abc')
+    with open(path, 'rb') as f:
+        original = f.read()
+    locks = LockFile(path)
+    assert list(locks) == ['a.h', 'b.h', 'c.h']
+    assert list(locks.locked()) == ['b.h']
+    assert locks.commit == 'abc'
+
+    # Changing a lock only rewrites its own row, in place
+    undo = locks.write([Lock(None, 'a.h', 'cyndi', 't2')])
+    with open(path, 'rb') as f:
+        data = f.read()
+    assert len(data) == len(original)
+    assert locks.written == locks.index['a.h'][1]
+    assert LockFile(path)['a.h'].user == 'cyndi'
+    assert list(LockFile(path).locked()) == ['a.h', 'b.h']
+
+    # New rows are appended and removed rows are blanked out
+    undo2 = locks.write([Lock(None, 'd.h', 'sophie', 't3')], removed=['c.h'], commit='def')
+    reloaded = LockFile(path)
+    assert list(reloaded) == ['a.h', 'b.h', 'd.h']
+    assert reloaded['d.h'].user == 'sophie'
+    assert reloaded.commit == 'def'
+
+    locks.restore(undo2)
+    locks.restore(undo)
+    with open(path, 'rb') as f:
+        assert f.read() == original
+    assert list(locks.locked()) == ['b.h']
+
+def test_lockfile_rewrite_unpadded(tmp_path):
+    from gitlock.lockfile import Lock, LockFile
+
+    # Rows of old lockfiles are not padded, so a longer user rewrites the whole file
+    path = str(tmp_path/'locks.txt')
+    with open(path, 'w') as f:
+        f.write('"a.h" "None" "t0"\n"b.h" "None" "t0"')
+    with open(path, 'rb') as f:
+        original = f.read()
+    locks = LockFile(path)
+    undo = locks.write([Lock(None, 'b.h', 'a-long-user-name', 't1')], commit='abc')
+    reloaded = LockFile(path)
+    assert reloaded['b.h'].user == 'a-long-user-name'
+    assert reloaded['a.h'].user == 'None'
+    assert reloaded.commit == 'abc'
+    assert len(set([length for offset, length in reloaded.index.values()])) == 1
+    locks.restore(undo)
+    with open(path, 'rb') as f:
+        assert f.read() == original
+
+def test_lockfile_in_memory():
+    from gitlock.lockfile import Lock, LockFile, format_row
+
+    data = (format_row('a.h', 'None', 't0')+'\n'+format_row('b.h', 'None', 't0')).encode('utf-8')
+    locks = LockFile('locks.txt', data)
+    locks.write([Lock(None, 'b.h', 'fred', 't1')])
+    assert locks.modified() == {'locks.txt': locks}
+    assert LockFile('locks.txt', locks.data())['b.h'].user == 'fred'
+    assert not os.path.exists('locks.txt')
+
+def read_old(path):
+    """
+    Read a lockfile the way that versions of gitlock before the indexed lockfile did
+    """
+    import csv
+    from gitlock.lockfile import Lock
+
+    with open(path, 'r') as f:
+        return OrderedDict([(row[0], Lock(None, *row))
+                            for row in csv.reader(f, delimiter=" ", quotechar='"')])
+
+def test_lockfile_old_reader(tmp_path):
+    from gitlock.lockfile import Lock, LockFile
+
+    # Padded rows still have three fields, so older clients can read them
+    path = str(tmp_path/'locks.txt')
+    make_lockfile(path, [('a.h', 'None', 't0'), ('b.h', 'fred', 't1')])
+    LockFile(path).write([Lock(None, 'a.h', 'cyndi', 't2')])
+    locks = read_old(path)
+    assert list(locks) == ['a.h', 'b.h']
+    assert [(lock.user, lock.time.rstrip()) for lock in locks.values()] == [('cyndi', 't2'), ('fred', 't1')]
+    assert LockFile(path)['a.h'].time == 't2'
+
+def test_lockfile_header_old_reader(tmp_path):
+    # The commit header is a change of the lockfile format that older clients cannot read
+    path = str(tmp_path/'locks.txt')
+    make_lockfile(path, [('a.h', 'None', 't0')], 'abc')
+    with pytest.raises(TypeError):
+        read_old(path)
+
+def race(repo, other, filename, user):
+    """
+    ``prepare`` function for `gitlock.lock.Repo.transact` that locks ``filename`` for
+    fred, after ``user`` locks ``filename`` in the ``other`` lock repo the first time
+    it is called (so that the first push of ``repo`` is rejected)
+    """
+    calls = []
+
+    def prepare():
+        if len(calls)==0:
+            assert gitlock.lock.Repo(pkg, other).lock(filename, user)
+        calls.append(repo.head)
+        return repo.prepare_lock(['include/lsst/afw/table/io/FitsReader.h'], 'fred')
+    return prepare, calls
+
+def is_clean(gitpath):
+    return git(gitpath, 'status', '--porcelain', '--untracked-files=no') == ''
+
+@pytest.mark.parametrize('backend', ['worktree', 'plumbing'])
+def test_transact_rebase(clone, package, backend):
+    import gitlock.metrics as metrics
+
+    gitpath = clone('locks', backend)
+    utils.create_lockfile(gitpath, pkg, package, shards='prefix:1')
+    other = clone('other')
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    # The other user changes a shard that was not read, so the changes are rebased
+    prepare, calls = race(repo, other, 'python/lsst/afw/geom/coordinateBase.cc', 'cyndi')
+    metrics.reset()
+    assert repo.transact(prepare)
+    counters = metrics.summary()['counters']
+    assert len(calls) == 2 and calls[0] != calls[1]
+    assert counters['push_rejected'] == 1
+    assert counters['rebased'] == 1
+    assert 'retries' not in counters
+    assert locked(other) == {'include/lsst/afw/table/io/FitsReader.h': 'fred',
+                             'python/lsst/afw/geom/coordinateBase.cc': 'cyndi'}
+    if backend == 'worktree':
+        assert is_clean(gitpath)
+        assert git(gitpath, 'rev-parse', 'HEAD') == git(gitpath, 'rev-parse', 'origin/master')
+
+@pytest.mark.parametrize('backend', ['worktree', 'plumbing'])
+def test_transact_retry(clone, package, backend):
+    import gitlock.metrics as metrics
+
+    gitpath = clone('locks', backend)
+    utils.create_lockfile(gitpath, pkg, package)
+    other = clone('other')
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    # The same lockfile changed, so the changes are prepared again on the new tip
+    prepare, calls = race(repo, other, 'python/lsst/afw/geom/coordinateBase.cc', 'cyndi')
+    metrics.reset()
+    assert repo.transact(prepare)
+    counters = metrics.summary()['counters']
+    assert len(calls) == 2
+    assert counters['retries'] == 1
+    assert 'backoff' not in metrics.summary()['phases']
+    assert locked(other) == {'include/lsst/afw/table/io/FitsReader.h': 'fred',
+                             'python/lsst/afw/geom/coordinateBase.cc': 'cyndi'}
+    if backend == 'worktree':
+        assert is_clean(gitpath)
+
+    # The lock is taken by another user first, so the retry fails and nothing is pushed
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    assert repo.unlock('include/lsst/afw/table/io/FitsReader.h', 'fred')
+    prepare, calls = race(repo, other, 'include/lsst/afw/table/io/FitsReader.h', 'cyndi')
+    report = repo.transact(prepare)
+    assert not report
+    assert report['include/lsst/afw/table/io/FitsReader.h'][0] == 'locked'
+    assert locked(gitpath)['include/lsst/afw/table/io/FitsReader.h'] == 'cyndi'
+    if backend == 'worktree':
+        assert is_clean(gitpath)
+
+def test_transact_gives_up(clone, package):
+    gitpath = clone('locks', push_retries=1, backoff_base=0.001)
+    utils.create_lockfile(gitpath, pkg, package)
+    other = clone('other')
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    contested = [f for f in pkg_files if f != 'include/lsst/afw/table/io/FitsReader.h']
+
+    def prepare():
+        # Another client pushes before every attempt
+        assert gitlock.lock.Repo(pkg, other).lock(contested.pop(), 'cyndi')
+        return repo.prepare_lock('include/lsst/afw/table/io/FitsReader.h', 'fred')
+    with pytest.raises(gitlock.git_io.GitError):
+        repo.transact(prepare)
+    assert len(contested) == 2
+    assert is_clean(gitpath)
+    assert 'include/lsst/afw/table/io/FitsReader.h' not in locked(gitpath)
+
+def test_push_error_restores_lockfile(gitpath, origin):
+    with open(os.path.join(origin, 'hooks', 'pre-receive'), 'w') as f:
+        f.write('#!/bin/sh\necho "locks are read-only" >&2\nexit 1\n')
+    os.chmod(os.path.join(origin, 'hooks', 'pre-receive'), 0o755)
+    head = git(gitpath, 'rev-parse', 'HEAD')
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    with pytest.raises(gitlock.git_io.GitError) as e:
+        repo.lock('include/lsst/afw/table/io/FitsReader.h', 'fred')
+    assert not isinstance(e.value, gitlock.git_io.PushRejected)
+    assert git(gitpath, 'rev-parse', 'HEAD') == head
+    assert is_clean(gitpath)
+
+def test_info_skips_fetch(gitpath, clone):
+    import gitlock.metrics as metrics
+
+    other = clone('other')
+    assert gitlock.lock.Repo(pkg, other).lock('include/lsst/afw/table/io/FitsReader.h', 'cyndi')
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    metrics.reset()
+    assert list(repo.get_locked_info(display=False)) == ['include/lsst/afw/table/io/FitsReader.h']
+    assert 'fetch' in metrics.summary()['phases']
+    # Nothing changed on the remote, so the lockfile is neither fetched nor parsed again
+    metrics.reset()
+    assert list(repo.get_locked_info(display=False)) == ['include/lsst/afw/table/io/FitsReader.h']
+    assert 'fetch' not in metrics.summary()['phases']
+    assert metrics.summary()['counters']['cache_hits'] == 1
+    # The working tree of the lock repo is not touched by info
+    assert git(gitpath, 'rev-parse', 'HEAD') != git(gitpath, 'rev-parse', 'origin/master')
+
+@pytest.mark.parametrize('lockfile_format', ['dense', 'sparse'])
+def test_update_renames_and_deletes(clone, package, lockfile_format, capsys):
+    gitpath = clone('locks')
+    utils.create_lockfile(gitpath, pkg, package, lockfile_format=lockfile_format)
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    assert repo.lock(['include/lsst/afw/table/io/FitsReader.h',
+                      'include/lsst/afw/table/io/InputArchive.h'], 'fred')
+    base = git(package, 'rev-parse', 'HEAD')
+
+    git(package, 'mv', 'include/lsst/afw/table/io/FitsReader.h', 'include/lsst/afw/table/io/Reader.h')
+    git(package, 'rm', '-q', 'include/lsst/afw/table/io/InputArchive.h',
+        'include/lsst/afw/table/io/FitsWriter.h', 'python/lsst/afw/geom/coordinateBase.cc')
+    write_files(package, ['python/lsst/afw/image/image.cc'], 'a new file\n')
+    git(package, 'add', '.')
+    git(package, 'commit', '-q', '-m', 'change')
+    head = git(package, 'rev-parse', 'HEAD')
+
+    report = utils.create_lockfile(gitpath, pkg, package, update=True)
+    assert report['include/lsst/afw/table/io/Reader.h'][0] == 'renamed'
+    assert report['include/lsst/afw/table/io/InputArchive.h'][0] == 'kept'
+    assert report['python/lsst/afw/image/image.cc'][0] == 'added'
+    if lockfile_format == 'dense':
+        assert report['include/lsst/afw/table/io/FitsWriter.h'][0] == 'removed'
+        # The directory of the deleted file no longer exists, the new one does
+        assert report['python/lsst/afw/geom'][0] == 'removed'
+    else:
+        assert 'include/lsst/afw/table/io/FitsWriter.h' not in report
+
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    locks = repo.update_all_locks()
+    assert locks.commit == head != base
+    # The lock moved with the renamed file, and the locked file that was deleted is kept
+    assert {filename: lock.user for filename, lock in locks.locked().items()} == {
+        'include/lsst/afw/table/io/Reader.h': 'fred',
+        'include/lsst/afw/table/io/InputArchive.h': 'fred',
+    }
+    assert 'include/lsst/afw/table/io/FitsReader.h' not in locks
+    if lockfile_format == 'dense':
+        assert 'python/lsst/afw/image/image.cc' in locks
+        assert 'python/lsst/afw/image' in locks
+        assert 'python/lsst/afw/geom/coordinateBase.cc' not in locks
+        assert 'python/lsst/afw/geom' not in locks
+        assert 'include/lsst/afw/table/io' in locks
+    assert repo.lock('python/lsst/afw/image/image.cc', 'cyndi')
+
+    # Updating again changes nothing
+    head = git(gitpath, 'rev-parse', 'HEAD')
+    capsys.readouterr()
+    assert len(utils.create_lockfile(gitpath, pkg, package, update=True)) == 0
+    assert git(gitpath, 'rev-parse', 'HEAD') == head
+    assert 'already up to date' in capsys.readouterr().out
+
+    # A package commit that only changes the contents of files moves the lockfile
+    write_files(package, ['python/lsst/afw/image/image.cc'], 'changed\n')
+    git(package, 'commit', '-q', '-am', 'edit')
+    report = utils.create_lockfile(gitpath, pkg, package, update=True)
+    assert len(report) == 0 and report.moved_from == locks.commit
+    assert 'moved the lockfile from {0} to {1}'.format(
+        locks.commit, git(package, 'rev-parse', 'HEAD')) in capsys.readouterr().out
+    assert gitlock.lock.Repo(pkg, gitpath).update_all_locks().commit == git(package, 'rev-parse', 'HEAD')
+
+def test_server_group_commit(gitpath):
+    import gitlock.server
+
+    assert gitlock.server.send(gitpath, {'op': 'ping'}) is None
+    server = gitlock.server.LockServer(gitpath)
+    requests = [gitlock.server.Request(data) for data in [
+        {'op': 'lock', 'pkg': pkg, 'user': 'fred', 'filenames': ['include/lsst/afw/table/io/FitsReader.h']},
+        {'op': 'lock', 'pkg': pkg, 'user': 'cyndi', 'filenames': ['include/lsst/afw/table/io/FitsReader.h']},
+        {'op': 'lock', 'pkg': pkg, 'user': 'cyndi', 'filenames': ['include/lsst/afw/table/io/FitsWriter.h']},
+        {'op': 'info', 'pkg': pkg},
+    ]]
+    head = git(gitpath, 'rev-parse', 'HEAD')
+    server.process(requests)
+    assert all([request.done.is_set() for request in requests])
+    assert [request.response['success'] for request in requests[:3]] == [True, False, True]
+    assert requests[1].response['report'][0][1] == 'locked'
+    assert [row[:2] for row in requests[3].response['locks']] == [
+        ['include/lsst/afw/table/io/FitsReader.h', 'fred'],
+        ['include/lsst/afw/table/io/FitsWriter.h', 'cyndi']]
+    # The requests that were granted are a single commit
+    assert git(gitpath, 'rev-list', '--count', head+'..HEAD') == '1'
+
+def test_server_sees_local_commits(gitpath):
+    import gitlock.server
+
+    def process(op, filename):
+        request = gitlock.server.Request({'op': op, 'pkg': pkg, 'user': 'fred', 'filenames': [filename]})
+        server.process([request])
+        return request.response['success']
+
+    server = gitlock.server.LockServer(gitpath)
+    assert process('lock', 'include/lsst/afw/table/io/FitsWriter.h')
+    assert process('unlock', 'include/lsst/afw/table/io/FitsWriter.h')
+    # Another process commits to the same clone, so the lockfile in the server is stale
+    # and a push on top of the new commit would not be rejected
+    assert gitlock.lock.Repo(pkg, gitpath).lock('include/lsst/afw/table/io/FitsWriter.h', 'carol')
+    assert not process('lock', 'include/lsst/afw/table/io/FitsWriter.h')
+    assert locked(gitpath) == {'include/lsst/afw/table/io/FitsWriter.h': 'carol'}
+
+def test_server_info_ttl(clone, package, monkeypatch):
+    import gitlock.server
+
+    gitpath = clone('locks', info_ttl=3600)
+    utils.create_lockfile(gitpath, pkg, package)
+    checks = []
+    remote_tip = gitlock.git_io.remote_tip
+
+    def check_remote(*args):
+        checks.append(args)
+        return remote_tip(*args)
+    monkeypatch.setattr(gitlock.git_io, 'remote_tip', check_remote)
+
+    def info(**data):
+        request = gitlock.server.Request(dict(op='info', pkg=pkg, **data))
+        server.process([request])
+        return request.response['locks']
+
+    server = gitlock.server.LockServer(gitpath)
+    # Without a ttl in the request the info_ttl of the package is used
+    assert info() == [] and len(checks) == 1
+    assert info() == [] and len(checks) == 1
+    assert info(ttl=0) == [] and len(checks) == 2
+
+def test_plumbing_backend(clone, package):
+    bare = clone('bare', 'plumbing')
+    utils.create_lockfile(bare, pkg, package)
+    repo = gitlock.lock.Repo(pkg, bare)
+    assert repo.backend == 'plumbing'
+    assert repo.lock(['include/lsst/afw/table/io/FitsReader.h', 'include/lsst/afw/table/io/FitsWriter.h'], 'fred')
+    assert repo.unlock('include/lsst/afw/table/io/FitsWriter.h', 'fred')
+    # The commits are on the remote, and a clone with a working tree sees them
+    worktree = clone('worktree')
+    assert locked(worktree) == {'include/lsst/afw/table/io/FitsReader.h': 'fred'}
+    assert git(bare, 'rev-parse', 'origin/master') == git(worktree, 'rev-parse', 'origin/master')
+    assert gitlock.lock.Repo(pkg, worktree).lock('include/lsst/afw/table/io/FitsWriter.h', 'cyndi')
+    assert not repo.lock('include/lsst/afw/table/io/FitsWriter.h', 'fred')
+    assert locked(bare) == {'include/lsst/afw/table/io/FitsReader.h': 'fred',
+                            'include/lsst/afw/table/io/FitsWriter.h': 'cyndi'}
+
+def test_path_trie():
+    from gitlock.lockfile import Lock, PathTrie
+
+    trie = PathTrie([Lock(None, 'include/lsst/afw/table', 'fred', 't0'),
+                     Lock(None, 'python/lsst/afw/geom/coordinateBase.cc', 'cyndi', 't1')])
+    # A directory lock covers everything below it
+    assert [lock.filename for lock in trie.conflicts('include/lsst/afw/table/io/FitsReader.h', 'cyndi')] == [
+        'include/lsst/afw/table']
+    assert trie.conflicts('include/lsst/afw/table/io/FitsReader.h', 'fred') == []
+    assert trie.parent_lock('include/lsst/afw/table/io/FitsReader.h').user == 'fred'
+    assert trie.parent_lock('include/lsst/afw/table') is None
+    # A directory conflicts with the locks on anything below it
+    assert [lock.filename for lock in trie.conflicts('python', 'fred')] == [
+        'python/lsst/afw/geom/coordinateBase.cc']
+    assert [lock.filename for lock in trie.conflicts('include', 'cyndi')] == ['include/lsst/afw/table']
+    assert trie.conflicts('python/lsst/afw/image', 'fred') == []
+    assert trie.conflicts('include/lsst/afw/image', 'cyndi') == []
+    assert trie.conflicts('other', 'fred') == []
+
+    trie.add(Lock(None, 'python/lsst/afw/geom', 'fred', 't2'))
+    assert len(trie.conflicts('python', 'sophie')) == 2
+    trie.remove('python/lsst/afw/geom/coordinateBase.cc')
+    assert [lock.filename for lock in trie.conflicts('python', 'fred')] == []
+    assert [lock.filename for lock in trie.conflicts('python', 'sophie')] == ['python/lsst/afw/geom']
+    trie.remove('python/lsst/afw/geom')
+    assert trie.conflicts('python', 'sophie') == []
+
+@pytest.mark.parametrize('lockfile_format', ['dense', 'sparse'])
+def test_directory_locks(clone, package, lockfile_format):
+    gitpath = clone('locks')
+    utils.create_lockfile(gitpath, pkg, package, lockfile_format=lockfile_format)
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    assert repo.lock('include/lsst/afw/table/io/FitsReader.h', 'cyndi')
+
+    # The directory contains a file locked by another user
+    report = repo.lock('include/lsst/afw/table', 'fred')
+    assert not report
+    assert report['include/lsst/afw/table'][0] == 'locked'
+    assert repo.unlock('include/lsst/afw/table/io/FitsReader.h', 'cyndi')
+    assert repo.lock('include/lsst/afw/table', 'fred')
+
+    # Files in the directory are covered by its lock
+    report = repo.lock('include/lsst/afw/table/io/FitsWriter.h', 'cyndi')
+    assert not report
+    assert 'include/lsst/afw/table' in report['include/lsst/afw/table/io/FitsWriter.h'][1]
+    report = repo.lock('include/lsst/afw/table/io/FitsWriter.h', 'fred')
+    assert report['include/lsst/afw/table/io/FitsWriter.h'][0] == 'held'
+    report = repo.unlock('include/lsst/afw/table/io/FitsWriter.h', 'fred')
+    assert report['include/lsst/afw/table/io/FitsWriter.h'][0] == 'unlocked'
+    assert locked(gitpath) == {'include/lsst/afw/table': 'fred'}
+
+    # Glob patterns only match files, so they conflict with the directory lock
+    report = repo.lock('include/lsst/afw/*/*/Fits*.h', 'cyndi')
+    assert not report
+    assert sorted(report) == ['include/lsst/afw/table/io/FitsReader.h',
+                              'include/lsst/afw/table/io/FitsSchemaInputMapper.h',
+                              'include/lsst/afw/table/io/FitsWriter.h']
+    assert repo.lock('python/*/*/*/*.cc', 'cyndi')
+    report = repo.lock('include/*.cc', 'cyndi')
+    assert report['include/*.cc'][0] == 'missing'
+    assert locked(gitpath) == {'include/lsst/afw/table': 'fred',
+                               'python/lsst/afw/geom/coordinateBase.cc': 'cyndi'}
+
+def test_metrics(gitpath, tmp_path):
+    import json
+    import gitlock.metrics as metrics
+
+    sink = str(tmp_path/'metrics.jsonl')
+    metrics.reset()
+    metrics.add_sink(metrics.load_sink(sink))
+    try:
+        repo = gitlock.lock.Repo(pkg, gitpath)
+        assert repo.lock('include/lsst/afw/table/io/FitsReader.h', 'fred')
+        summary = metrics.summary()
+    finally:
+        metrics.close()
+    phases = summary['phases']
+    for name in ('pull', 'prepare', 'write', 'commit', 'push'):
+        assert phases[name]['calls'] >= 1
+    assert phases['write']['bytes'] > 0
+    # The bytes sent to the remote are not known
+    assert phases['push']['bytes'] is None
+    assert summary['values']['lockfile_bytes'] == os.path.getsize(repo.lockfile_path)
+    with open(sink) as f:
+        records = [json.loads(line) for line in f]
+    assert records[-1]['type'] == 'summary'
+    assert set(['write', 'push']) <= set([r['phase'] for r in records if r['type'] == 'phase'])
+
+def test_metrics_remote_commands(clone, package):
+    import gitlock.metrics as metrics
+
+    gitpath = clone('bare', 'plumbing')
+    utils.create_lockfile(gitpath, pkg, package)
+    metrics.reset()
+    assert gitlock.lock.Repo(pkg, gitpath).lock('include/lsst/afw/table/io/FitsReader.h', 'fred')
+    phases = metrics.summary()['phases']
+    assert phases['git fetch']['bytes'] is None
+    assert phases['git push']['bytes'] is None
+    assert phases['git cat-file --batch']['bytes'] > 0
+
+def test_info_without_gitpython(gitpath, clone):
+    import sys
+
+    other = clone('other')
+    assert gitlock.lock.Repo(pkg, other).lock('include/lsst/afw/table/io/FitsReader.h', 'cyndi')
+    # The first query caches the package configuration, the second one runs without
+    # importing GitPython or PyYAML
+    script = ("import sys, gitlock.lock\n"
+              "locks = gitlock.lock.Repo({0!r}, {1!r}).get_locked_info(display=False)\n"
+              "print(list(locks), 'git' in sys.modules, 'yaml' in sys.modules)").format(pkg, gitpath)
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    for n in range(2):
+        output = subprocess.run([sys.executable, '-c', script], env=env, check=True,
+                                stdout=subprocess.PIPE).stdout.decode('utf-8').strip()
+    assert output == "['include/lsst/afw/table/io/FitsReader.h'] False False"
+
+def test_sparse_migration(gitpath):
+    from gitlock.lockfile import LockFile
+
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    assert repo.lock(['include/lsst/afw/table/io/FitsReader.h', 'include/lsst/afw/table'], 'fred')
+    dense_rows = len(LockFile(repo.lockfile_path))
+
+    utils.migrate_lockfile(gitpath, pkg, 'sparse')
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    locks = repo.update_all_locks()
+    assert locks.sparse
+    assert locks.commit == git(repo.config['pkg_path'], 'rev-parse', 'HEAD')
+    # Only the locked files have rows
+    assert sorted(locks) == ['include/lsst/afw/table', 'include/lsst/afw/table/io/FitsReader.h']
+    assert locked(gitpath) == {'include/lsst/afw/table/io/FitsReader.h': 'fred',
+                               'include/lsst/afw/table': 'fred'}
+
+    # Locking adds a row and unlocking removes it
+    assert repo.lock('python/lsst/afw/geom/coordinateBase.cc', 'cyndi')
+    assert 'python/lsst/afw/geom/coordinateBase.cc' in LockFile(repo.lockfile_path)
+    assert repo.unlock(['include/lsst/afw/table/io/FitsReader.h', 'include/lsst/afw/table'], 'fred')
+    assert list(LockFile(repo.lockfile_path)) == ['python/lsst/afw/geom/coordinateBase.cc']
+    assert not repo.lock('include/lsst/afw/missing.h', 'fred')
+
+    # Migrating back lists every file and directory of the package again
+    utils.migrate_lockfile(gitpath, pkg, 'dense')
+    locks = gitlock.lock.Repo(pkg, gitpath).update_all_locks()
+    assert not locks.sparse
+    assert len(locks) == dense_rows
+    assert locked(gitpath) == {'python/lsst/afw/geom/coordinateBase.cc': 'cyndi'}
+
+@pytest.mark.parametrize('shards', ['prefix:1', 'hash:4'])
+def test_shards(clone, package, shards):
+    gitpath = clone('locks')
+    utils.create_lockfile(gitpath, pkg, package, shards=shards)
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    shard_dir = os.path.join(os.path.dirname(repo.lockfile_path), 'locks')
+    assert len(os.listdir(shard_dir)) > 1
+    head = git(gitpath, 'rev-parse', 'HEAD')
+    assert repo.lock('include/lsst/afw/table/io/FitsReader.h', 'fred')
+    # Only the shard with the file changed
+    changed = git(gitpath, 'diff', '--name-only', head, 'HEAD').split()
+    assert len(changed) == 1 and changed[0].startswith('repos/{0}/locks/'.format(pkg))
+    assert repo.lock('include/lsst/afw/table', 'fred')
+    assert not repo.lock('include', 'cyndi')
+    assert locked(gitpath) == {'include/lsst/afw/table/io/FitsReader.h': 'fred',
+                               'include/lsst/afw/table': 'fred'}
+
+    utils.migrate_lockfile(gitpath, pkg, shards='none')
+    assert not os.path.exists(shard_dir)
+    assert git(gitpath, 'ls-files', 'repos/{0}/locks'.format(pkg)) == ''
+    assert is_clean(gitpath)
+    locks = gitlock.lock.Repo(pkg, gitpath).update_all_locks()
+    assert locks.shards is None
+    assert locked(gitpath) == {'include/lsst/afw/table/io/FitsReader.h': 'fred',
+                               'include/lsst/afw/table': 'fred'}
+
+def test_compact_history(gitpath, clone, origin):
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    for user in ('fred', 'cyndi', 'sophie'):
+        assert repo.lock('include/lsst/afw/table/io/FitsReader.h', user)
+        assert repo.unlock('include/lsst/afw/table/io/FitsReader.h', user)
+    assert repo.lock('include/lsst/afw/table/io/FitsWriter.h', 'fred')
+    old = git(origin, 'rev-parse', 'master')
+
+    utils.compact_lock_repo(gitpath, pkg, keep=1, archive='archive')
+    assert git(origin, 'rev-list', '--count', 'master') == '2'
+    assert git(origin, 'rev-parse', 'archive') == old
+    assert git(origin, 'rev-parse', 'master^{tree}') == git(origin, 'rev-parse', old+'^{tree}')
+    assert git(gitpath, 'rev-parse', 'HEAD') == git(origin, 'rev-parse', 'master')
+    assert is_clean(gitpath)
+
+    # Other clones follow the rewritten history, with a shallow fetch
+    other = clone('other')
+    assert gitlock.lock.Repo(pkg, other).lock('include/lsst/afw/table/io/FitsReader.h', 'cyndi')
+    assert repo.lock('include/lsst/afw/table/io/InputArchive.h', 'fred')
+    assert locked(other) == {'include/lsst/afw/table/io/FitsReader.h': 'cyndi',
+                             'include/lsst/afw/table/io/FitsWriter.h': 'fred',
+                             'include/lsst/afw/table/io/InputArchive.h': 'fred'}
+
+def test_pull_keeps_local_changes(gitpath, clone):
+    readme = os.path.join(gitpath, 'README')
+    with open(readme, 'a') as f:
+        f.write('a local note\n')
+    other = clone('other')
+    assert gitlock.lock.Repo(pkg, other).lock('include/lsst/afw/table/io/FitsReader.h', 'cyndi')
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    assert repo.lock('include/lsst/afw/table/io/FitsWriter.h', 'fred')
+    with open(readme) as f:
+        assert f.read().endswith('a local note\n')
+    assert git(gitpath, 'status', '--porcelain', '--untracked-files=no') == 'M README'
+
+    # A file with local changes that also changed on the remote is not overwritten
+    git(other, 'pull', '-q', '--ff-only')
+    write_files(other, ['README'], 'changed on the remote\n')
+    git(other, 'commit', '-q', '-a', '-m', 'Change README')
+    git(other, 'push', '-q', 'origin', 'master')
+    with pytest.raises(gitlock.git_io.GitError):
+        repo.lock('include/lsst/afw/table/io/InputArchive.h', 'fred')
+    with open(readme) as f:
+        assert f.read().endswith('a local note\n')
+
+def test_pull_keeps_local_commits(gitpath, clone):
+    write_files(gitpath, ['README'], 'a local commit\n')
+    git(gitpath, 'commit', '-q', '-a', '-m', 'Change README')
+    head = git(gitpath, 'rev-parse', 'HEAD')
+    other = clone('other')
+    assert gitlock.lock.Repo(pkg, other).lock('include/lsst/afw/table/io/FitsReader.h', 'cyndi')
+    # The shallow pull cannot merge, and does not drop the commit that was not pushed
+    with pytest.raises(gitlock.git_io.GitError):
+        gitlock.lock.Repo(pkg, gitpath).lock('include/lsst/afw/table/io/FitsWriter.h', 'fred')
+    assert git(gitpath, 'rev-parse', 'HEAD') == head
+
+def test_pull_configured_branch(gitpath, clone, origin):
+    git(origin, 'branch', 'locks', 'master')
+    master = git(origin, 'rev-parse', 'master')
+    other = clone('other', branch='locks')
+    repo = gitlock.lock.Repo(pkg, other)
+    assert repo.lock('include/lsst/afw/table/io/FitsReader.h', 'cyndi')
+    assert git(origin, 'rev-parse', 'master') == master
+    assert git(origin, 'rev-parse', 'locks') != master
+    assert locked(other) == {'include/lsst/afw/table/io/FitsReader.h': 'cyndi'}
+    assert repo.unlock('include/lsst/afw/table/io/FitsReader.h', 'cyndi')
+    assert git(origin, 'rev-parse', 'master') == master
+    assert locked(other) == {}
+
+def test_check(gitpath, package):
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    assert repo.lock('include/lsst/afw/table/io/FitsReader.h', 'cyndi')
+    assert repo.lock('python/lsst/afw/geom', 'sophie')
+    assert repo.check('fred')
+
+    write_files(package, ['include/lsst/afw/table/io/FitsReader.h',
+                          'python/lsst/afw/geom/coordinateBase.cc',
+                          'include/lsst/afw/table/io/FitsWriter.h'], 'changed\n')
+    git(package, 'add', 'include/lsst/afw/table/io/FitsWriter.h')
+    report = repo.check('fred')
+    assert not report
+    assert report['include/lsst/afw/table/io/FitsReader.h'][0] == 'locked'
+    assert report['python/lsst/afw/geom/coordinateBase.cc'][0] == 'conflict'
+    assert 'include/lsst/afw/table/io/FitsWriter.h' not in report
+    # Only the staged file is checked before a commit
+    assert repo.check('fred', staged=True)
+    assert repo.check('cyndi', staged=True)
+    assert set(repo.check('cyndi')) == set(['python/lsst/afw/geom/coordinateBase.cc'])
+
+def test_watch(gitpath, clone):
+    other = clone('other')
+    watcher = gitlock.lock.Repo(pkg, gitpath).watch(interval=0)
+    locks, events = next(watcher)
+    assert len(locks) == 0 and events == []
+    assert gitlock.lock.Repo(pkg, other).lock('include/lsst/afw/table/io/FitsReader.h', 'cyndi')
+    locks, events = next(watcher)
+    assert list(locks) == ['include/lsst/afw/table/io/FitsReader.h']
+    assert [(e['event'], e['path'], e['user']) for e in events] == [
+        ('locked', 'include/lsst/afw/table/io/FitsReader.h', 'cyndi')]
+    assert gitlock.lock.Repo(pkg, other).unlock('include/lsst/afw/table/io/FitsReader.h', 'cyndi')
+    locks, events = next(watcher)
+    assert len(locks) == 0
+    assert [(e['event'], e['user']) for e in events] == [('unlocked', 'cyndi')]
+
+def test_watch_claim(gitpath, clone, package):
+    import sys
+    import time
+
+    other = clone('other')
+    assert gitlock.lock.Repo(pkg, other).lock('include/lsst/afw/table/io/FitsReader.h', 'cyndi')
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts', 'gitlock')
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(script)))
+    watch = subprocess.Popen([sys.executable, script, 'watch', pkg, '-g', gitpath, '-u', 'fred',
+                              '-f', 'include/lsst/afw/table/io/FitsReader.h', '--claim', '-i', '0.1'],
+                             cwd=package, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    try:
+        time.sleep(1)
+        assert watch.poll() is None
+        assert gitlock.lock.Repo(pkg, other).unlock('include/lsst/afw/table/io/FitsReader.h', 'cyndi')
+        output = watch.communicate(timeout=60)[0].decode('utf-8')
+    finally:
+        if watch.poll() is None:
+            watch.kill()
+    assert watch.returncode == 0, output
+    assert 'unlocked by cyndi' in output
+    assert locked(other) == {'include/lsst/afw/table/io/FitsReader.h': 'fred'}
+
+def test_query():
+    import datetime
+    from gitlock.lockfile import Lock
+    from gitlock.query import LockIndex, parse_age
+
+    now = datetime.datetime.now()
+
+    def ago(**kwargs):
+        return str(now-datetime.timedelta(**kwargs))
+    locks = [
+        Lock(None, 'include/lsst/afw/table/io/FitsReader.h', 'fred', ago(days=10)),
+        Lock(None, 'include/lsst/afw/table/io/FitsWriter.h', 'cyndi', ago(hours=2)),
+        Lock(None, 'include/lsst/afw/table', 'sophie', ago(days=3)),
+        Lock(None, 'python/lsst/afw/geom/coordinateBase.cc', 'fred', ago(minutes=5)),
+    ]
+    index = LockIndex(dict([(lock.filename, lock) for lock in locks]))
+
+    def query(**kwargs):
+        return [lock.filename for lock in index.query(**kwargs)]
+    assert parse_age('2w') == datetime.timedelta(days=14)
+    with pytest.raises(ValueError):
+        parse_age('soon')
+    assert query(user='fred') == ['include/lsst/afw/table/io/FitsReader.h',
+                                  'python/lsst/afw/geom/coordinateBase.cc']
+    assert query(paths=['include/lsst/afw/table']) == [
+        'include/lsst/afw/table', 'include/lsst/afw/table/io/FitsReader.h',
+        'include/lsst/afw/table/io/FitsWriter.h']
+    assert query(paths=['include/lsst/afw/tab']) == []
+    assert query(paths=['*.cc', 'include/*/Fits*.h']) == [
+        'include/lsst/afw/table/io/FitsReader.h', 'include/lsst/afw/table/io/FitsWriter.h',
+        'python/lsst/afw/geom/coordinateBase.cc']
+    assert query(older_than='1d', sortby='time') == ['include/lsst/afw/table/io/FitsReader.h',
+                                                     'include/lsst/afw/table']
+    assert query(newer_than='1d', older_than='1h') == ['include/lsst/afw/table/io/FitsWriter.h']
+    assert query(sortby='time', reverse=True, limit=2, offset=1) == [
+        'include/lsst/afw/table/io/FitsWriter.h', 'include/lsst/afw/table']
+    assert query(user='fred', paths=['python']) == ['python/lsst/afw/geom/coordinateBase.cc']
+    with pytest.raises(ValueError):
+        query(sortby='size')
+
+def test_batch_reader(gitpath, clone):
+    reader = gitlock.git_io.batch_reader(gitpath)
+    assert gitlock.git_io.batch_reader(gitpath) is reader
+    head = git(gitpath, 'rev-parse', 'HEAD')
+    kind, data = reader.read(head+':README')
+    assert (kind, data) == ('blob', b'gitlock test locks\n')
+    with pytest.raises(gitlock.git_io.GitError):
+        reader.read(head+':missing')
+
+    # Objects fetched after the reader started are found, and a reader whose process
+    # died is restarted
+    other = clone('other')
+    assert gitlock.lock.Repo(pkg, other).lock('include/lsst/afw/table/io/FitsReader.h', 'cyndi')
+    tip = gitlock.git_io.fetch(gitpath, 'master')
+    reader.process.kill()
+    reader.process.wait()
+    lockfile = gitlock.git_io.read_blob(gitpath, tip, 'repos/{0}/locks.txt'.format(pkg))
+    assert b'"cyndi"' in lockfile
+    gitlock.git_io.close_readers()
+
+def test_multiple_packages(gitpath, package, tmp_path):
+    import gitlock.multi
+
+    meas = str(tmp_path/'meas')
+    os.makedirs(meas)
+    git(meas, 'init', '-q')
+    write_files(meas, ['include/lsst/meas/Algorithm.h', 'src/Algorithm.cc'])
+    git(meas, 'add', '.')
+    git(meas, 'commit', '-q', '-m', 'init')
+    utils.edit_lock_cfg('meas', gitpath, meas)
+    utils.build_lockfiles(gitpath, ['meas'])
+    assert utils.get_packages(gitpath, None, True) == ['afw', 'meas']
+
+    multi = gitlock.multi.MultiRepo(['afw', 'meas'], gitpath)
+    head = git(gitpath, 'rev-parse', 'HEAD')
+    reports = multi.change_locks('lock', [os.path.join(package, 'include/lsst/afw/table/io/FitsReader.h'),
+                                          os.path.join(meas, 'src/Algorithm.cc')], 'fred')
+    assert all(reports.values())
+    assert git(gitpath, 'rev-list', '--count', head+'..HEAD') == '1'
+    assert locked(gitpath) == {'include/lsst/afw/table/io/FitsReader.h': 'fred'}
+    assert list(gitlock.lock.Repo('meas', gitpath).get_locked_info(display=False)) == ['src/Algorithm.cc']
+
+    # A request that fails in one package is not applied to the others
+    reports = gitlock.multi.MultiRepo(['afw', 'meas'], gitpath).change_locks(
+        'lock', [os.path.join(package, 'include/lsst/afw/table/io/FitsWriter.h'),
+                 os.path.join(meas, 'src/Algorithm.cc')], 'cyndi')
+    assert not reports['afw'] and not reports['meas']
+    assert reports['afw']['include/lsst/afw/table/io/FitsWriter.h'][0] == 'available'
+    assert reports['meas']['src/Algorithm.cc'][0] == 'locked'
+    assert locked(gitpath) == {'include/lsst/afw/table/io/FitsReader.h': 'fred'}
+    locks = gitlock.multi.MultiRepo(['afw', 'meas'], gitpath).read_locked()
+    assert [list(pkg_locks) for pkg_locks in locks.values()] == [
+        ['include/lsst/afw/table/io/FitsReader.h'], ['src/Algorithm.cc']]
+
+def test_async_repo(gitpath):
+    import asyncio
+    import gitlock.aio
+
+    async def run():
+        repo = gitlock.aio.AsyncRepo(pkg, gitpath, window=0.2)
+        head = git(gitpath, 'rev-parse', 'HEAD')
+        # Requests that arrive together are a single commit
+        reports = await asyncio.gather(
+            repo.lock(['include/lsst/afw/table/io/FitsReader.h'], 'fred'),
+            repo.lock(['include/lsst/afw/table/io/FitsReader.h'], 'cyndi'),
+            repo.lock(['include/lsst/afw/table/io/FitsWriter.h'], 'cyndi'))
+        assert [bool(report) for report in reports] == [True, False, True]
+        assert git(gitpath, 'rev-list', '--count', head+'..HEAD') == '1'
+        assert (await repo.unlock(['include/lsst/afw/table/io/FitsWriter.h'], 'cyndi'))
+
+        # Another process commits to the same clone, so the writer has to reload the
+        # lockfile even though its push would not be rejected
+        assert gitlock.lock.Repo(pkg, gitpath).lock('include/lsst/afw/table/io/FitsWriter.h', 'carol')
+        report = await repo.lock(['include/lsst/afw/table/io/FitsWriter.h'], 'fred')
+        assert not report
+        locks = await repo.info()
+        assert [(lock.filename, lock.user) for lock in locks] == [
+            ('include/lsst/afw/table/io/FitsReader.h', 'fred'),
+            ('include/lsst/afw/table/io/FitsWriter.h', 'carol')]
+
+        # The default user is read once
+        assert (await repo.lock(['python/lsst/afw/geom/coordinateBase.cc']))
+        assert repo.username == 'fred'
+        await repo.close()
+    asyncio.run(run())
+
+def test_history(gitpath, clone, origin, tmp_path):
+    import gitlock.history
+
+    other = clone('other')
+    repo = gitlock.lock.Repo(pkg, other)
+    assert repo.lock('include/lsst/afw/table/io/FitsReader.h', 'fred')
+    assert repo.lock('include/lsst/afw/table/io/FitsWriter.h', 'cyndi')
+    assert repo.unlock('include/lsst/afw/table/io/FitsReader.h', 'fred')
+
+    # A shallow clone of the lock repo, as left by the default fetch depth of 1
+    shallow = str(tmp_path/'shallow')
+    git(str(tmp_path), 'clone', '-q', '--depth=1', 'file://'+origin, shallow)
+    utils.edit_lock_cfg(pkg, shallow, gitlock.lock.Repo(pkg, gitpath).config['pkg_path'])
+    index = gitlock.history.History(gitlock.lock.Repo(pkg, shallow))
+    assert index.update() > 0
+    assert [(hold.path, hold.user, hold.end is None) for hold in index.holds()] == [
+        ('include/lsst/afw/table/io/FitsReader.h', 'fred', False),
+        ('include/lsst/afw/table/io/FitsWriter.h', 'cyndi', True)]
+    assert index.update() == 0
+
+    # Only the new commits are fetched and indexed
+    for user in ('sophie', 'fred', 'cyndi'):
+        assert repo.lock('include/lsst/afw/table/io/InputArchive.h', user)
+        assert repo.unlock('include/lsst/afw/table/io/InputArchive.h', user)
+    gitlock.lock.Repo(pkg, shallow).fetch_locks()
+    assert git(shallow, 'rev-parse', '--is-shallow-repository') == 'true'
+    assert index.update() == 6
+    holds = [(hold.path, hold.user, hold.start_commit, hold.end_commit) for hold in index.holds()]
+    assert [(hold.path, hold.user) for hold in index.holds(paths=['include/lsst/afw/table/io/InputArchive.h'])] == [
+        ('include/lsst/afw/table/io/InputArchive.h', user) for user in ('sophie', 'fred', 'cyndi')]
+    assert [row[0] for row in index.user_stats()] == ['cyndi', 'fred', 'sophie']
+
+    # Indexing the whole history from scratch gives the same holds
+    full = gitlock.history.History(gitlock.lock.Repo(pkg, shallow), str(tmp_path/'full.sqlite'))
+    full.update()
+    assert [(hold.path, hold.user, hold.start_commit, hold.end_commit) for hold in full.holds()] == holds
 
-build_lock_file(pkg, repo_path)
-lock_file('python/lsst/afw/geom/coordinateBase.cc', 'afw')
+def test_spool_coalescing(gitpath):
+    import gitlock.spool
 
-lock_file('include/lsst/afw/table/io/FitsReader.h', 'afw', 'fred')
-lock_file('include/lsst/afw/table/io/FitsSchemaInputMapper.h', 'afw', 'cyndi')
-lock_file('include/lsst/afw/table/io/FitsWriter.h', 'afw', 'sophie')
-lock_file('include/lsst/afw/table/io/InputArchive.h', 'afw', 'fred')
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    spool_dir = gitlock.spool.get_spool_dir(repo)
+    # Requests that other processes queued while waiting for the repo lock, and one of a
+    # process that is no longer running
+    waiting = [('0-1', 'cyndi', 'include/lsst/afw/table/io/FitsWriter.h', os.getpid()),
+               ('0-2', 'sophie', 'include/lsst/afw/table/io/FitsReader.h', os.getpid()),
+               ('0-3', 'sophie', 'include/lsst/afw/table/io/InputArchive.h', 2**22+1)]
+    for name, user, filename, pid in waiting:
+        utils.dump_json(os.path.join(spool_dir, name+'.request'),
+                        {'pid': pid, 'requests': [['lock', [filename], user]]})
+    head = git(gitpath, 'rev-parse', 'HEAD')
+    reports = gitlock.spool.submit(repo, [('lock', ['include/lsst/afw/table/io/FitsReader.h'], 'fred'),
+                                          ('unlock', ['include/lsst/afw/table/io/FitsWriter.h'], 'fred')])
+    assert git(gitpath, 'rev-list', '--count', head+'..HEAD') == '1'
+    # The queued requests came first, so sophie has the lock and cyndi's lock cannot be
+    # released by fred
+    assert not reports[0] and reports[0]['include/lsst/afw/table/io/FitsReader.h'][0] == 'locked'
+    assert not reports[1] and reports[1]['include/lsst/afw/table/io/FitsWriter.h'][0] == 'locked'
+    assert locked(gitpath) == {'include/lsst/afw/table/io/FitsWriter.h': 'cyndi',
+                               'include/lsst/afw/table/io/FitsReader.h': 'sophie'}
+    # The waiting processes find their results, the dead process's request is dropped
+    result = utils.load_json(os.path.join(spool_dir, '0-1.result'))
+    assert result['reports'] == [['lock', True, [['include/lsst/afw/table/io/FitsWriter.h', 'granted', 'locked']]]]
+    assert utils.load_json(os.path.join(spool_dir, '0-2.result'))['reports'][0][1]
+    assert sorted(os.listdir(spool_dir)) == ['0-1.request', '0-1.result', '0-2.request', '0-2.result']
 
-lock_file('python/lsst/afw/geom/coordinateBase.cc', 'afw')
-lock_file('include/lsst/afw/table/io/FitsReader.h', 'afw')
-lock_file('include/lsst/afw/table/io/FitsSchemaInputMapper.h', 'afw')
-lock_file('include/lsst/afw/table/io/FitsWriter.h', 'afw')
-lock_file('include/lsst/afw/table/io/InputArchive.h', 'afw')
+def test_install_lockfiles(gitpath, package, origin, capsys):
+    repo = gitlock.lock.Repo(pkg, gitpath)
+    assert repo.lock('include/lsst/afw/table/io/FitsReader.h', 'fred')
+    lock_dir = os.path.dirname(repo.lockfile_path)
+    with open(repo.lockfile_path, 'rb') as f:
+        original = f.read()
 
-#unlock_file('include/lsst/afw/table/io/InputArchive.h', 'afw')
-#unlock_file('include/lsst/afw/table/io/InputArchive.h', 'afw', 'fred')
+    # A rebuild that cannot be pushed leaves the old lockfile and no temporary files
+    with open(os.path.join(origin, 'hooks', 'pre-receive'), 'w') as f:
+        f.write('#!/bin/sh\nexit 1\n')
+    os.chmod(os.path.join(origin, 'hooks', 'pre-receive'), 0o755)
+    capsys.readouterr()
+    with pytest.raises(gitlock.git_io.GitError):
+        utils.create_lockfile(gitpath, pkg, package, overwrite=True, shards='prefix:1')
+    assert 'Restoring' not in capsys.readouterr().out
+    with open(repo.lockfile_path, 'rb') as f:
+        assert f.read() == original
+    assert sorted(os.listdir(lock_dir)) == ['locks.cfg', 'locks.txt']
+    assert is_clean(gitpath)
 
-get_locked_info(pkg, sortby='user')
-#get_locked_info(pkg, username="fred")
\ No newline at end of file
+    os.remove(os.path.join(origin, 'hooks', 'pre-receive'))
+    utils.create_lockfile(gitpath, pkg, package, overwrite=True, shards='prefix:1')
+    assert sorted(os.listdir(lock_dir)) == ['locks', 'locks.cfg', 'locks.txt']
+    assert is_clean(gitpath)
+    # A rebuild without an update starts with no locks
+    assert locked(gitpath) == {}